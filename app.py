@@ -1,25 +1,46 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, abort
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from datetime import datetime
+from datetime import datetime, timedelta
 from itsdangerous import URLSafeTimedSerializer
 import os
-from flask_mail import Mail, Message as MailMessage
-from werkzeug.utils import secure_filename
+from flask_mail import Mail, Message as MailMessage, Connection as MailConnection
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.exceptions import ClientDisconnected
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 import json
+import re
+import urllib.parse
+import html
+import mimetypes
+import struct
+import smtplib
+import heapq
+import itertools
 import time, hmac, hashlib, base64
+import threading
+import atexit
+import uuid
+import glob
+import shutil
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from flask import request as flask_request
-try:
+
+# Режим конкурентности Socket.IO: threading (по умолчанию), eventlet или gevent.
+# Для eventlet/gevent monkey-patching должен выполниться до импорта остальных модулей,
+# поэтому эти режимы запускаются через serve.py. USE_EVENTLET=1 оставлен для совместимости.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if os.environ.get('USE_EVENTLET') == '1':
     import eventlet
-    # Включать monkey_patch только если явно задано USE_EVENTLET=1
-    if os.environ.get('USE_EVENTLET') == '1':
-        eventlet.monkey_patch()
-    else:
-        eventlet = None
-except Exception:
-    eventlet = None
+    eventlet.monkey_patch()
+    ASYNC_MODE = 'eventlet'
+if ASYNC_MODE not in ('threading', 'eventlet', 'gevent'):
+    ASYNC_MODE = 'threading'
 
 # Инициализация и Конфигурация
 app = Flask(__name__)
@@ -43,6 +64,38 @@ else:
     else:
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Пул соединений с БД. В кооперативных режимах одновременно работающих обработчиков
+# (гринлетов) намного больше, чем потоков, поэтому пул больше, а ожидание соединения
+# ограничено DB_POOL_TIMEOUT: лишние запросы ждут в очереди, а не открывают соединения.
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (ValueError, TypeError):
+        return default
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (ValueError, TypeError):
+        return default
+
+DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 10 if ASYNC_MODE == 'threading' else 40)
+DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 10)
+DB_POOL_TIMEOUT = _env_int('DB_POOL_TIMEOUT', 30)
+_db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+if _db_uri.startswith('sqlite') and (_db_uri in ('sqlite://', 'sqlite:///') or ':memory:' in _db_uri):
+    pass  # БД в памяти живет в одном соединении, пул не настраивается
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_pre_ping': True,
+    }
+    if _db_uri.startswith('sqlite'):
+        # SQLite пишет по одному: пусть конкурирующие запросы ждут блокировку, а не падают
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'timeout': DB_POOL_TIMEOUT}
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB для видео
 
 # Загрузка аватаров
@@ -50,11 +103,83 @@ UPLOAD_AVATAR_DIR = os.path.join('static', 'uploads', 'avatars')
 os.makedirs(UPLOAD_AVATAR_DIR, exist_ok=True)
 ALLOWED_IMAGE_EXTENSIONS = { 'png', 'jpg', 'jpeg', 'gif', 'webp' }
 
+# Загруженные файлы никогда не перезаписываются (уникальные имена или имя по содержимому),
+# поэтому отдаются с Cache-Control: immutable. MEDIA_ACCEL_REDIRECT — префикс internal-location
+# nginx: файл отдает nginx (sendfile, Range), приложение только проверяет путь
+UPLOAD_ROOT = os.path.join(BASE_DIR, 'static', 'uploads')
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600  # секунды
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT', '').rstrip('/')
+
 # Загрузка медиа (фото/видео)
 UPLOAD_MEDIA_DIR = os.path.join('static', 'uploads', 'media')
 os.makedirs(UPLOAD_MEDIA_DIR, exist_ok=True)
 ALLOWED_VIDEO_EXTENSIONS = { 'mp4', 'webm', 'ogg', 'mov' }
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+# Вложения хранятся по содержимому: cas/<2 символа>/<sha256><расширение>, один файл на digest
+MEDIA_STORE_DIR = os.path.join(UPLOAD_MEDIA_DIR, 'cas')
+MEDIA_STORE_CHUNK = 1024 * 1024  # байт
+# Загрузка по частям (/api/uploads): части дописываются в файл на диске, обрыв продолжается с подтвержденного смещения
+UPLOAD_CHUNK_MAX = 8 * 1024 * 1024  # байт в одном PUT
+UPLOAD_SESSION_TTL = 24 * 3600  # секунды; незавершенные загрузки старше удаляются
+UPLOAD_SESSIONS_PER_USER = 20
+
+# Уменьшенные копии картинок (нужен Pillow): наибольшая сторона, пикселей.
+# Считаются в пуле процессов после загрузки, до готовности клиент показывает оригинал
+MEDIA_VARIANT_SIZES = {'thumb': 480, 'preview': 1600}
+AVATAR_VARIANT_SIDE = 256
+MEDIA_PIPELINE_WORKERS = _env_int('MEDIA_PIPELINE_WORKERS', 2)  # 0 — не создавать копии
+
+# Хэширование паролей (scrypt, десятки мс CPU) идет в пуле процессов, а не в обработчике.
+# Сверх PASSWORD_HASH_QUEUE_LIMIT задач (выполняются + ждут) вход отвечает 503 сразу
+PASSWORD_HASH_WORKERS = _env_int('PASSWORD_HASH_WORKERS', 2)  # 0 — считать в обработчике
+PASSWORD_HASH_QUEUE_LIMIT = _env_int('PASSWORD_HASH_QUEUE_LIMIT', 4 * max(PASSWORD_HASH_WORKERS, 1))
+PASSWORD_HASH_TIMEOUT = _env_float('PASSWORD_HASH_TIMEOUT', 10.0)  # секунды
+
+# Рассылка сообщений: начиная с этого числа участников сообщение кодируется один раз
+# и уходит в общую socket-комнату участников, а счетчики непрочитанных — пачками
+try:
+    ROOM_FANOUT_THRESHOLD = int(os.environ.get('ROOM_FANOUT_THRESHOLD', 200))
+except (ValueError, TypeError):
+    ROOM_FANOUT_THRESHOLD = 200
+UNREAD_DELTA_FLUSH_INTERVAL = 0.5  # секунды
+
+# Присутствие: офлайн публикуется, только если пользователь не вернулся за PRESENCE_OFFLINE_GRACE;
+# изменения рассылаются пачками presence_batch раз в PRESENCE_FLUSH_INTERVAL
+PRESENCE_OFFLINE_GRACE = 5.0  # секунды
+PRESENCE_FLUSH_INTERVAL = 1.0  # секунды
+# Раз в PRESENCE_SWEEP_INTERVAL опубликованные онлайн без соединений (их процесс упал) уходят в офлайн
+PRESENCE_SWEEP_INTERVAL = 30.0  # секунды
+
+# Слияние частых эфемерных событий (typing, слайды, реакции, опросы) в окне COALESCE_WINDOW
+COALESCE_WINDOW = _env_float('COALESCE_WINDOW', 0.1)  # секунды
+# Повторный "печатает" от того же пользователя рассылается не чаще раза в TYPING_REFRESH
+# (клиент гасит индикатор через 1.5 с без обновлений)
+TYPING_REFRESH = 1.0  # секунды
+# Отметки "печатает" без остановки (клиент отключился) забываются через TYPING_STATE_TTL
+TYPING_STATE_TTL = 30.0  # секунды
+
+# Совместные документы: журнал последних операций для преобразования запоздавших правок,
+# снимок в БД раз в DOCUMENT_SNAPSHOT_INTERVAL, неактивные документы выгружаются из памяти
+DOCUMENT_OP_LOG_SIZE = 500
+DOCUMENT_SNAPSHOT_INTERVAL = 10  # секунды
+DOCUMENT_IDLE_TTL = 600  # секунды
+DOCUMENT_MAX_LENGTH = 1000000  # символов
+
+# Активные доска и презентация комнаты отдаются при входе; без обновлений запись истекает
+ROOM_SESSION_TTL = 3 * 3600  # секунды
+
+# Общее состояние и межпроцессная рассылка: без STATE_BACKEND_URL все живет в памяти
+# одного процесса; с redis://... можно запускать несколько процессов за балансировщиком
+# с липкими сессиями (Socket.IO использует тот же адрес как очередь сообщений)
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL') or None
+
+# Кэш прав доступа (участие, роли, блокировки) для частых socket-событий
+ACCESS_CACHE_MAX_ENTRIES = 50000
+ACCESS_CACHE_TTL = 300  # секунды; изменения членства и блокировок сбрасывают записи сразу
+
+# Размер страницы истории чата
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 200
 
 # Конфигурация Email (Чтение из переменных окружения)
 # ... (Настройки MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD) ...
@@ -81,14 +206,28 @@ app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 if app.config['MAIL_USERNAME']:
     app.config['MAIL_DEFAULT_SENDER'] = ('GlassChat Team', app.config['MAIL_USERNAME'])
 
+# Очередь писем: обработчики запросов не ждут SMTP. Рабочая задача шлет через одно
+# соединение до MAIL_BATCH_SIZE писем и держит его открытым MAIL_CONNECTION_IDLE после
+# последнего письма; временные ошибки повторяются через MAIL_RETRY_BASE·2^n, не дольше MAIL_RETRY_MAX
+MAIL_BATCH_SIZE = _env_int('MAIL_BATCH_SIZE', 50)
+MAIL_CONNECTION_IDLE = _env_float('MAIL_CONNECTION_IDLE', 10.0)  # секунды
+MAIL_SMTP_TIMEOUT = _env_float('MAIL_SMTP_TIMEOUT', 30.0)  # секунды на одну операцию SMTP
+MAIL_MAX_ATTEMPTS = _env_int('MAIL_MAX_ATTEMPTS', 5)
+MAIL_RETRY_BASE = 2.0  # секунды
+MAIL_RETRY_MAX = 300.0  # секунды
+MAIL_QUEUE_POLL = 0.2  # секунды
+# Раз в MAIL_STATS_INTERVAL очередь печатает глубину, счетчики и задержку, если что-то изменилось
+MAIL_STATS_INTERVAL = _env_float('MAIL_STATS_INTERVAL', 300.0)  # секунды
+
 db = SQLAlchemy(app)
 socketio = SocketIO(
     app,
-    async_mode='threading',
+    async_mode=ASYNC_MODE,
     cors_allowed_origins='*',
     ping_timeout=25,
     ping_interval=15,
-    allow_upgrades=False
+    allow_upgrades=False,
+    message_queue=STATE_BACKEND_URL
 )
 s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 mail = Mail(app)
@@ -113,11 +252,13 @@ class User(db.Model):
     bio = db.Column(db.String(200), default="", nullable=True)
     theme = db.Column(db.String(20), default="dark", nullable=False)
     avatar_url = db.Column(db.String(256), nullable=True)
+    # Поиск по префиксу имени без учета регистра (search_users)
+    __table_args__ = (db.Index('ix_user_username_lower', db.func.lower(username)),)
 
     rooms = db.relationship('RoomParticipant', backref='user', lazy='dynamic')
 
-    def set_password(self, p): self.password_hash = generate_password_hash(p)
-    def check_password(self, p): return check_password_hash(self.password_hash, p)
+    def set_password(self, p): self.password_hash = hash_password(p)
+    def check_password(self, p): return verify_password(self.password_hash, p)
 
     def get_contact(self, contact_user):
         return Contact.query.filter_by(user_id=self.id, contact_id=contact_user.id).first()
@@ -158,9 +299,11 @@ class Room(db.Model):
         role = 'member'
         dm_other_user_id = None
 
+        last_read_message_id = None
         current_participant = self.participants.filter(RoomParticipant.user_id == current_user.id).first()
         if current_participant:
             role = current_participant.role
+            last_read_message_id = current_participant.last_read_message_id
 
         if self.type == 'dm':
             other_participant_entry = self.participants.filter(RoomParticipant.user_id != current_user.id).first()
@@ -175,9 +318,8 @@ class Room(db.Model):
                 if other_participant_entry.user.avatar_url:
                     avatar = other_participant_entry.user.avatar_url
         
-        # Получаем количество непрочитанных
-        unread_entry = UnreadMessage.query.filter_by(user_id=current_user.id, room_id=self.id).first()
-        unread_count = unread_entry.count if unread_entry else 0
+        # Количество непрочитанных считается от указателя прочтения
+        unread_count = count_unread(self.id, current_user.id, last_read_message_id)
 
         return display_name, role, avatar, dm_other_user_id, unread_count
         
@@ -199,6 +341,7 @@ class RoomParticipant(db.Model):
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), primary_key=True)
     role = db.Column(db.String(10), default='member', nullable=False)
     is_archived = db.Column(db.Boolean, default=False, nullable=False)  # Архивирован ли чат для этого пользователя
+    last_read_message_id = db.Column(db.Integer, nullable=True)  # До какого сообщения пользователь прочитал комнату
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -208,38 +351,58 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.now)
     media_url = db.Column(db.String(512), nullable=True)
     media_type = db.Column(db.String(20), nullable=True)  # 'image', 'video', 'system', 'call'
+    # Метаданные файла media_url (голосовые), записываются при загрузке
+    media_original_name = db.Column(db.String(255), nullable=True)
+    media_mime_type = db.Column(db.String(120), nullable=True)
+    media_file_size = db.Column(db.Integer, nullable=True)
     message_type = db.Column(db.String(20), default='text', nullable=False)  # 'text', 'system', 'call'
     call_duration = db.Column(db.String(10), nullable=True)  # Для карточек звонков
-    thread_root_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    thread_root_id = db.Column(db.Integer, db.ForeignKey('message.id'), index=True, nullable=True)
     thread_type = db.Column(db.String(20), nullable=True)
+    # Денормализованная статистика треда на корневом сообщении
+    comment_count = db.Column(db.Integer, default=0, nullable=False)
+    last_comment_at = db.Column(db.DateTime, nullable=True)
+
+    # Индекс для keyset-пагинации истории: WHERE room_id = ? AND id < ? ORDER BY id
+    __table_args__ = (db.Index('ix_message_room_id_id', 'room_id', 'id'),)
 
     sender = db.relationship('User', foreign_keys=[sender_id])
     reactions = db.relationship('MessageReaction', backref='message', lazy='dynamic', cascade="all, delete-orphan")
     media_items = db.relationship('MessageMedia', backref='message', lazy='dynamic', cascade="all, delete-orphan")
+    poll = db.relationship('Poll', backref='message', uselist=False, cascade="all, delete-orphan")
+    reaction_counts = db.relationship('MessageReactionCount', lazy='dynamic', cascade="all, delete-orphan")
 
     def get_reactions_summary(self):
-        summary = {}
-        for reaction in self.reactions.all():
-            if reaction.emoji not in summary:
-                summary[reaction.emoji] = []
-            summary[reaction.emoji].append(reaction.user_id)
-        return summary
+        # Компактная сводка {emoji: count} из счетчиков, без списков пользователей
+        return {row.emoji: row.count for row in self.reaction_counts.order_by(MessageReactionCount.emoji) if row.count > 0}
 
     def to_dict(self):
+        # Одиночная сериализация идет через тот же пакетный путь, что и история
+        return serialize_messages([self])[0]
+
+    def _build_dict(self, sender, reactions, media_items, poll, my_reactions=None):
         result = {
-            'id': self.id, 
-            'room_id': self.room_id, 
+            'id': self.id,
+            'room_id': self.room_id,
             'sender_id': self.sender_id,
-            'sender_username': self.sender.username if self.sender else 'System',
+            'sender_username': sender.username if sender else 'System',
             'content': self.content or '',
             'timestamp': self.timestamp.isoformat(),
             'message_type': self.message_type,
-            'reactions': self.get_reactions_summary(),
-            'media_items': [item.to_dict() for item in self.media_items]
+            'reactions': reactions,
+            'media_items': [item.to_dict() for item in media_items]
         }
+        if my_reactions is not None:
+            result['my_reactions'] = my_reactions
         if self.media_url:
             result['media_url'] = self.media_url
             result['media_type'] = self.media_type
+            if self.media_original_name:
+                result['media_name'] = self.media_original_name
+            if self.media_file_size is not None:
+                result['media_size'] = self.media_file_size
+            if self.media_mime_type:
+                result['media_mime_type'] = self.media_mime_type
         if self.call_duration:
             result['call_duration'] = self.call_duration
         if self.thread_root_id:
@@ -247,36 +410,12 @@ class Message(db.Model):
         if self.thread_type:
             result['thread_type'] = self.thread_type
         # Встраиваем текущие результаты для опросов
-        if self.message_type == 'poll':
-            try:
-                payload = json.loads(self.content or '{}')
-                question = payload.get('question', '')
-                options = payload.get('options', [])
-                multiple_choice = bool(payload.get('multiple_choice'))
-                anonymous = bool(payload.get('anonymous'))
-                # Подсчет результатов
-                results = []
-                try:
-                    total_options = len(options)
-                    for idx in range(total_options):
-                        results.append(db.session.execute(db.select(db.func.count()).select_from(PollVote).where(PollVote.message_id == self.id, PollVote.option_index == idx)).scalar() or 0)
-                except Exception:
-                    results = [0 for _ in options]
-                result['poll'] = {
-                    'question': question,
-                    'options': options,
-                    'multiple_choice': multiple_choice,
-                    'anonymous': anonymous,
-                    'results': results
-                }
-            except Exception:
-                pass
+        if self.message_type == 'poll' and poll is not None:
+            result['poll'] = poll
         if not self.thread_root_id and self.message_type != 'poll_comment':
-            try:
-                count_stmt = db.select(db.func.count()).select_from(Message).where(Message.thread_root_id == self.id)
-                result['thread_comment_count'] = db.session.execute(count_stmt).scalar() or 0
-            except Exception:
-                result['thread_comment_count'] = 0
+            result['thread_comment_count'] = self.comment_count or 0
+            if self.last_comment_at:
+                result['thread_last_comment_at'] = self.last_comment_at.isoformat()
         return result
 
 class MessageReaction(db.Model):
@@ -284,6 +423,15 @@ class MessageReaction(db.Model):
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     emoji = db.Column(db.String(10), primary_key=True)
+    # Постраничный список поставивших конкретную реакцию
+    __table_args__ = (db.Index('ix_message_reaction_msg_emoji_user', 'message_id', 'emoji', 'user_id'),)
+
+# Счетчик реакций по (сообщение, эмодзи), обновляется вместе с message_reaction
+class MessageReactionCount(db.Model):
+    __tablename__ = 'message_reaction_count'
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    emoji = db.Column(db.String(10), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
 
 class MessageMedia(db.Model):
     __tablename__ = 'message_media'
@@ -291,43 +439,116 @@ class MessageMedia(db.Model):
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
     url = db.Column(db.String(512), nullable=False)
     type = db.Column(db.String(20), nullable=False)  # 'image', 'video' или 'file'
+    # Метаданные записываются при загрузке (старые строки — backfill_media_metadata.py)
+    original_name = db.Column(db.String(255), nullable=True)
+    mime_type = db.Column(db.String(120), nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    # Уменьшенные копии картинки; пока их нет, клиент берет url
+    thumbnail_url = db.Column(db.String(512), nullable=True)
+    preview_url = db.Column(db.String(512), nullable=True)
+    # Содержимое в хранилище по хешу; у вложений, загруженных раньше, пусто
+    digest = db.Column(db.String(64), db.ForeignKey('media_blob.digest'), index=True, nullable=True)
 
     def to_dict(self):
+        # Только поля строки: сериализация не обращается к файловой системе
         result = {'url': self.url, 'type': self.type}
-
-        try:
-            filename = os.path.basename(self.url or '')
-        except Exception:
-            filename = ''
-
-        if filename:
-            # Имя файла сохраняется в формате m{user}_{timestamp}_{original}
-            if filename.count('_') >= 2:
-                result['name'] = filename.split('_', 2)[-1]
-            else:
-                result['name'] = filename
-
-        media_path = (self.url or '').lstrip('/')
-        if media_path:
-            full_path = os.path.join(BASE_DIR, media_path)
-            try:
-                result['size'] = os.path.getsize(full_path)
-            except OSError:
-                pass
-
+        name = self.original_name or legacy_media_name(self.url)
+        if name:
+            result['name'] = name
+        if self.file_size is not None:
+            result['size'] = self.file_size
+        if self.mime_type:
+            result['mime_type'] = self.mime_type
+        if self.width and self.height:
+            result['width'] = self.width
+            result['height'] = self.height
+        if self.thumbnail_url:
+            result['thumbnail_url'] = self.thumbnail_url
+        if self.preview_url:
+            result['preview_url'] = self.preview_url
         return result
 
+# Файл в хранилище по содержимому; ref_count — число строк message_media, которые на него ссылаются
+class MediaBlob(db.Model):
+    __tablename__ = 'media_blob'
+    digest = db.Column(db.String(64), primary_key=True)  # sha256, hex
+    url = db.Column(db.String(512), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MediaUpload(db.Model):
+    """Незавершенная загрузка по частям; содержимое лежит в cas/tmp/<id>.part"""
+    __tablename__ = 'media_upload'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    mime_type = db.Column(db.String(120), nullable=True)
+    size = db.Column(db.Integer, nullable=False)  # заявленный размер
+    received = db.Column(db.Integer, default=0, nullable=False)  # подтвержденное смещение
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class BlockedUser(db.Model):
     __tablename__ = 'blocked_user'
     blocker_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     blocked_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
 
+# Каноническая пара собеседников личного чата: (меньший id, больший id) -> комната
+class DirectMessagePair(db.Model):
+    __tablename__ = 'dm_pair'
+    min_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    max_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), unique=True, nullable=False)
+
+    room = db.relationship('Room')
+
+# Последний снимок совместного документа комнаты
+class RoomDocument(db.Model):
+    __tablename__ = 'room_document'
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), primary_key=True)
+    content = db.Column(db.Text, default='', nullable=False)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Устаревшая таблица счетчиков: используется только для переноса в last_read_message_id
 class UnreadMessage(db.Model):
     __tablename__ = 'unread_message'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), primary_key=True)
     count = db.Column(db.Integer, default=0, nullable=False)
 
+# Опросы: определение и счетчики голосов по вариантам
+class Poll(db.Model):
+    __tablename__ = 'poll'
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    question = db.Column(db.Text, nullable=False)
+    multiple_choice = db.Column(db.Boolean, default=False, nullable=False)
+    anonymous = db.Column(db.Boolean, default=False, nullable=False)
+
+    options = db.relationship('PollOption', order_by='PollOption.position', cascade="all, delete-orphan")
+
+    def to_dict(self, options=None):
+        options = self.options if options is None else options
+        return {
+            'question': self.question,
+            'options': [option.text for option in options],
+            'multiple_choice': bool(self.multiple_choice),
+            'anonymous': bool(self.anonymous),
+            'results': [option.vote_count or 0 for option in options]
+        }
+
+class PollOption(db.Model):
+    __tablename__ = 'poll_option'
+    # Первичный ключ (message_id, position): все варианты опроса читаются одним проходом по индексу
+    message_id = db.Column(db.Integer, db.ForeignKey('poll.message_id'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    text = db.Column(db.String(100), nullable=False)
+    vote_count = db.Column(db.Integer, default=0, nullable=False)
+
 # Голоса для опросов
 class PollVote(db.Model):
     __tablename__ = 'poll_vote'
@@ -337,9 +558,1866 @@ class PollVote(db.Model):
     option_index = db.Column(db.Integer, nullable=False)
     __table_args__ = (db.UniqueConstraint('message_id', 'user_id', 'option_index', name='uq_poll_vote_msg_user_opt'),)
 
+# --- Непрочитанные сообщения ---
+UNREAD_COUNT_CAP = 100  # Клиент все равно показывает "99+"
+
+def count_unread(room_id, user_id, last_read_message_id):
+    """Число чужих сообщений после указателя прочтения, не больше UNREAD_COUNT_CAP.
+
+    Подзапрос с LIMIT ограничивает обход индекса (room_id, id), так что давно
+    не открытая комната стоит не дороже свежей.
+    """
+    capped = (db.select(Message.id)
+              .where(Message.room_id == room_id,
+                     Message.id > (last_read_message_id or 0),
+                     db.or_(Message.sender_id.is_(None), Message.sender_id != user_id))
+              .limit(UNREAD_COUNT_CAP)
+              .subquery())
+    return db.session.execute(db.select(db.func.count()).select_from(capped)).scalar() or 0
+
+def room_unread_counts(room_id, exclude_user_id=None):
+    """Счетчики непрочитанных для всех участников комнаты: {user_id: count}.
+
+    Один сгруппированный запрос: участники соединяются с сообщениями после своих
+    указателей прочтения. Сообщения берутся только из последних UNREAD_COUNT_CAP
+    комнаты, поэтому счетчик не превышает предел, а обход индекса ограничен.
+    Отправка сдвигает указатель отправителя (advance_sender_read_pointer), так что
+    после указателя своих сообщений нет и результат совпадает с count_unread.
+    """
+    window_floor = (db.select(Message.id)
+                    .where(Message.room_id == room_id)
+                    .order_by(Message.id.desc())
+                    .offset(UNREAD_COUNT_CAP - 1)
+                    .limit(1)
+                    .scalar_subquery())
+    query = (db.session.query(RoomParticipant.user_id, db.func.count(Message.id))
+             .outerjoin(Message, db.and_(
+                 Message.room_id == RoomParticipant.room_id,
+                 Message.id > db.func.coalesce(RoomParticipant.last_read_message_id, 0),
+                 Message.id >= db.func.coalesce(window_floor, 0),
+                 db.or_(Message.sender_id.is_(None), Message.sender_id != RoomParticipant.user_id)))
+             .filter(RoomParticipant.room_id == room_id))
+    if exclude_user_id is not None:
+        query = query.filter(RoomParticipant.user_id != exclude_user_id)
+    return dict(query.group_by(RoomParticipant.user_id).all())
+
+def advance_sender_read_pointer(message):
+    """Свое сообщение считается прочитанным; вызывается в транзакции отправки до commit"""
+    db.session.flush()
+    RoomParticipant.query.filter(
+        RoomParticipant.user_id == message.sender_id,
+        RoomParticipant.room_id == message.room_id,
+        db.or_(RoomParticipant.last_read_message_id.is_(None),
+               RoomParticipant.last_read_message_id < message.id)
+    ).update({RoomParticipant.last_read_message_id: message.id}, synchronize_session=False)
+
+def latest_message_id(room_id):
+    return db.session.execute(db.select(db.func.max(Message.id)).where(Message.room_id == room_id)).scalar()
+
+# --- Список комнат ---
+def build_room_list(user):
+    """Сводки всех комнат пользователя тем же форматом, что и Room.to_dict.
+
+    Три запроса на весь список: участия вместе с комнатами и счетчиками
+    непрочитанных, собеседники в ЛС и имена контактов. Каждая сводка
+    дополнительно содержит is_archived.
+    """
+    capped = (db.select(Message.id)
+              .where(Message.room_id == RoomParticipant.room_id,
+                     Message.id > db.func.coalesce(RoomParticipant.last_read_message_id, 0),
+                     db.or_(Message.sender_id.is_(None), Message.sender_id != user.id))
+              .limit(UNREAD_COUNT_CAP)
+              .correlate(RoomParticipant)
+              .subquery())
+    unread_subq = db.select(db.func.count()).select_from(capped).scalar_subquery()
+    rows = (db.session.query(Room, RoomParticipant.role, RoomParticipant.is_archived, unread_subq)
+            .join(RoomParticipant, RoomParticipant.room_id == Room.id)
+            .filter(RoomParticipant.user_id == user.id)
+            .order_by(Room.id)
+            .all())
+
+    dm_room_ids = [room.id for room, _, _, _ in rows if room.type == 'dm']
+    dm_peers = {}
+    for chunk in _chunked(dm_room_ids):
+        peer_rows = (db.session.query(RoomParticipant.room_id, User.id, User.username, User.avatar_url)
+                     .join(User, User.id == RoomParticipant.user_id)
+                     .filter(RoomParticipant.room_id.in_(chunk), RoomParticipant.user_id != user.id)
+                     .order_by(RoomParticipant.room_id, RoomParticipant.user_id)
+                     .all())
+        for room_id, peer_id, username, avatar_url in peer_rows:
+            dm_peers.setdefault(room_id, (peer_id, username, avatar_url))
+
+    custom_names = {}
+    peer_ids = list({peer[0] for peer in dm_peers.values()})
+    for chunk in _chunked(peer_ids):
+        for contact_id, custom_name in (db.session.query(Contact.contact_id, Contact.custom_name)
+                                        .filter(Contact.user_id == user.id, Contact.contact_id.in_(chunk))):
+            custom_names[contact_id] = custom_name
+
+    result = []
+    for room, role, is_archived, unread_count in rows:
+        display_name = room.name
+        avatar = room.avatar_url
+        dm_other_user_id = None
+        peer = dm_peers.get(room.id) if room.type == 'dm' else None
+        if peer:
+            dm_other_user_id, username, peer_avatar = peer
+            display_name = custom_names.get(dm_other_user_id) or f"@{username}"
+            if peer_avatar:
+                avatar = peer_avatar
+        result.append({
+            'id': room.id,
+            'name': display_name,
+            'type': room.type,
+            'role': role,
+            'avatar_url': avatar,
+            'dm_other_user_id': dm_other_user_id,
+            'unread_count': unread_count or 0,
+            'is_archived': bool(is_archived)
+        })
+    return result
+
+def split_room_list(user):
+    """Возвращает (активные, архивированные) сводки комнат"""
+    active_rooms, archived_rooms = [], []
+    for room_dict in build_room_list(user):
+        (archived_rooms if room_dict.pop('is_archived') else active_rooms).append(room_dict)
+    return active_rooms, archived_rooms
+
+# --- Полнотекстовые индексы (SQLite FTS5) ---
+_FTS_READY = {}
+
+def fts_table_ready(name):
+    """Есть ли в БД виртуальная таблица name; результат кэшируется на процесс"""
+    if name not in _FTS_READY:
+        _FTS_READY[name] = bool(db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': name}
+        ).first()) if db.engine.dialect.name == 'sqlite' else False
+    return _FTS_READY[name]
+
+def ensure_fts_table(name, ddl, fill_sql=None):
+    """Создает FTS-таблицу (и заполняет ее fill_sql), если ее еще нет"""
+    if db.engine.dialect.name != 'sqlite':
+        _FTS_READY[name] = False
+        return False
+    _FTS_READY.pop(name, None)
+    if fts_table_ready(name):
+        return True
+    try:
+        db.session.execute(text(ddl))
+        if fill_sql:
+            db.session.execute(text(fill_sql))
+        db.session.commit()
+        _FTS_READY[name] = True
+    except Exception as e:
+        db.session.rollback()
+        print(f"Полнотекстовый индекс {name} недоступен: {e}")
+        _FTS_READY[name] = False
+    return _FTS_READY[name]
+
+# --- Поиск пользователей ---
+USER_SEARCH_LIMIT = 10
+
+def user_search_ready():
+    """Есть ли индекс user_search (FTS5 с триграммным токенизатором)"""
+    return fts_table_ready('user_search')
+
+def ensure_user_search_index():
+    """Создает и заполняет user_search; без FTS5/trigram поиск остается на LIKE"""
+    return ensure_fts_table(
+        'user_search',
+        "CREATE VIRTUAL TABLE user_search USING fts5(username, tokenize='trigram')",
+        "INSERT INTO user_search (rowid, username) SELECT id, username FROM user"
+    )
+
+def index_username(user):
+    """Обновляет запись пользователя в user_search в текущей транзакции"""
+    if not user_search_ready():
+        return
+    db.session.flush()
+    db.session.execute(text("DELETE FROM user_search WHERE rowid = :id"), {'id': user.id})
+    db.session.execute(text("INSERT INTO user_search (rowid, username) VALUES (:id, :username)"),
+                       {'id': user.id, 'username': user.username})
+
+def search_users(query, exclude_user_id, limit=USER_SEARCH_LIMIT):
+    """Подтвержденные пользователи, чье имя содержит query (без учета регистра).
+
+    Сначала точное совпадение и префиксы (диапазон по индексу lower(username)),
+    затем остальные вхождения подстроки из user_search по релевантности.
+    """
+    lowered = query.lower()
+    lowered_username = db.func.lower(User.username)
+    base = User.query.filter(User.is_verified == True, User.id != exclude_user_id)
+    results = (base.filter(lowered_username >= lowered, lowered_username < lowered + '\uffff')
+               .order_by(db.func.length(User.username), User.username)
+               .limit(limit).all())
+    if len(results) >= limit:
+        return results
+
+    # Префиксы уже найдены все: их меньше limit
+    rest = base
+    if results:
+        rest = rest.filter(User.id.notin_([user.id for user in results]))
+    # Триграммам нужно не меньше трех символов, более короткие запросы идут через LIKE
+    if user_search_ready() and len(query) >= 3:
+        user_search = db.table('user_search', db.column('rowid'), db.column('rank'))
+        phrase = '"' + query.replace('"', '""') + '"'
+        rest = (rest.join(user_search, user_search.c.rowid == User.id)
+                .filter(text('user_search MATCH :phrase')).params(phrase=phrase)
+                .order_by(user_search.c.rank, db.func.length(User.username), User.username))
+    else:
+        rest = (rest.filter(User.username.contains(query, autoescape=True))
+                .order_by(db.func.length(User.username), User.username))
+    results.extend(rest.limit(limit - len(results)).all())
+    return results
+
+# --- Поиск по сообщениям ---
+MESSAGE_SEARCH_PAGE_SIZE = 20
+MESSAGE_SEARCH_MAX_PAGE_SIZE = 50
+MESSAGE_SEARCH_BACKFILL_CHUNK = 2000
+SEARCHABLE_MESSAGE_TYPES = ('text', 'comment', 'poll_comment')
+_SNIPPET_START, _SNIPPET_END = '\x02', '\x03'
+
+def message_search_ready():
+    return fts_table_ready('message_search')
+
+def ensure_message_search_index():
+    """Создает пустой message_search; старые сообщения добавляет backfill_message_search.py"""
+    return ensure_fts_table(
+        'message_search',
+        "CREATE VIRTUAL TABLE message_search USING fts5(content, tokenize='unicode61 remove_diacritics 2')"
+    )
+
+def _is_searchable(message):
+    return bool(message.content) and (message.message_type or 'text') in SEARCHABLE_MESSAGE_TYPES
+
+def index_messages(messages):
+    """Добавляет/обновляет сообщения в message_search в текущей транзакции"""
+    if not message_search_ready() or not messages:
+        return
+    db.session.flush()
+    unindex_messages([message.id for message in messages])
+    rows = [{'id': message.id, 'content': message.content} for message in messages if _is_searchable(message)]
+    if rows:
+        db.session.execute(text("INSERT INTO message_search (rowid, content) VALUES (:id, :content)"), rows)
+
+def unindex_messages(message_ids):
+    if not message_search_ready():
+        return
+    for chunk in _chunked(list(message_ids)):
+        db.session.execute(text("DELETE FROM message_search WHERE rowid IN :ids")
+                           .bindparams(db.bindparam('ids', expanding=True)), {'ids': chunk})
+
+def unindex_room_messages(room_id):
+    if message_search_ready():
+        db.session.execute(text("DELETE FROM message_search WHERE rowid IN (SELECT id FROM message WHERE room_id = :room_id)"),
+                           {'room_id': room_id})
+
+def build_match_query(raw_query):
+    """Превращает ввод пользователя в запрос FTS5: все слова обязательны, последнее — как префикс"""
+    words = [word for word in raw_query.split() if word.strip('"')]
+    if not words:
+        return None
+    terms = ['"' + word.replace('"', '""') + '"' for word in words[:10]]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def _render_snippet(raw_snippet):
+    # Экранируем текст сообщения и только потом превращаем маркеры FTS в <mark>
+    escaped = html.escape(raw_snippet or '')
+    return escaped.replace(_SNIPPET_START, '<mark>').replace(_SNIPPET_END, '</mark>')
+
+def search_messages(user_id, match_query, room_id=None, before_id=None, limit=MESSAGE_SEARCH_PAGE_SIZE):
+    """Страница совпадений (от новых к старым) в комнатах, где состоит пользователь.
+
+    Возвращает (results, has_more); results содержит готовый HTML-сниппет.
+    """
+    scope = "m.room_id = :room_id" if room_id is not None else \
+        "m.room_id IN (SELECT room_id FROM room_participant WHERE user_id = :user_id)"
+    # Как и в chat_history: личный чат с заблокированным собеседником не показывается
+    scope += (" AND m.room_id NOT IN (SELECT d.room_id FROM dm_pair d JOIN blocked_user b "
+              "ON b.blocker_id = :user_id AND b.blocked_id = CASE WHEN d.min_user_id = :user_id "
+              "THEN d.max_user_id ELSE d.min_user_id END "
+              "WHERE d.min_user_id = :user_id OR d.max_user_id = :user_id)")
+    sql = (
+        "SELECT m.id, m.room_id, m.sender_id, u.username, m.timestamp, m.thread_root_id, "
+        "snippet(message_search, 0, :mark_start, :mark_end, '…', 12) "
+        "FROM message_search JOIN message m ON m.id = message_search.rowid "
+        "LEFT JOIN user u ON u.id = m.sender_id "
+        f"WHERE message_search MATCH :match AND {scope} "
+        + ("AND message_search.rowid < :before_id " if before_id else "")
+        + "ORDER BY message_search.rowid DESC LIMIT :limit"
+    )
+    rows = db.session.execute(text(sql), {
+        'match': match_query, 'user_id': user_id, 'room_id': room_id, 'before_id': before_id,
+        'limit': limit + 1, 'mark_start': _SNIPPET_START, 'mark_end': _SNIPPET_END
+    }).fetchall()
+    has_more = len(rows) > limit
+    results = []
+    for message_id, msg_room_id, sender_id, username, timestamp, thread_root_id, raw_snippet in rows[:limit]:
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        results.append({
+            'message_id': message_id,
+            'room_id': msg_room_id,
+            'sender_id': sender_id,
+            'sender_username': username,
+            'timestamp': timestamp.isoformat() if timestamp else None,
+            'thread_root_id': thread_root_id,
+            'snippet': _render_snippet(raw_snippet)
+        })
+    return results, has_more
+
+def backfill_message_search(chunk_size=MESSAGE_SEARCH_BACKFILL_CHUNK, pause=0.05, start_id=0, progress=None):
+    """Индексирует существующие сообщения порциями по id.
+
+    Каждая порция — отдельная короткая транзакция (DELETE + INSERT ... SELECT по диапазону id),
+    между порциями запись отпускается на pause секунд. Возвращает последний обработанный id,
+    с которого можно продолжить через start_id.
+    """
+    if not ensure_message_search_index():
+        return start_id
+    last_id = start_id
+    type_params = {f't{i}': message_type for i, message_type in enumerate(SEARCHABLE_MESSAGE_TYPES)}
+    type_list = ', '.join(f':{name}' for name in type_params)
+    while True:
+        upper_id = db.session.execute(text(
+            "SELECT MAX(id) FROM (SELECT id FROM message WHERE id > :last_id ORDER BY id LIMIT :chunk)"
+        ), {'last_id': last_id, 'chunk': chunk_size}).scalar()
+        if upper_id is None:
+            break
+        params = {'last_id': last_id, 'upper_id': upper_id, **type_params}
+        db.session.execute(text("DELETE FROM message_search WHERE rowid > :last_id AND rowid <= :upper_id"), params)
+        db.session.execute(text(
+            "INSERT INTO message_search (rowid, content) SELECT id, content FROM message "
+            "WHERE id > :last_id AND id <= :upper_id AND content IS NOT NULL AND content != '' "
+            f"AND COALESCE(message_type, 'text') IN ({type_list})"
+        ), params)
+        db.session.commit()
+        last_id = upper_id
+        if progress:
+            progress(last_id)
+        if pause:
+            time.sleep(pause)
+    return last_id
+
+# --- Счетчики реакций ---
+REACTORS_PAGE_SIZE = 50
+
+def bump_reaction_count(message_id, emoji, delta):
+    """Изменяет счетчик (message_id, emoji) на delta в текущей транзакции"""
+    updated = MessageReactionCount.query.filter_by(message_id=message_id, emoji=emoji).update(
+        {MessageReactionCount.count: MessageReactionCount.count + delta}, synchronize_session=False)
+    if not updated and delta > 0:
+        db.session.add(MessageReactionCount(message_id=message_id, emoji=emoji, count=delta))
+    elif delta < 0:
+        MessageReactionCount.query.filter(
+            MessageReactionCount.message_id == message_id,
+            MessageReactionCount.emoji == emoji,
+            MessageReactionCount.count <= 0
+        ).delete(synchronize_session=False)
+
+# --- Статистика тредов ---
+def refresh_thread_stats(root_ids):
+    """Пересчитывает comment_count/last_comment_at корневых сообщений в текущей транзакции.
+
+    Используется при удалении комментариев; при добавлении счетчик просто увеличивается.
+    """
+    root_ids = [root_id for root_id in set(root_ids) if root_id]
+    if not root_ids:
+        return
+    db.session.flush()
+    comments = db.aliased(Message)
+    count_subq = (db.select(db.func.count()).select_from(comments)
+                  .where(comments.thread_root_id == Message.id).scalar_subquery())
+    last_subq = (db.select(db.func.max(comments.timestamp))
+                 .where(comments.thread_root_id == Message.id).scalar_subquery())
+    for chunk in _chunked(root_ids):
+        db.session.execute(
+            db.update(Message)
+            .where(Message.id.in_(chunk))
+            .values(comment_count=count_subq, last_comment_at=last_subq)
+            .execution_options(synchronize_session=False)
+        )
+
+def thread_stats_payload(root_ids):
+    roots = Message.query.filter(Message.id.in_(list(root_ids))).all() if root_ids else []
+    return [{
+        'root_id': root.id,
+        'room_id': root.room_id,
+        'thread_comment_count': root.comment_count or 0,
+        'thread_last_comment_at': root.last_comment_at.isoformat() if root.last_comment_at else None
+    } for root in roots]
+
+# --- Пакетная сериализация сообщений ---
+SERIALIZE_CHUNK_SIZE = 500  # Ограничение на размер IN (...) для SQLite
+
+def _chunked(items, size=SERIALIZE_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def load_reaction_summaries(message_ids):
+    """{message_id: {emoji: count}} по счетчикам реакций"""
+    reactions = {}
+    for chunk in _chunked(list(message_ids)):
+        rows = (db.session.query(MessageReactionCount.message_id, MessageReactionCount.emoji, MessageReactionCount.count)
+                .filter(MessageReactionCount.message_id.in_(chunk), MessageReactionCount.count > 0)
+                .order_by(MessageReactionCount.message_id, MessageReactionCount.emoji)
+                .all())
+        for message_id, emoji, count in rows:
+            reactions.setdefault(message_id, {})[emoji] = count
+    return reactions
+
+def load_poll_dicts(message_ids):
+    """{message_id: Poll.to_dict()} двумя запросами на порцию"""
+    polls = {}
+    for chunk in _chunked(list(message_ids)):
+        definitions = Poll.query.filter(Poll.message_id.in_(chunk)).all()
+        options = {}
+        for option in (PollOption.query.filter(PollOption.message_id.in_(chunk))
+                       .order_by(PollOption.message_id, PollOption.position).all()):
+            options.setdefault(option.message_id, []).append(option)
+        for definition in definitions:
+            polls[definition.message_id] = definition.to_dict(options.get(definition.message_id, []))
+    return polls
+
+def serialize_messages(messages, viewer_id=None):
+    """Сериализует страницу сообщений фиксированным числом сгруппированных запросов.
+
+    Вместо отдельных запросов на отправителя, реакции, медиа и опрос для каждого
+    сообщения, все данные подгружаются пачками по списку id. Счетчик комментариев
+    хранится на самом корневом сообщении, счетчики голосов — в poll_option,
+    счетчики реакций — в message_reaction_count. Если передан viewer_id, к каждому
+    сообщению добавляется my_reactions — эмодзи, поставленные этим пользователем.
+    """
+    messages = [m for m in messages if m is not None]
+    if not messages:
+        return []
+
+    message_ids = [m.id for m in messages]
+    sender_ids = list({m.sender_id for m in messages if m.sender_id})
+    poll_ids = [m.id for m in messages if m.message_type == 'poll']
+
+    senders = {}
+    for chunk in _chunked(sender_ids):
+        for user in User.query.filter(User.id.in_(chunk)).all():
+            senders[user.id] = user
+
+    reactions = load_reaction_summaries(message_ids)
+    my_reactions = {}
+    for chunk in _chunked(message_ids if viewer_id is not None else []):
+        rows = (db.session.query(MessageReaction.message_id, MessageReaction.emoji)
+                .filter(MessageReaction.message_id.in_(chunk), MessageReaction.user_id == viewer_id)
+                .order_by(MessageReaction.message_id, MessageReaction.emoji)
+                .all())
+        for message_id, emoji in rows:
+            my_reactions.setdefault(message_id, []).append(emoji)
+
+    media = {}
+    for chunk in _chunked(message_ids):
+        items = MessageMedia.query.filter(MessageMedia.message_id.in_(chunk)).order_by(MessageMedia.id).all()
+        for item in items:
+            media.setdefault(item.message_id, []).append(item)
+
+    polls = load_poll_dicts(poll_ids)
+
+    return [
+        m._build_dict(
+            senders.get(m.sender_id),
+            reactions.get(m.id, {}),
+            media.get(m.id, []),
+            polls.get(m.id),
+            my_reactions.get(m.id, []) if viewer_id is not None else None
+        )
+        for m in messages
+    ]
+
+# --- Метаданные медиа ---
+MEDIA_METADATA_BACKFILL_CHUNK = 500
+
+def legacy_media_name(url):
+    """Исходное имя из имени файла m{user}_{timestamp}_{original}"""
+    filename = os.path.basename(url or '')
+    if filename.count('_') >= 2:
+        return filename.split('_', 2)[-1]
+    return filename
+
+def media_file_path(url):
+    return os.path.join(BASE_DIR, (url or '').lstrip('/'))
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def read_image_size(path):
+    """(ширина, высота) по заголовку PNG, GIF, JPEG или WebP; None, если формат не распознан"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(32)
+            if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                chunk = head[12:16]
+                if chunk == b'VP8 ':
+                    width, height = struct.unpack('<HH', head[26:30])
+                    return width & 0x3FFF, height & 0x3FFF
+                if chunk == b'VP8L':
+                    b = head[21:25]
+                    return (1 + (((b[1] & 0x3F) << 8) | b[0]),
+                            1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6)))
+                if chunk == b'VP8X':
+                    return (1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little'))
+                return None
+            if head[:2] == b'\xff\xd8':
+                # Идем по сегментам до заголовка кадра (SOFn)
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None
+                    code = marker[1]
+                    while code == 0xFF:
+                        code = f.read(1)[0]
+                    if code == 0x01 or 0xD0 <= code <= 0xD8:
+                        continue
+                    length = struct.unpack('>H', f.read(2))[0]
+                    if code in _JPEG_SOF_MARKERS:
+                        height, width = struct.unpack('>xHH', f.read(5))
+                        return width, height
+                    f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
+
+def describe_media_file(path, original_name=None, declared_mime=None, media_type=None):
+    """Поля MessageMedia для только что записанного файла: размер, имя, MIME, размеры картинки"""
+    original_name = os.path.basename((original_name or '').replace('\\', '/'))[:255] or None
+    mime_type = declared_mime if declared_mime and declared_mime != 'application/octet-stream' else None
+    if not mime_type:
+        mime_type = mimetypes.guess_type(original_name or path)[0]
+    meta = {'original_name': original_name, 'mime_type': (mime_type or '')[:120] or None}
+    try:
+        meta['file_size'] = os.path.getsize(path)
+    except OSError:
+        meta['file_size'] = None
+    size = read_image_size(path) if media_type in (None, 'image') else None
+    meta['width'], meta['height'] = size if size else (None, None)
+    return meta
+
+# --- Хранилище вложений по содержимому ---
+class MediaTooLargeError(Exception):
+    pass
+
+def media_store_url(digest, ext):
+    return f"/static/uploads/media/cas/{digest[:2]}/{digest}{ext}"
+
+def upload_extension(filename):
+    """Расширение исходного имени ('' для имен без него или с экзотическими символами)"""
+    ext = os.path.splitext(filename or '')[1].lstrip('.').lower()
+    return ext if ext.isalnum() and len(ext) <= 10 else ''
+
+def media_tmp_path(name):
+    tmp_dir = os.path.join(MEDIA_STORE_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    return os.path.join(tmp_dir, name + '.part')
+
+def media_kind(ext):
+    if ext in ALLOWED_IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in ALLOWED_VIDEO_EXTENSIONS:
+        return 'video'
+    return 'file'
+
+def store_media_upload(stream, ext):
+    """Пишет поток во временный файл, считая sha256 по ходу записи.
+
+    Возвращает (MediaBlob, reused): при совпадении содержимого временный файл
+    удаляется, а существующий blob получает еще одну ссылку. Изменения счетчиков
+    фиксирует вызывающий вместе со строками message_media.
+    """
+    tmp_path = media_tmp_path(uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(MEDIA_STORE_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise MediaTooLargeError()
+                digest.update(chunk)
+                out.write(chunk)
+        return commit_media_blob(tmp_path, digest.hexdigest(), size, f".{ext}" if ext else '')
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def commit_media_blob(tmp_path, digest, size, ext, keep_source=False):
+    """Регистрирует ссылку на содержимое, уже записанное в tmp_path; возвращает (MediaBlob, reused).
+
+    Файл кладется в хранилище только после UPDATE/INSERT строки media_blob, то есть
+    под ее блокировкой: remove_media_blob_files удаляет файл под той же блокировкой,
+    поэтому параллельное удаление не унесет только что положенный файл. С keep_source
+    файл попадает в хранилище жесткой ссылкой (или копией), а tmp_path остается на
+    месте, пока вызывающий не зафиксирует транзакцию.
+    """
+    reused = bool(db.session.execute(
+        db.update(MediaBlob).where(MediaBlob.digest == digest).values(ref_count=MediaBlob.ref_count + 1)
+    ).rowcount)
+    if not reused:
+        # Параллельная загрузка того же содержимого могла успеть вставить строку — тогда это еще одна ссылка
+        db.session.execute(text(
+            "INSERT INTO media_blob (digest, url, size, ref_count, created_at) VALUES (:digest, :url, :size, 1, :now) "
+            "ON CONFLICT (digest) DO UPDATE SET ref_count = media_blob.ref_count + 1"
+        ), {'digest': digest, 'url': media_store_url(digest, ext), 'size': size, 'now': datetime.utcnow()})
+    blob = db.session.get(MediaBlob, digest)
+    final_path = media_file_path(blob.url)
+    if not os.path.exists(final_path):
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        if keep_source:
+            staged_path = media_tmp_path(uuid.uuid4().hex)
+            try:
+                os.link(tmp_path, staged_path)
+            except OSError:
+                shutil.copyfile(tmp_path, staged_path)
+            tmp_path = staged_path
+        os.replace(tmp_path, final_path)
+    return blob, reused
+
+def copy_media_variants(media_item):
+    """Копии картинки с тем же содержимым уже могли быть посчитаны для другого вложения"""
+    sibling = (MessageMedia.query
+               .filter(MessageMedia.digest == media_item.digest,
+                       db.or_(MessageMedia.thumbnail_url.isnot(None), MessageMedia.preview_url.isnot(None)))
+               .first())
+    if sibling:
+        media_item.thumbnail_url = sibling.thumbnail_url
+        media_item.preview_url = sibling.preview_url
+    return sibling is not None
+
+def media_send_denied(sender_id, room_id):
+    """Текст отказа, если пользователь не может отправлять вложения в комнату, иначе None"""
+    role = get_member_role(sender_id, room_id)
+    room_info = get_room_info(room_id)
+    if role is None or not room_info:
+        return 'Нет доступа к комнате.'
+    if room_info['type'] == 'channel' and role != 'admin':
+        return 'Нет прав для отправки в канал.'
+    if room_info['type'] == 'dm':
+        other_id = dm_peer_id(room_info, sender_id)
+        if other_id and is_blocked(sender_id, other_id):
+            return 'Пользователь заблокирован.'
+    return None
+
+def attach_media_item(message, blob, reused, filename, mimetype):
+    """Строка message_media для сохраненного содержимого"""
+    media_type = media_kind(upload_extension(filename))
+    media_item = MessageMedia(
+        message=message,
+        url=blob.url,
+        type=media_type,
+        digest=blob.digest,
+        **describe_media_file(media_file_path(blob.url), filename, mimetype, media_type)
+    )
+    db.session.add(media_item)
+    if reused:
+        copy_media_variants(media_item)
+    return media_item
+
+def publish_media_message(message, media_items):
+    """Фиксирует сообщение с вложениями, рассылает его и ставит в очередь уменьшенные копии"""
+    index_messages([message])
+    advance_sender_read_pointer(message)
+    db.session.commit()
+
+    message_dict = message.to_dict()
+
+    # Отправляем сообщение и обновленный счетчик непрочитанных (через socketio.emit из HTTP контекста)
+    fan_out_message(message.room_id, message_dict, message.sender_id)
+    schedule_media_variants(message.id, message.room_id,
+                            [item for item in media_items if not item.thumbnail_url and not item.preview_url])
+    return message_dict
+
+def release_media_blobs(message_ids):
+    """Снимает ссылки вложений удаляемых сообщений; возвращает url файлов, на которые ссылок не осталось.
+
+    message_ids — список id или подзапрос. Строки с нулевым счетчиком остаются до
+    remove_media_blob_files, которая после commit удаляет их вместе с файлами.
+    """
+    counts = (db.session.query(MessageMedia.digest, db.func.count())
+              .filter(MessageMedia.message_id.in_(message_ids), MessageMedia.digest.isnot(None))
+              .group_by(MessageMedia.digest).all())
+    orphaned = []
+    for digest, count in counts:
+        db.session.execute(db.update(MediaBlob).where(MediaBlob.digest == digest)
+                           .values(ref_count=MediaBlob.ref_count - count))
+        blob = db.session.get(MediaBlob, digest)
+        if blob is not None:
+            db.session.refresh(blob)
+            if blob.ref_count <= 0:
+                orphaned.append(blob.url)
+    return orphaned
+
+def remove_media_blob_files(urls):
+    """Удаляет файлы содержимого, на которое не осталось ссылок.
+
+    Файл удаляется в одной транзакции с удалением строки media_blob при нулевом
+    счетчике: загрузка того же содержимого ждет эту блокировку в commit_media_blob,
+    а если успела первой, строка уже с ненулевым счетчиком и файл остается. Для
+    файлов, чья строка откатилась, временно вставляется такая же строка-метка.
+    """
+    for url in urls:
+        digest = os.path.splitext(os.path.basename(url))[0]
+        db.session.execute(text(
+            "INSERT INTO media_blob (digest, url, size, ref_count, created_at) VALUES (:digest, :url, 0, 0, :now) "
+            "ON CONFLICT (digest) DO NOTHING"
+        ), {'digest': digest, 'url': url, 'now': datetime.utcnow()})
+        if db.session.execute(
+            db.delete(MediaBlob).where(MediaBlob.digest == digest, MediaBlob.ref_count <= 0)
+        ).rowcount:
+            path = media_file_path(url)
+            for target in [path] + glob.glob(glob.escape(os.path.splitext(path)[0]) + '_*.webp'):
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+        db.session.commit()
+
+# --- Загрузка по частям ---
+# sha256 считается по ходу дописывания; состояние живет в памяти процесса. Если часть
+# пришла в другой процесс или после перезапуска, хэш пересчитывается по файлу при завершении
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+def parse_content_range(header):
+    """'bytes <start>-<end>/<total>' -> (start, end, total) или None"""
+    match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', (header or '').strip())
+    if not match:
+        return None
+    start, end, total = (int(value) for value in match.groups())
+    return (start, end, total) if start <= end < total else None
+
+def append_upload_chunk(upload, start, length, stream):
+    """Дописывает length байт из stream с позиции start; возвращает новое смещение.
+
+    Хвост, оставшийся от оборванной части, отбрасывается: подтверждено только upload.received.
+    """
+    path = media_tmp_path(upload.id)
+    with _upload_hashers_lock:
+        offset, hasher = _upload_hashers.pop(upload.id, (0, hashlib.sha256()))
+    if offset != start:
+        hasher = None
+    remaining = length
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as out:
+        out.seek(start)
+        out.truncate()
+        while remaining:
+            chunk = stream.read(min(MEDIA_STORE_CHUNK, remaining))
+            if not chunk:
+                raise ClientDisconnected()
+            out.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            remaining -= len(chunk)
+    if hasher is not None:
+        with _upload_hashers_lock:
+            _upload_hashers[upload.id] = (start + length, hasher)
+    return start + length
+
+def upload_digest(upload):
+    with _upload_hashers_lock:
+        offset, hasher = _upload_hashers.pop(upload.id, (None, None))
+    if offset == upload.size:
+        return hasher.hexdigest()
+    hasher = hashlib.sha256()
+    with open(media_tmp_path(upload.id), 'rb') as source:
+        for chunk in iter(lambda: source.read(MEDIA_STORE_CHUNK), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def discard_media_upload(upload):
+    with _upload_hashers_lock:
+        _upload_hashers.pop(upload.id, None)
+    try:
+        os.remove(media_tmp_path(upload.id))
+    except OSError:
+        pass
+    db.session.delete(upload)
+
+def expire_media_uploads():
+    cutoff = datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_TTL)
+    stale = MediaUpload.query.filter(MediaUpload.updated_at < cutoff).limit(100).all()
+    for upload in stale:
+        discard_media_upload(upload)
+    if stale:
+        db.session.commit()
+
+def backfill_media_metadata(chunk_size=MEDIA_METADATA_BACKFILL_CHUNK, start_id=0, progress=None):
+    """Заполняет метаданные строк message_media, загруженных до их появления.
+
+    Идет порциями по id, каждая порция — отдельная транзакция. Файлы, которых нет
+    на диске, остаются без размера. Возвращает последний обработанный id.
+    Файлы media_url у сообщений (голосовые) заполняет backfill_message_file_metadata.
+    """
+    last_id = start_id
+    while True:
+        items = (MessageMedia.query.filter(MessageMedia.id > last_id)
+                 .order_by(MessageMedia.id).limit(chunk_size).all())
+        if not items:
+            break
+        for item in items:
+            if item.file_size is not None and item.original_name and item.mime_type:
+                continue
+            meta = describe_media_file(media_file_path(item.url), legacy_media_name(item.url), None, item.type)
+            for field, value in meta.items():
+                if getattr(item, field) is None:
+                    setattr(item, field, value)
+        db.session.commit()
+        last_id = items[-1].id
+        if progress:
+            progress(last_id)
+    return last_id
+
+def backfill_message_file_metadata(chunk_size=MEDIA_METADATA_BACKFILL_CHUNK, start_id=0, progress=None):
+    """То же для файлов media_url у сообщений (голосовые и старые вложения); возвращает последний id"""
+    last_id = start_id
+    while True:
+        messages = (Message.query.filter(Message.id > last_id, Message.media_url.isnot(None),
+                                         Message.media_file_size.is_(None))
+                    .order_by(Message.id).limit(chunk_size).all())
+        if not messages:
+            break
+        for message in messages:
+            meta = describe_media_file(media_file_path(message.media_url), legacy_media_name(message.media_url),
+                                       None, message.media_type)
+            message.media_original_name = message.media_original_name or meta['original_name']
+            message.media_mime_type = message.media_mime_type or meta['mime_type']
+            message.media_file_size = meta['file_size']
+        db.session.commit()
+        last_id = messages[-1].id
+        if progress:
+            progress(last_id)
+    return last_id
+
+# --- Уменьшенные копии изображений ---
+try:
+    import media_worker
+except ImportError:  # Pillow не установлен: клиенты получают оригиналы
+    media_worker = None
+
+_MEDIA_POOL = None
+_MEDIA_POOL_LOCK = threading.Lock()
+
+def media_pool():
+    """Пул процессов для перекодирования; создается при первой загрузке картинки"""
+    global _MEDIA_POOL
+    with _MEDIA_POOL_LOCK:
+        if _MEDIA_POOL is None:
+            # spawn: рабочие процессы не наследуют monkey-patching gevent/eventlet и открытые соединения
+            _MEDIA_POOL = ProcessPoolExecutor(max_workers=MEDIA_PIPELINE_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return _MEDIA_POOL
+
+def media_pipeline_enabled():
+    return media_worker is not None and MEDIA_PIPELINE_WORKERS > 0
+
+def media_url_for_path(path):
+    return '/' + os.path.relpath(path, BASE_DIR).replace(os.sep, '/')
+
+def variant_base(url):
+    return os.path.splitext(media_file_path(url))[0]
+
+def schedule_media_variants(message_id, room_id, media_items):
+    """Ставит в очередь копии для картинок сообщения; готовые рассылаются событием media_variants_ready"""
+    if not media_pipeline_enabled():
+        return
+    jobs = [(item.id, media_pool().submit(media_worker.render_variants, media_file_path(item.url),
+                                          variant_base(item.url), MEDIA_VARIANT_SIZES))
+            for item in media_items if item.type == 'image']
+    if jobs:
+        socketio.start_background_task(_finish_media_variants, message_id, room_id, jobs)
+
+def _finish_media_variants(message_id, room_id, jobs):
+    results = {}
+    for media_id, future in jobs:
+        try:
+            results[media_id] = future.result()
+        except Exception as e:
+            app.logger.error(f"media variants failed for media {media_id}: {e}")
+    results = {media_id: variants for media_id, variants in results.items() if variants}
+    if not results:
+        return
+    with app.app_context():
+        for item in MessageMedia.query.filter(MessageMedia.id.in_(list(results))).all():
+            variants = results[item.id]
+            if 'thumb' in variants:
+                item.thumbnail_url = media_url_for_path(variants['thumb'][0])
+            if 'preview' in variants:
+                item.preview_url = media_url_for_path(variants['preview'][0])
+        db.session.commit()
+        media_items = [item.to_dict() for item in
+                       MessageMedia.query.filter_by(message_id=message_id).order_by(MessageMedia.id)]
+        db.session.remove()
+    socketio.emit('media_variants_ready', {'message_id': message_id, 'room_id': room_id,
+                                           'media_items': media_items}, room=str(room_id))
+
+def avatar_upload_stem(url):
+    """Общее начало имен оригинала и копий аватара: u{id}_{время} или room{id}_{время}"""
+    name = os.path.splitext(os.path.basename(url or ''))[0]
+    return '_'.join(name.split('_')[:2])
+
+def remove_avatar_files(url):
+    """Удаляет загруженный через API аватар вместе с его копиями"""
+    if not url or not url.startswith('/static/uploads/avatars/'):
+        return
+    stem = avatar_upload_stem(url)
+    directory = os.path.dirname(media_file_path(url))
+    for path in glob.glob(os.path.join(directory, glob.escape(stem) + '.*')) + \
+            glob.glob(os.path.join(directory, glob.escape(stem) + '_*')) + \
+            glob.glob(os.path.join(directory, glob.escape(stem))):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def schedule_avatar_variant(owner, owner_id, url):
+    """Квадратная копия аватара; owner — 'user' или 'room'. Поле avatar_url меняется, когда копия готова"""
+    if not media_pipeline_enabled():
+        return
+    future = media_pool().submit(media_worker.render_avatar, media_file_path(url), variant_base(url), AVATAR_VARIANT_SIDE)
+    socketio.start_background_task(_finish_avatar_variant, owner, owner_id, url, future)
+
+def _finish_avatar_variant(owner, owner_id, url, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        app.logger.error(f"avatar variant failed for {owner} {owner_id}: {e}")
+        return
+    if not result:
+        return
+    with app.app_context():
+        target = db.session.get(User if owner == 'user' else Room, owner_id)
+        # Пока считалась копия, аватар могли заменить или удалить
+        if not target or target.avatar_url != url:
+            try:
+                os.remove(result[0])
+            except OSError:
+                pass
+            db.session.remove()
+            return
+        target.avatar_url = media_url_for_path(result[0])
+        db.session.commit()
+        if owner == 'user':
+            for entry in target.rooms.options(db.joinedload(RoomParticipant.room)).all():
+                if entry.room.type == 'dm':
+                    notify_room_update(entry.room)
+            socketio.emit('avatar_updated', {'avatar_url': target.avatar_url}, room=f"user_{owner_id}")
+        else:
+            notify_room_update(target)
+        db.session.remove()
+
+# --- Общее состояние процессов ---
+class InMemoryStateBackend:
+    """Состояние одного процесса: соединения пользователей и опубликованный онлайн.
+
+    Тот же интерфейс реализует RedisStateBackend; broadcast() здесь ничего не
+    делает, потому что других процессов нет.
+    """
+
+    host_id = 'local'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_sids = {}
+        self._published = set()
+
+    def add_connection(self, user_id, sid):
+        with self._lock:
+            self._user_sids.setdefault(user_id, set()).add(sid)
+
+    def remove_connection(self, user_id, sid):
+        with self._lock:
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._user_sids[user_id]
+
+    def user_sids(self, user_id):
+        with self._lock:
+            return list(self._user_sids.get(user_id, ()))
+
+    def connected_users(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if user_id in self._user_sids}
+
+    def set_published(self, user_id, online):
+        """Меняет опубликованный статус; True, если он действительно изменился"""
+        with self._lock:
+            if online == (user_id in self._published):
+                return False
+            if online:
+                self._published.add(user_id)
+            else:
+                self._published.discard(user_id)
+            return True
+
+    def is_published(self, user_id):
+        with self._lock:
+            return user_id in self._published
+
+    def published_users(self):
+        with self._lock:
+            return set(self._published)
+
+    def heartbeat(self):
+        pass
+
+    def broadcast(self, channel, message):
+        pass
+
+    def subscribe(self, channel, handler):
+        pass
+
+class RedisStateBackend:
+    """Состояние, общее для нескольких процессов, в Redis (или совместимом брокере).
+
+    Соединения хранятся как "host_id:sid" в множестве пользователя; каждый процесс
+    продлевает ключ host:<host_id>, и соединения процессов, переставших его
+    продлевать (упали), не учитываются и вычищаются при чтении. broadcast()
+    рассылает сообщение остальным процессам; свои сообщения процесс пропускает —
+    вызывающий код применяет их у себя сам.
+
+    client — redis.Redis(decode_responses=True) или state_testing.LocalBroker для проверок.
+    """
+
+    HOST_TTL = 30  # секунды
+    HEARTBEAT_INTERVAL = 10  # секунды
+
+    def __init__(self, client, prefix='glasschat'):
+        self.client = client
+        self.prefix = prefix
+        self.host_id = uuid.uuid4().hex
+        self._handlers = {}
+        self._listener = None
+        self._pubsub = None
+        self._last_heartbeat = 0
+        self.heartbeat()
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    def _live_members(self, user_id, members):
+        hosts = {member.split(':', 1)[0] for member in members}
+        alive = {host for host in hosts if host == self.host_id or self.client.exists(self._key('host', host))}
+        dead = [member for member in members if member.split(':', 1)[0] not in alive]
+        if dead:
+            self.client.srem(self._key('sids', user_id), *dead)
+        return [member for member in members if member.split(':', 1)[0] in alive]
+
+    def add_connection(self, user_id, sid):
+        self.client.sadd(self._key('sids', user_id), f"{self.host_id}:{sid}")
+
+    def remove_connection(self, user_id, sid):
+        self.client.srem(self._key('sids', user_id), f"{self.host_id}:{sid}")
+
+    def user_sids(self, user_id):
+        members = self.client.smembers(self._key('sids', user_id))
+        return [member.split(':', 1)[1] for member in self._live_members(user_id, members)]
+
+    def connected_users(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline()
+        for user_id in user_ids:
+            pipe.smembers(self._key('sids', user_id))
+        return {user_id for user_id, members in zip(user_ids, pipe.execute())
+                if members and self._live_members(user_id, members)}
+
+    def set_published(self, user_id, online):
+        key = self._key('published')
+        # SADD/SREM атомарны: переход публикует ровно один процесс
+        changed = self.client.sadd(key, user_id) if online else self.client.srem(key, user_id)
+        return bool(changed)
+
+    def is_published(self, user_id):
+        return bool(self.client.sismember(self._key('published'), user_id))
+
+    def published_users(self):
+        return {int(user_id) for user_id in self.client.smembers(self._key('published'))}
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if now - self._last_heartbeat >= self.HEARTBEAT_INTERVAL:
+            self.client.set(self._key('host', self.host_id), '1', ex=self.HOST_TTL)
+            self._last_heartbeat = now
+
+    def broadcast(self, channel, message):
+        self.client.publish(self._key('channel', channel), json.dumps({'host_id': self.host_id, 'data': message}))
+
+    def subscribe(self, channel, handler):
+        """Регистрирует обработчик; сообщения, пришедшие до подписки, не доставляются"""
+        key = self._key('channel', channel)
+        self._handlers[key] = handler
+        if self._pubsub is not None:
+            self._pubsub.subscribe(key)
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        pubsub = self._pubsub = self.client.pubsub()
+        pubsub.subscribe(*list(self._handlers))
+        for item in pubsub.listen():
+            if item.get('type') != 'message':
+                continue
+            handler = self._handlers.get(item.get('channel'))
+            try:
+                envelope = json.loads(item['data'])
+                if handler and envelope.get('host_id') != self.host_id:
+                    handler(envelope.get('data'))
+            except Exception as e:
+                print(f"Ошибка обработки сообщения {item.get('channel')}: {e}")
+
+def create_state_backend(url):
+    """InMemoryStateBackend без url, иначе RedisStateBackend (нужен пакет redis)"""
+    if not url:
+        return InMemoryStateBackend()
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("Для STATE_BACKEND_URL нужен пакет redis: pip install redis")
+    return RedisStateBackend(redis.Redis.from_url(url, decode_responses=True))
+
+STATE = create_state_backend(STATE_BACKEND_URL)
+
+# --- Присутствие ---
+class PresenceRegistry:
+    """Соединения пользователей и опубликованный статус онлайн поверх бэкенда состояния.
+
+    Пользователь онлайн, пока у него есть хотя бы одно соединение (в любом
+    процессе). Переходы не рассылаются сразу: connect/disconnect только
+    планируют проверку, а collect_transitions() отдает изменения, дожившие до
+    срока. Переподключение в пределах offline_grace не порождает ни одного события.
+    Пользователей упавшего процесса, опубликованных онлайн без живых соединений,
+    находит sweep() в любом уцелевшем процессе.
+    """
+
+    def __init__(self, backend, offline_grace, sweep_interval):
+        self.backend = backend
+        self.offline_grace = offline_grace
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._sid_user = {}  # соединения этого процесса
+        self._pending = {}  # user_id -> когда проверить статус (time.monotonic)
+        self._last_sweep = time.monotonic()
+
+    def connect(self, sid, user_id):
+        with self._lock:
+            self._sid_user[sid] = user_id
+            self._pending[user_id] = time.monotonic()
+        self.backend.add_connection(user_id, sid)
+
+    def disconnect(self, sid):
+        """Убирает соединение и возвращает его user_id (или None)"""
+        with self._lock:
+            user_id = self._sid_user.pop(sid, None)
+        if user_id is None:
+            return None
+        self.backend.remove_connection(user_id, sid)
+        if not self.backend.connected_users([user_id]):
+            with self._lock:
+                self._pending[user_id] = time.monotonic() + self.offline_grace
+        return user_id
+
+    def sids(self, user_id):
+        return self.backend.user_sids(user_id)
+
+    def connected_users(self, user_ids):
+        return self.backend.connected_users(user_ids)
+
+    def is_online(self, user_id):
+        return bool(self.backend.connected_users([user_id])) or self.backend.is_published(user_id)
+
+    def collect_transitions(self):
+        """Возвращает {user_id: online} для созревших изменений статуса"""
+        now = time.monotonic()
+        with self._lock:
+            due = [user_id for user_id, due_at in self._pending.items() if due_at <= now]
+            for user_id in due:
+                del self._pending[user_id]
+        if not due:
+            return {}
+        connected = self.backend.connected_users(due)
+        return {user_id: user_id in connected for user_id in due
+                if self.backend.set_published(user_id, user_id in connected)}
+
+    def sweep(self):
+        """Планирует проверку опубликованных онлайн пользователей без живых соединений.
+
+        Их офлайн мог быть запланирован только в упавшем процессе. Проверка идет
+        после offline_grace, как при обычном отключении, поэтому пользователь,
+        переподключающийся к другому процессу, не мигает; set_published сам
+        гарантирует, что переход разошлет ровно один процесс.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        published = self.backend.published_users()
+        if not published:
+            return
+        orphaned = published - self.backend.connected_users(published)
+        with self._lock:
+            for user_id in orphaned:
+                self._pending.setdefault(user_id, now + self.offline_grace)
+
+PRESENCE = PresenceRegistry(STATE, PRESENCE_OFFLINE_GRACE, PRESENCE_SWEEP_INTERVAL)
+
+# --- Кэш прав доступа ---
+class AccessCache:
+    """Потокобезопасный LRU-кэш с ограничением по числу записей и времени жизни.
+
+    Кэшируются и отрицательные ответы (None/False). Счетчик поколений не дает
+    записать значение, загруженное до параллельной инвалидации.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._data[key] = (now + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+ACCESS_CACHE = AccessCache(ACCESS_CACHE_MAX_ENTRIES, ACCESS_CACHE_TTL)
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_member_role(user_id, room_id):
+    """Роль пользователя в комнате или None, если он не участник"""
+    user_id, room_id = _as_int(user_id), _as_int(room_id)
+    if user_id is None or room_id is None:
+        return None
+    def load():
+        row = (db.session.query(RoomParticipant.role)
+               .filter(RoomParticipant.user_id == user_id, RoomParticipant.room_id == room_id).first())
+        return row[0] if row else None
+    return ACCESS_CACHE.get(('member', room_id, user_id), load)
+
+def is_room_member(user_id, room_id):
+    return get_member_role(user_id, room_id) is not None
+
+def get_room_info(room_id):
+    """Тип комнаты, число участников и (для ЛС) id собеседников"""
+    room_id = _as_int(room_id)
+    if room_id is None:
+        return None
+    def load():
+        room_type = db.session.query(Room.type).filter(Room.id == room_id).scalar()
+        if room_type is None:
+            return None
+        member_ids = None
+        if room_type == 'dm':
+            member_ids = tuple(row[0] for row in db.session.query(RoomParticipant.user_id)
+                               .filter(RoomParticipant.room_id == room_id).all())
+            member_count = len(member_ids)
+        else:
+            member_count = RoomParticipant.query.filter_by(room_id=room_id).count()
+        return {'type': room_type, 'member_count': member_count, 'dm_user_ids': member_ids}
+    return ACCESS_CACHE.get(('room', room_id), load)
+
+def get_room_member_ids(room_id):
+    """id всех участников комнаты (из кэша)"""
+    room_id = _as_int(room_id)
+    if room_id is None:
+        return ()
+    def load():
+        return tuple(row[0] for row in db.session.query(RoomParticipant.user_id)
+                     .filter(RoomParticipant.room_id == room_id).all())
+    return ACCESS_CACHE.get(('members', room_id), load)
+
+def is_blocked(blocker_id, blocked_id):
+    blocker_id, blocked_id = _as_int(blocker_id), _as_int(blocked_id)
+    if blocker_id is None or blocked_id is None:
+        return False
+    def load():
+        return BlockedUser.query.filter_by(blocker_id=blocker_id, blocked_id=blocked_id).first() is not None
+    return ACCESS_CACHE.get(('block', blocker_id, blocked_id), load)
+
+def dm_peer_id(room_info, user_id):
+    for member_id in (room_info or {}).get('dm_user_ids') or ():
+        if member_id != user_id:
+            return member_id
+    return None
+
+def _apply_access_invalidation(message):
+    room_id = message.get('room_id')
+    if message.get('kind') == 'block':
+        ACCESS_CACHE.invalidate(('block', message['blocker_id'], message['blocked_id']))
+    elif message.get('user_id') is None:
+        ACCESS_CACHE.invalidate_where(lambda key: key[0] in ('member', 'room', 'members') and key[1] == room_id)
+    else:
+        ACCESS_CACHE.invalidate(('member', room_id, message['user_id']), ('room', room_id), ('members', room_id))
+
+def _invalidate_access(message):
+    # Локально сразу, остальным процессам — через бэкенд состояния
+    _apply_access_invalidation(message)
+    STATE.broadcast('access_invalidate', message)
+
+def invalidate_membership(room_id, user_id=None):
+    """Сбрасывает кэш участия: одного пользователя или всей комнаты"""
+    _invalidate_access({'kind': 'membership', 'room_id': _as_int(room_id),
+                        'user_id': _as_int(user_id) if user_id is not None else None})
+
+def invalidate_block(blocker_id, blocked_id):
+    _invalidate_access({'kind': 'block', 'blocker_id': _as_int(blocker_id), 'blocked_id': _as_int(blocked_id)})
+
+STATE.subscribe('access_invalidate', _apply_access_invalidation)
+
+def members_room(room_id):
+    """Socket-комната всех участников чата (в отличие от str(room_id) — только открывших его)"""
+    return f"members_{room_id}"
+
+def user_sids(user_id):
+    return PRESENCE.sids(user_id)
+
+def sync_member_room(user_id, room_id, joined=True):
+    """Добавляет/убирает активные соединения пользователя в комнату участников"""
+    for sid in user_sids(user_id):
+        try:
+            if joined:
+                socketio.server.enter_room(sid, members_room(room_id), namespace='/')
+            else:
+                socketio.server.leave_room(sid, members_room(room_id), namespace='/')
+        except Exception:
+            pass
+
+# Накопленные приращения непрочитанных для широковещательной рассылки:
+# {room_id: {sender_id: count}}. Сбрасываются фоновой задачей раз в UNREAD_DELTA_FLUSH_INTERVAL.
+_PENDING_UNREAD = {}
+_PENDING_UNREAD_LOCK = threading.Lock()
+_UNREAD_FLUSHER_STARTED = False
+
+def _flush_unread_deltas():
+    with _PENDING_UNREAD_LOCK:
+        pending = dict(_PENDING_UNREAD)
+        _PENDING_UNREAD.clear()
+    for room_id, by_sender in pending.items():
+        socketio.emit('unread_delta', {
+            'room_id': room_id,
+            'delta': sum(by_sender.values()),
+            # Клиент вычитает собственные сообщения из общего приращения
+            'by_sender': {str(sender_id): count for sender_id, count in by_sender.items()}
+        }, room=members_room(room_id))
+
+def _unread_flusher_loop():
+    while True:
+        socketio.sleep(UNREAD_DELTA_FLUSH_INTERVAL)
+        try:
+            _flush_unread_deltas()
+        except Exception as e:
+            app.logger.error(f"unread delta flush failed: {e}")
+
+def queue_unread_delta(room_id, sender_id):
+    global _UNREAD_FLUSHER_STARTED
+    with _PENDING_UNREAD_LOCK:
+        by_sender = _PENDING_UNREAD.setdefault(room_id, {})
+        by_sender[sender_id] = by_sender.get(sender_id, 0) + 1
+        start_flusher = not _UNREAD_FLUSHER_STARTED
+        _UNREAD_FLUSHER_STARTED = True
+    if start_flusher:
+        socketio.start_background_task(_unread_flusher_loop)
+
+_PRESENCE_FLUSHER_STARTED = False
+_PRESENCE_FLUSHER_LOCK = threading.Lock()
+
+def _flush_presence():
+    """Рассылает созревшие изменения присутствия пачками presence_batch.
+
+    Для больших комнат — одна пачка на комнату участников; в остальных
+    получатели собираются по пользователям, так что общий собеседник из
+    нескольких чатов получает одно событие.
+    """
+    changes = PRESENCE.collect_transitions()
+    if not changes:
+        return
+    with app.app_context():
+        room_rows = (db.session.query(RoomParticipant.room_id, RoomParticipant.user_id)
+                     .filter(RoomParticipant.user_id.in_(list(changes))).all())
+        by_room = {}
+        for room_id, user_id in room_rows:
+            by_room.setdefault(room_id, {})[user_id] = changes[user_id]
+
+        per_recipient = {}
+        for room_id, updates in by_room.items():
+            member_ids = get_room_member_ids(room_id)
+            if len(member_ids) >= ROOM_FANOUT_THRESHOLD:
+                socketio.emit('presence_batch', {'updates': {str(uid): online for uid, online in updates.items()}},
+                              room=members_room(room_id))
+                continue
+            for member_id in PRESENCE.connected_users(member_ids):
+                per_recipient.setdefault(member_id, {}).update(updates)
+
+    for recipient_id, updates in per_recipient.items():
+        updates.pop(recipient_id, None)
+        if updates:
+            socketio.emit('presence_batch', {'updates': {str(uid): online for uid, online in updates.items()}},
+                          room=f"user_{recipient_id}")
+
+def _presence_flusher_loop():
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_INTERVAL)
+        try:
+            STATE.heartbeat()
+            PRESENCE.sweep()
+            _flush_presence()
+        except Exception as e:
+            app.logger.error(f"presence flush failed: {e}")
+
+def ensure_presence_flusher():
+    global _PRESENCE_FLUSHER_STARTED
+    with _PRESENCE_FLUSHER_LOCK:
+        if _PRESENCE_FLUSHER_STARTED:
+            return
+        _PRESENCE_FLUSHER_STARTED = True
+    socketio.start_background_task(_presence_flusher_loop)
+
+# --- Слияние эфемерных событий ---
+class RoomEventCoalescer:
+    """Сливает частые события комнаты в окне window и рассылает только итог.
+
+    Политики:
+    - latest: последнее значение по ключу (смена слайда);
+    - state: по ключу запоминается только факт изменения, полезная нагрузка
+      собирается загрузчиком при отправке одним пакетным запросом (реакции, опросы);
+    - typing: начало набора уходит сразу, повторы — не чаще typing_refresh,
+      остановка откладывается до конца окна и отменяется новым началом.
+    """
+
+    def __init__(self, window, typing_refresh, typing_ttl):
+        self.window = window
+        self.typing_refresh = typing_refresh
+        self.typing_ttl = typing_ttl
+        self._lock = threading.Lock()
+        self._latest = OrderedDict()  # (event, room, key) -> (payload, skip_sid)
+        self._state = {}  # event -> {key: room}
+        self._typing_stops = {}  # (room, user_id) -> (payload, skip_sid)
+        self._typing_sent = OrderedDict()  # (room, user_id) -> время последнего "печатает", старые первыми
+        self._loaders = {}
+        self._started = False
+
+    def register_loader(self, event, loader):
+        """loader(keys) -> {key: payload}; вызывается в контексте приложения"""
+        self._loaders[event] = loader
+
+    def latest(self, event, room, key, payload, skip_sid=None):
+        with self._lock:
+            self._latest[(event, room, key)] = (payload, skip_sid)
+        self._ensure_started()
+
+    def state(self, event, room, key):
+        with self._lock:
+            self._state.setdefault(event, {})[key] = room
+        self._ensure_started()
+
+    def typing(self, room, user_id, is_typing, payload, skip_sid=None):
+        now = time.monotonic()
+        typing_key = (room, user_id)
+        with self._lock:
+            if is_typing:
+                self._typing_stops.pop(typing_key, None)
+                last_sent = self._typing_sent.get(typing_key)
+                if last_sent is not None and now - last_sent < self.typing_refresh:
+                    return
+                self._typing_sent[typing_key] = now
+                self._typing_sent.move_to_end(typing_key)
+                self._prune_typing(now)
+            else:
+                if typing_key not in self._typing_sent:
+                    return
+                self._typing_stops[typing_key] = (payload, skip_sid)
+        if is_typing:
+            socketio.emit('typing', payload, room=room, skip_sid=skip_sid)
+        else:
+            self._ensure_started()
+
+    def _prune_typing(self, now):
+        # Отметки упорядочены по времени: с начала снимаются только устаревшие
+        while self._typing_sent:
+            typing_key, sent_at = next(iter(self._typing_sent.items()))
+            if now - sent_at < self.typing_ttl:
+                break
+            del self._typing_sent[typing_key]
+
+    def flush(self):
+        with self._lock:
+            latest, self._latest = self._latest, OrderedDict()
+            state, self._state = self._state, {}
+            stops, self._typing_stops = self._typing_stops, {}
+            for typing_key in stops:
+                self._typing_sent.pop(typing_key, None)
+
+        for (event, room, _), (payload, skip_sid) in latest.items():
+            socketio.emit(event, payload, room=room, skip_sid=skip_sid)
+        for (room, _), (payload, skip_sid) in stops.items():
+            socketio.emit('typing', payload, room=room, skip_sid=skip_sid)
+        if state:
+            with app.app_context():
+                for event, rooms_by_key in state.items():
+                    payloads = self._loaders[event](list(rooms_by_key))
+                    for key, room in rooms_by_key.items():
+                        if key in payloads:
+                            socketio.emit(event, payloads[key], room=room)
+
+    def _loop(self):
+        while True:
+            socketio.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"event coalescer flush failed: {e}")
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._loop)
+
+def _reaction_state_payloads(message_ids):
+    summaries = load_reaction_summaries(message_ids)
+    return {message_id: {'message_id': message_id, 'reactions': summaries.get(message_id, {})}
+            for message_id in message_ids}
+
+def _poll_state_payloads(message_ids):
+    return {message_id: {'message_id': message_id, 'poll': poll}
+            for message_id, poll in load_poll_dicts(message_ids).items()}
+
+COALESCER = RoomEventCoalescer(COALESCE_WINDOW, TYPING_REFRESH, TYPING_STATE_TTL)
+COALESCER.register_loader('update_reactions', _reaction_state_payloads)
+COALESCER.register_loader('poll_updated', _poll_state_payloads)
+
+# --- Совместные документы ---
+# Операция — одна правка строки {'pos', 'delete', 'insert'}: удалить delete символов
+# с позиции pos и вставить insert. Позиции считаются в символах Unicode.
+def apply_document_op(content, op):
+    pos, delete, insert = op['pos'], op['delete'], op['insert']
+    return content[:pos] + insert + content[pos + delete:]
+
+def transform_document_op(op, applied):
+    """Переносит op, сделанную по той же версии, что и applied, на документ после applied.
+
+    Если диапазоны соприкасаются или пересекаются, удаляется их объединение, а обе
+    вставки сохраняются: первой идет та, что начинается левее, при равных позициях —
+    applied. Клиент (transformRemoteDocumentOp в chat.js) делает зеркальное
+    преобразование, так что обе стороны получают один текст.
+    """
+    pos, delete, insert = op['pos'], op['delete'], op['insert']
+    applied_pos, applied_end = applied['pos'], applied['pos'] + applied['delete']
+    applied_len = len(applied['insert'])
+    end = pos + delete
+    if end < applied_pos:
+        return op
+    if pos > applied_end:
+        return {'pos': pos + applied_len - applied['delete'], 'delete': delete, 'insert': insert}
+    if pos < applied_pos:
+        if end > applied_end:
+            return {'pos': pos, 'delete': delete - applied['delete'] + applied_len,
+                    'insert': insert + applied['insert']}
+        return {'pos': pos, 'delete': applied_pos - pos, 'insert': insert}
+    return {'pos': applied_pos + applied_len, 'delete': max(0, end - applied_end), 'insert': insert}
+
+def diff_document(old, new):
+    """Одна операция, превращающая old в new (общие начало и конец не трогаются)"""
+    if old == new:
+        return None
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return {'pos': prefix, 'delete': len(old) - prefix - suffix, 'insert': new[prefix:len(new) - suffix]}
+
+def parse_document_op(raw):
+    if not isinstance(raw, dict):
+        return None
+    pos, delete, insert = _as_int(raw.get('pos')), _as_int(raw.get('delete', 0)), raw.get('insert', '')
+    if pos is None or delete is None or pos < 0 or delete < 0 or not isinstance(insert, str):
+        return None
+    return {'pos': pos, 'delete': delete, 'insert': insert}
+
+class DocumentStaleError(Exception):
+    """Операция сделана по версии старше журнала — клиенту нужен свежий снимок"""
+
+class DocumentRegistry:
+    """Версионированное состояние совместных документов комнат (OT на сервере).
+
+    Сервер — единственный источник порядка: операция клиента по версии base
+    преобразуется относительно операций журнала после base, применяется,
+    получает следующий номер версии и рассылается в комнату под блокировкой
+    документа, чтобы дельты приходили участникам по порядку. Снимок пишется
+    в room_document фоновой задачей; новый участник получает последний снимок
+    и операции после него. Состояние живет в памяти процесса.
+    """
+
+    def __init__(self, log_size, snapshot_interval, idle_ttl, max_length):
+        self.log_size = log_size
+        self.snapshot_interval = snapshot_interval
+        self.idle_ttl = idle_ttl
+        self.max_length = max_length
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._started = False
+
+    def _load(self, room_id):
+        """Документ комнаты из памяти или из последнего снимка; вызывается в контексте приложения"""
+        with self._lock:
+            doc = self._docs.get(room_id)
+        if doc is not None:
+            return doc
+        row = db.session.get(RoomDocument, room_id)
+        content, version = (row.content or '', row.version or 0) if row else ('', 0)
+        with self._lock:
+            doc = self._docs.get(room_id)
+            if doc is None:
+                doc = {'lock': threading.Lock(), 'content': content, 'version': version,
+                       'snapshot': content, 'snapshot_version': version,
+                       'log': [], 'touched': time.monotonic()}
+                self._docs[room_id] = doc
+        self._ensure_started()
+        return doc
+
+    def snapshot(self, room_id):
+        """Последний снимок и операции после него"""
+        doc = self._load(room_id)
+        with doc['lock']:
+            doc['touched'] = time.monotonic()
+            snapshot_version = doc['snapshot_version']
+            return {
+                'snapshot': doc['snapshot'],
+                'snapshot_version': snapshot_version,
+                'ops': [{'version': version, 'op': op} for version, op in doc['log'] if version > snapshot_version],
+                'version': doc['version'],
+            }
+
+    def current(self, room_id):
+        """Текущий текст и версия"""
+        doc = self._load(room_id)
+        with doc['lock']:
+            return doc['content'], doc['version']
+
+    def apply(self, room_id, base_version, op, publish):
+        """Применяет операцию клиента; publish(version, op) вызывается под блокировкой документа"""
+        doc = self._load(room_id)
+        with doc['lock']:
+            doc['touched'] = time.monotonic()
+            version = doc['version']
+            if base_version is None or base_version > version:
+                raise DocumentStaleError()
+            missed = version - base_version
+            if missed > len(doc['log']):
+                raise DocumentStaleError()
+            for _, applied in doc['log'][-missed:] if missed else []:
+                op = transform_document_op(op, applied)
+            content = doc['content']
+            if op['pos'] > len(content) or op['pos'] + op['delete'] > len(content):
+                raise DocumentStaleError()
+            content = apply_document_op(content, op)
+            if len(content) > self.max_length:
+                raise ValueError('document too large')
+            version += 1
+            doc['content'], doc['version'] = content, version
+            doc['log'].append((version, op))
+            # Операции после снимка нужны новым участникам, поэтому журнал режется только до снимка
+            overflow = len(doc['log']) - self.log_size
+            if overflow > 0:
+                overflow = min(overflow, sum(1 for entry in doc['log'] if entry[0] <= doc['snapshot_version']))
+                del doc['log'][:overflow]
+            publish(version, op)
+            return version, op
+
+    def drop(self, room_id):
+        with self._lock:
+            self._docs.pop(room_id, None)
+
+    def flush(self, evict_idle=True):
+        """Пишет снимки измененных документов и выгружает давно неактивные"""
+        with self._lock:
+            docs = list(self._docs.items())
+        now = time.monotonic()
+        saved = []
+        with app.app_context():
+            for room_id, doc in docs:
+                with doc['lock']:
+                    content, version = doc['content'], doc['version']
+                if version == doc['snapshot_version']:
+                    continue
+                row = db.session.get(RoomDocument, room_id)
+                if row is None:
+                    if not db.session.get(Room, room_id):
+                        self.drop(room_id)
+                        continue
+                    row = RoomDocument(room_id=room_id)
+                    db.session.add(row)
+                row.content, row.version, row.updated_at = content, version, datetime.utcnow()
+                saved.append((doc, content, version))
+            if saved:
+                db.session.commit()
+        for doc, content, version in saved:
+            with doc['lock']:
+                doc['snapshot'], doc['snapshot_version'] = content, version
+        if evict_idle:
+            with self._lock:
+                for room_id, doc in list(self._docs.items()):
+                    if doc['version'] == doc['snapshot_version'] and now - doc['touched'] > self.idle_ttl:
+                        del self._docs[room_id]
+
+    def _loop(self):
+        while True:
+            socketio.sleep(self.snapshot_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"document snapshot failed: {e}")
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._loop)
+
+DOCUMENTS = DocumentRegistry(DOCUMENT_OP_LOG_SIZE, DOCUMENT_SNAPSHOT_INTERVAL, DOCUMENT_IDLE_TTL, DOCUMENT_MAX_LENGTH)
+
+# --- Активные сессии комнат (доска, презентация) ---
+class RoomSessionRegistry:
+    """Последнее состояние совместных сессий комнаты: {kind: payload} с истечением по TTL.
+
+    Каждое обновление продлевает запись; завершение сессии или удаление комнаты
+    убирает ее сразу. Изменения расходятся по процессам через бэкенд состояния,
+    так что вход в комнату на любом процессе видит те же сессии.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}  # room_id -> {kind: (payload, expires_at)}
+        self._next_sweep = 0
+
+    def set(self, room_id, kind, payload):
+        message = {'op': 'set', 'room_id': room_id, 'kind': kind, 'payload': payload}
+        self.apply(message)
+        STATE.broadcast('room_session', message)
+
+    def end(self, room_id, kind=None):
+        message = {'op': 'end', 'room_id': room_id, 'kind': kind}
+        self.apply(message)
+        STATE.broadcast('room_session', message)
+
+    def get(self, room_id):
+        now = time.monotonic()
+        with self._lock:
+            sessions = self._sessions.get(room_id) or {}
+            return {kind: payload for kind, (payload, expires_at) in sessions.items() if expires_at > now}
+
+    def apply(self, message):
+        room_id, kind = message.get('room_id'), message.get('kind')
+        now = time.monotonic()
+        with self._lock:
+            if message.get('op') == 'set':
+                self._sessions.setdefault(room_id, {})[kind] = (message.get('payload'), now + self.ttl)
+            elif kind is None:
+                self._sessions.pop(room_id, None)
+            else:
+                sessions = self._sessions.get(room_id)
+                if sessions is not None:
+                    sessions.pop(kind, None)
+                    if not sessions:
+                        del self._sessions[room_id]
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        # Истекшие записи убираются попутно, не чаще раза в минуту
+        self._next_sweep = now + 60
+        for room_id in list(self._sessions):
+            sessions = self._sessions[room_id]
+            for kind in [kind for kind, (_, expires_at) in sessions.items() if expires_at <= now]:
+                del sessions[kind]
+            if not sessions:
+                del self._sessions[room_id]
+
+ROOM_SESSIONS = RoomSessionRegistry(ROOM_SESSION_TTL)
+STATE.subscribe('room_session', ROOM_SESSIONS.apply)
+
 # --- Вспомогательные функции ---
-ONLINE_USERS = set()
-SID_TO_USER = {}
+def fan_out_message(room_id, message_dict, sender_id):
+    """Доставляет новое сообщение всем участникам комнаты.
+
+    Небольшие комнаты получают персональный receive_message_with_unread с точным
+    счетчиком. Для больших групп и каналов сообщение сериализуется один раз и
+    рассылается в комнату участников, а счетчики обновляются пачкой unread_delta.
+    """
+    room_info = get_room_info(room_id)
+    member_count = room_info['member_count'] if room_info else 0
+    if member_count >= ROOM_FANOUT_THRESHOLD:
+        socketio.emit('receive_message', message_dict, room=members_room(room_id))
+        queue_unread_delta(room_id, sender_id)
+        return
+
+    socketio.emit('receive_message', message_dict, room=f"user_{sender_id}")
+    unread_counts = room_unread_counts(room_id, exclude_user_id=sender_id)
+    for user_id, unread_count in unread_counts.items():
+        payload = {
+            'message': message_dict,
+            'unread_update': {
+                'room_id': room_id,
+                'count': unread_count
+            }
+        }
+        socketio.emit('receive_message_with_unread', payload, room=f"user_{user_id}")
+
 def notify_user_about_new_room(user, room):
     room_data = room.to_dict(user)
     socketio.emit('new_room', room_data, room=f"user_{user.id}")
@@ -351,20 +2429,29 @@ def notify_room_update(room):
          room_data = room.to_dict(user)
          socketio.emit('room_updated', room_data, room=f"user_{participant.user_id}")
 
+def find_dm_room(user_id_a, user_id_b):
+    """Личный чат двух пользователей по первичному ключу dm_pair"""
+    pair = db.session.get(DirectMessagePair, (min(user_id_a, user_id_b), max(user_id_a, user_id_b)))
+    return pair.room if pair else None
+
 def find_or_create_dm_room(user1, user2):
-    room = Room.query.filter_by(type='dm').filter(
-        Room.participants.any(user_id=user1.id)
-    ).filter(
-        Room.participants.any(user_id=user2.id)
-    ).first()
+    room = find_dm_room(user1.id, user2.id)
 
     is_new_room = False
     if not room:
-        is_new_room = True
         room = Room(type='dm')
         db.session.add(room)
         db.session.add(RoomParticipant(user_id=user1.id, room=room))
         db.session.add(RoomParticipant(user_id=user2.id, room=room))
+        db.session.add(DirectMessagePair(min_user_id=min(user1.id, user2.id),
+                                         max_user_id=max(user1.id, user2.id), room=room))
+        try:
+            db.session.flush()
+            is_new_room = True
+        except IntegrityError:
+            # Параллельный запрос уже создал этот чат: уникальный ключ пары не дал завести дубль
+            db.session.rollback()
+            room = find_dm_room(user1.id, user2.id)
     
     user1.add_contact(user2)
     user2.add_contact(user1)
@@ -372,11 +2459,302 @@ def find_or_create_dm_room(user1, user2):
     db.session.commit()
 
     if is_new_room:
+        invalidate_membership(room.id)
+        sync_member_room(user1.id, room.id)
+        sync_member_room(user2.id, room.id)
         notify_user_about_new_room(user1, room)
         notify_user_about_new_room(user2, room)
         
     return room
 
+# --- Хэширование паролей ---
+class PasswordHashBusy(Exception):
+    """Очередь хэширования заполнена или результат не пришел за PASSWORD_HASH_TIMEOUT"""
+
+_PASSWORD_POOL = None
+_PASSWORD_POOL_LOCK = threading.Lock()
+_password_jobs = 0
+_password_jobs_lock = threading.Lock()
+
+def password_pool():
+    global _PASSWORD_POOL
+    with _PASSWORD_POOL_LOCK:
+        if _PASSWORD_POOL is None:
+            # Рабочим процессам нужен только werkzeug.security: функции передаются по имени
+            _PASSWORD_POOL = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return _PASSWORD_POOL
+
+def _reset_password_pool(broken):
+    global _PASSWORD_POOL
+    with _PASSWORD_POOL_LOCK:
+        if _PASSWORD_POOL is broken:
+            _PASSWORD_POOL = None
+
+def _release_password_slot(future):
+    global _password_jobs
+    with _password_jobs_lock:
+        _password_jobs -= 1
+
+def _run_password_job(fn, *args):
+    """Выполняет fn в пуле; место в очереди освобождается, когда задача действительно завершилась"""
+    global _password_jobs
+    if PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    with _password_jobs_lock:
+        if _password_jobs >= PASSWORD_HASH_QUEUE_LIMIT:
+            raise PasswordHashBusy()
+        _password_jobs += 1
+    pool = password_pool()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _release_password_slot(None)
+        _reset_password_pool(pool)
+        raise PasswordHashBusy()
+    future.add_done_callback(_release_password_slot)
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHashBusy()
+    except BrokenProcessPool:
+        # Рабочий процесс упал: следующий вызов создаст пул заново
+        _reset_password_pool(pool)
+        raise PasswordHashBusy()
+
+def hash_password(password):
+    return _run_password_job(generate_password_hash, password)
+
+def verify_password(password_hash, password):
+    return _run_password_job(check_password_hash, password_hash, password)
+
+def password_busy_response():
+    response = jsonify({'success': False, 'message': 'Сервер перегружен, повторите попытку через несколько секунд.'})
+    response.headers['Retry-After'] = '2'
+    return response, 503
+
+# --- Очередь исходящих писем ---
+class TimeoutMailConnection(MailConnection):
+    """Соединение Flask-Mail с таймаутом: зависший сервер не останавливает очередь навсегда"""
+
+    def configure_host(self):
+        if self.mail.use_ssl:
+            host = smtplib.SMTP_SSL(self.mail.server, self.mail.port, timeout=MAIL_SMTP_TIMEOUT)
+        else:
+            host = smtplib.SMTP(self.mail.server, self.mail.port, timeout=MAIL_SMTP_TIMEOUT)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+class MailQueue:
+    """Фоновая отправка писем с переиспользованием SMTP-соединения.
+
+    enqueue только кладет письмо в память процесса. Рабочая задача открывает
+    соединение, когда появляется письмо, и шлет через него пачку до batch_size
+    писем, дожидаясь новых не дольше idle_timeout. Обрыв соединения и ответы 4xx
+    повторяются с экспоненциальной паузой до max_attempts попыток, ответы 5xx — нет.
+    Раз в stats_interval состояние очереди печатается в консоль, а при выходе
+    процесса печатаются запасные ссылки писем, которые так и не ушли.
+    """
+
+    def __init__(self, batch_size, idle_timeout, max_attempts, retry_base, retry_max, stats_interval):
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.stats_interval = stats_interval
+        self._lock = threading.Lock()
+        self._ready = deque()
+        self._delayed = []  # куча (время повтора, номер, задание)
+        self._sequence = itertools.count()
+        self._in_flight = {}  # id(задание) -> задание
+        self._started = False
+        self._latencies = deque(maxlen=1000)  # от постановки в очередь до приема сервером, с
+        self._send_times = deque(maxlen=1000)  # одна отправка через открытое соединение, с
+        self._counters = {'sent': 0, 'failed': 0, 'retried': 0, 'connections': 0}
+        self._last_error = None
+        self._reported = None
+
+    def enqueue(self, message, fallback=None):
+        """fallback печатается, если письмо так и не ушло (например, ссылка подтверждения)"""
+        job = {'message': message, 'attempt': 0, 'queued_at': time.monotonic(), 'fallback': fallback}
+        with self._lock:
+            self._ready.append(job)
+        self._ensure_started()
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            send_times = sorted(self._send_times)
+            stats = dict(self._counters)
+            stats.update({
+                'queued': len(self._ready),
+                'retrying': len(self._delayed),
+                'in_flight': len(self._in_flight),
+                'last_error': self._last_error,
+            })
+
+        def percentile(values, pct):
+            return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000, 1) if values else None
+
+        stats.update({
+            'latency_p50_ms': percentile(latencies, 50),
+            'latency_p95_ms': percentile(latencies, 95),
+            'send_p50_ms': percentile(send_times, 50),
+            'send_p95_ms': percentile(send_times, 95),
+        })
+        return stats
+
+    def pending(self):
+        with self._lock:
+            return len(self._ready) + len(self._delayed) + len(self._in_flight)
+
+    def report(self):
+        """Печатает состояние очереди, если с прошлого отчета что-то изменилось"""
+        stats = self.stats()
+        snapshot = tuple(stats[key] for key in ('queued', 'retrying', 'in_flight', 'sent', 'failed', 'retried'))
+        if snapshot == self._reported:
+            return
+        self._reported = snapshot
+        print(f"[EMAIL] Очередь: ждут {stats['queued']}, на повторе {stats['retrying']}, "
+              f"отправляются {stats['in_flight']}; отправлено {stats['sent']}, ошибок {stats['failed']}, "
+              f"повторов {stats['retried']}, соединений {stats['connections']}"
+              + (f"; задержка p50/p95 {stats['latency_p50_ms']}/{stats['latency_p95_ms']} мс"
+                 if stats['latency_p50_ms'] is not None else '')
+              + (f"; последняя ошибка: {stats['last_error']}" if stats['last_error'] else ''))
+
+    def dump_undelivered(self):
+        """Печатает запасные ссылки писем, оставшихся в очереди (очередь живет только в памяти)"""
+        with self._lock:
+            jobs = list(self._ready) + [entry[2] for entry in self._delayed] + list(self._in_flight.values())
+        for job in jobs:
+            print(f"[EMAIL] Не отправлено до остановки: {', '.join(job['message'].recipients)}")
+            if job['fallback']:
+                print(job['fallback'])
+
+    def _take(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                self._ready.append(heapq.heappop(self._delayed)[2])
+            if not self._ready:
+                return None
+            job = self._ready.popleft()
+            self._in_flight[id(job)] = job
+            return job
+
+    def _done(self, job, error=None, transient=False):
+        with self._lock:
+            self._in_flight.pop(id(job), None)
+            if error is None:
+                self._counters['sent'] += 1
+                self._latencies.append(time.monotonic() - job['queued_at'])
+                return
+            job['attempt'] += 1
+            self._last_error = f"{type(error).__name__}: {error}"
+            retry = transient and job['attempt'] < self.max_attempts
+            if retry:
+                delay = min(self.retry_max, self.retry_base * 2 ** (job['attempt'] - 1))
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), job))
+                self._counters['retried'] += 1
+            else:
+                self._counters['failed'] += 1
+        recipients = ', '.join(job['message'].recipients)
+        if retry:
+            print(f"[EMAIL] Повтор через {delay:.1f} с ({job['attempt']}/{self.max_attempts}) для {recipients}: {error}")
+            return
+        print(f"\n--- ОШИБКА ОТПРАВКИ EMAIL ---")
+        print(f"Получатель: {recipients}")
+        print(f"Ошибка: {error} ({type(error).__name__}), попыток: {job['attempt']}")
+        if job['fallback']:
+            print(job['fallback'])
+        print(f"---\n")
+
+    def _next_job(self):
+        """Следующее письмо для открытого соединения; ждет не дольше idle_timeout"""
+        deadline = time.monotonic() + self.idle_timeout
+        while True:
+            job = self._take()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            socketio.sleep(MAIL_QUEUE_POLL)
+
+    def _send_batch(self, job):
+        connection = TimeoutMailConnection(mail)
+        try:
+            connection.__enter__()
+        except Exception as e:
+            self._done(job, e, transient=True)
+            return
+        with self._lock:
+            self._counters['connections'] += 1
+        try:
+            for sent_count in range(1, self.batch_size + 1):
+                started = time.monotonic()
+                try:
+                    connection.send(job['message'])
+                except smtplib.SMTPRecipientsRefused as e:
+                    # Сервер отклонил всех получателей; соединение при этом исправно
+                    codes = [code for code, _ in e.recipients.values()]
+                    self._done(job, e, transient=all(400 <= code < 500 for code in codes))
+                except smtplib.SMTPResponseException as e:
+                    self._done(job, e, transient=400 <= e.smtp_code < 500)
+                    if e.smtp_code == 421:
+                        return
+                except (OSError, smtplib.SMTPException) as e:
+                    # Обрыв или таймаут: письмо — на повтор, соединение открывается заново
+                    self._done(job, e, transient=True)
+                    return
+                except Exception as e:
+                    self._done(job, e)
+                else:
+                    with self._lock:
+                        self._send_times.append(time.monotonic() - started)
+                    self._done(job)
+                if sent_count == self.batch_size:
+                    return
+                job = self._next_job()
+                if job is None:
+                    return
+        finally:
+            try:
+                if connection.host is not None:
+                    connection.host.quit()
+            except (OSError, smtplib.SMTPException):
+                connection.host.close()
+
+    def _loop(self):
+        last_report = time.monotonic()
+        while True:
+            if time.monotonic() - last_report >= self.stats_interval:
+                last_report = time.monotonic()
+                self.report()
+            job = self._take()
+            if job is None:
+                socketio.sleep(MAIL_QUEUE_POLL)
+                continue
+            try:
+                with app.app_context():
+                    self._send_batch(job)
+            except Exception as e:
+                app.logger.error(f"mail queue batch failed: {e}")
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        atexit.register(self.dump_undelivered)
+        socketio.start_background_task(self._loop)
+
+MAIL_QUEUE = MailQueue(MAIL_BATCH_SIZE, MAIL_CONNECTION_IDLE, MAIL_MAX_ATTEMPTS, MAIL_RETRY_BASE, MAIL_RETRY_MAX,
+                       MAIL_STATS_INTERVAL)
+
 def send_verification_email(user):
     token = s.dumps(user.email, salt='email-confirm')
     confirm_url = url_for('confirm_email', token=token, _external=True)
@@ -394,19 +2772,9 @@ def send_verification_email(user):
         print(f"---\n")
         return False
 
-    try:
-        print(f"\n[EMAIL] Отправка письма на {user.email}...")
-        mail.send(msg)
-        print(f"[EMAIL] ✅ Успешно отправлено на {user.email}")
-        return True
-    except Exception as e:
-        print(f"\n--- ОШИБКА ОТПРАВКИ EMAIL ---")
-        print(f"Получатель: {user.email}")
-        print(f"Ошибка: {e}")
-        print(f"Тип ошибки: {type(e).__name__}")
-        print(f"Ссылка для ручного использования: {confirm_url}")
-        print(f"---\n")
-        return False
+    MAIL_QUEUE.enqueue(msg, fallback=f"Ссылка для ручного использования: {confirm_url}")
+    print(f"[EMAIL] Письмо на {user.email} поставлено в очередь")
+    return True
 
 def send_password_reset_email(user):
     token = s.dumps(user.email, salt='password-reset')
@@ -437,43 +2805,68 @@ def send_password_reset_email(user):
         print(f"---\n")
         return False
 
-    try:
-        print(f"\n[EMAIL] Отправка письма на {user.email}...")
-        mail.send(msg)
-        print(f"[EMAIL] ✅ Успешно отправлено на {user.email}")
-        return True
-    except Exception as e:
-        print(f"\n--- ОШИБКА ОТПРАВКИ EMAIL ---")
-        print(f"Получатель: {user.email}")
-        print(f"Ошибка: {e}")
-        print(f"Тип ошибки: {type(e).__name__}")
-        print(f"Ссылка для ручного использования: {reset_url}")
-        print(f"---\n")
-        return False
+    MAIL_QUEUE.enqueue(msg, fallback=f"Ссылка для ручного использования: {reset_url}")
+    print(f"[EMAIL] Письмо на {user.email} поставлено в очередь")
+    return True
 
 # --- Маршруты (Routes) и API ---
+@app.route('/static/uploads/<path:filename>')
+def serve_upload(filename):
+    """Загруженные файлы: перемотка (Range), ETag/Last-Modified с ответом 304, кэш навсегда.
+
+    Правило точнее общего /static/<path>, поэтому старые url вложений и аватаров
+    обслуживает этот обработчик.
+    """
+    path = safe_join(UPLOAD_ROOT, filename)
+    if path is None:
+        abort(404)
+    # Части незавершенных загрузок не отдаются; проверяется уже нормализованный путь,
+    # иначе media/./cas/tmp/ или media/cas//tmp/ обходят проверку
+    tmp_dir = os.path.normcase(os.path.join(MEDIA_STORE_DIR, 'tmp'))
+    if os.path.commonpath([os.path.normcase(os.path.abspath(path)), tmp_dir]) == tmp_dir:
+        abort(404)
+    if MEDIA_ACCEL_REDIRECT:
+        if not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{MEDIA_ACCEL_REDIRECT}/{urllib.parse.quote(filename)}"
+    else:
+        # Тело передается через wsgi.file_wrapper сервера, если он его предоставляет
+        response = send_from_directory(UPLOAD_ROOT, filename, max_age=MEDIA_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/')
 def index():
     if 'user_id' in session:
         user = db.session.get(User, session['user_id'])
         if user and user.is_verified:
             user_contacts_data = user.get_contacts_data()
-            participant_entries = user.rooms.options(db.joinedload(RoomParticipant.room)).all()
-            
             # Разделяем на обычные и архивированные чаты
-            active_rooms = []
-            archived_rooms = []
-            for entry in participant_entries:
-                room_dict = entry.room.to_dict(user)
-                if entry.is_archived:
-                    archived_rooms.append(room_dict)
-                else:
-                    active_rooms.append(room_dict)
+            active_rooms, archived_rooms = split_room_list(user)
             
             sfu_url = os.environ.get('SFU_URL')
             return render_template('index.html', user=user, contacts=user_contacts_data, 
                                  rooms=active_rooms, archived_rooms=archived_rooms, sfu_url=sfu_url)
     return redirect(url_for('auth'))
+@app.route('/api/rooms')
+def get_rooms():
+    """Список комнат для переподключившегося клиента; поддерживает If-None-Match"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    user = db.session.get(User, session['user_id'])
+    if not user:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    active_rooms, archived_rooms = split_room_list(user)
+    response = jsonify({'success': True, 'rooms': active_rooms, 'archived_rooms': archived_rooms})
+    # Список персональный: кэшировать может только браузер, и только с ревалидацией
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
 # ... (Auth, Logout, Confirm, Register, Login API)
 @app.route('/auth')
 def auth():
@@ -497,6 +2890,7 @@ def confirm_email(token):
     user = User.query.filter_by(email=email).first_or_404()
     if not user.is_verified:
         user.is_verified = True
+        index_username(user)
         db.session.commit()
     return redirect(url_for('auth'))
 
@@ -515,8 +2909,12 @@ def register():
         return jsonify({'success': False, 'message': 'Имя или Email заняты'}), 409
 
     new_user = User(username=username, email=email)
-    new_user.set_password(password)
+    try:
+        new_user.set_password(password)
+    except PasswordHashBusy:
+        return password_busy_response()
     db.session.add(new_user)
+    index_username(new_user)
     db.session.commit()
     
     email_sent = send_verification_email(new_user)
@@ -541,7 +2939,12 @@ def login():
         (User.username == identifier) | (User.email == identifier)
     ).first()
 
-    if user and user.check_password(password):
+    try:
+        password_ok = user is not None and user.check_password(password)
+    except PasswordHashBusy:
+        return password_busy_response()
+
+    if password_ok:
         if not user.is_verified:
             return jsonify({'success': False, 'message': 'Пожалуйста, подтвердите ваш email.'}), 403
             
@@ -599,7 +3002,10 @@ def reset_password():
     if not user:
         return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
     
-    user.set_password(new_password)
+    try:
+        user.set_password(new_password)
+    except PasswordHashBusy:
+        return password_busy_response()
     db.session.commit()
     
     return jsonify({'success': True, 'message': 'Пароль успешно изменен!'})
@@ -632,12 +3038,15 @@ def handle_send_poll(data):
     anonymous = bool(data.get('anonymous'))
     if not room_id or not question or not isinstance(options, list) or len(options) < 2:
         return
-    if not RoomParticipant.query.filter_by(user_id=sender_id, room_id=room_id).first():
+    if not is_room_member(sender_id, room_id):
+        return
+    option_texts = [str(o)[:100] for o in options if str(o).strip()]
+    if len(option_texts) < 2:
         return
-    # Формируем JSON контент опроса
+    # JSON в content сохраняем для совместимости, источник истины — таблицы poll/poll_option
     payload = {
         'question': question,
-        'options': [str(o)[:100] for o in options if str(o).strip()],
+        'options': option_texts,
         'multiple_choice': multiple_choice,
         'anonymous': anonymous
     }
@@ -647,7 +3056,14 @@ def handle_send_poll(data):
         content=json.dumps(payload, ensure_ascii=False),
         message_type='poll'
     )
+    new_message.poll = Poll(
+        question=question,
+        multiple_choice=multiple_choice,
+        anonymous=anonymous,
+        options=[PollOption(position=idx, text=text, vote_count=0) for idx, text in enumerate(option_texts)]
+    )
     db.session.add(new_message)
+    advance_sender_read_pointer(new_message)
     db.session.commit()
     socketio.emit('receive_message', new_message.to_dict(), room=str(room_id))
 
@@ -660,14 +3076,12 @@ def handle_vote_poll(data):
     if not message_id: return
     message = db.session.get(Message, message_id)
     if not message or message.message_type != 'poll': return
-    if not RoomParticipant.query.filter_by(user_id=user_id, room_id=message.room_id).first():
-        return
-    try:
-        payload = json.loads(message.content or '{}')
-        options = payload.get('options', [])
-        multiple_choice = bool(payload.get('multiple_choice'))
-    except Exception:
+    if not is_room_member(user_id, message.room_id):
         return
+    poll = message.poll
+    if not poll: return
+    option_count = len(poll.options)
+    multiple_choice = bool(poll.multiple_choice)
     # Нормализуем выбранные индексы
     if multiple_choice:
         if not isinstance(selected, list):
@@ -679,7 +3093,7 @@ def handle_vote_poll(data):
         except Exception:
             return
     # Ограничиваем диапазон
-    indices = [i for i in indices if 0 <= i < len(options)]
+    indices = [i for i in indices if 0 <= i < option_count]
     if not indices:
         return
     existing_votes = PollVote.query.filter_by(message_id=message_id, user_id=user_id).all()
@@ -693,23 +3107,23 @@ def handle_vote_poll(data):
         }, room=f"user_{user_id}")
         return
 
+    # Для одиночного выбора учитываем только первый индекс
+    new_indices = [indices[0]] if not multiple_choice else [i for i in indices if i not in existing_indices]
     added = False
-    if not multiple_choice:
-        # Для одиночного выбора учитываем только первый индекс
-        idx = indices[0]
-        db.session.add(PollVote(message_id=message_id, user_id=user_id, option_index=idx))
-        added = True
-    else:
-        for idx in indices:
-            if not PollVote.query.filter_by(message_id=message_id, user_id=user_id, option_index=idx).first():
+    if new_indices:
+        try:
+            for idx in new_indices:
                 db.session.add(PollVote(message_id=message_id, user_id=user_id, option_index=idx))
-                added = True
-
-    if added:
-        db.session.commit()
+                # Счетчик варианта увеличиваем в той же транзакции, что и вставку голоса
+                PollOption.query.filter_by(message_id=message_id, position=idx).update(
+                    {PollOption.vote_count: PollOption.vote_count + 1}, synchronize_session=False)
+            db.session.commit()
+            added = True
+        except Exception:
+            # Повторный голос из параллельного запроса отсекается уникальным ключом
+            db.session.rollback()
 
-    user_votes = PollVote.query.filter_by(message_id=message_id, user_id=user_id).all()
-    selected_indices = sorted(vote.option_index for vote in user_votes)
+    selected_indices = sorted(set(existing_indices) | set(new_indices)) if added else sorted(existing_indices)
 
     emit('poll_vote_ack', {
         'message_id': message_id,
@@ -718,7 +3132,8 @@ def handle_vote_poll(data):
     }, room=f"user_{user_id}")
 
     if added:
-        socketio.emit('poll_updated', {'message_id': message_id, 'poll': message.to_dict().get('poll')}, room=str(message.room_id))
+        # Итоговые счетчики уйдут в комнату одним poll_updated за окно слияния
+        COALESCER.state('poll_updated', str(message.room_id), message_id)
 
 @app.route('/api/poll_vote/<int:message_id>', methods=['GET'])
 def get_poll_vote(message_id):
@@ -730,7 +3145,7 @@ def get_poll_vote(message_id):
     if not message or message.message_type != 'poll':
         return jsonify({'success': False, 'selected': []}), 404
 
-    if not RoomParticipant.query.filter_by(user_id=user_id, room_id=message.room_id).first():
+    if not is_room_member(user_id, message.room_id):
         return jsonify({'error': 'Access denied'}), 403
 
     votes = PollVote.query.filter_by(message_id=message_id, user_id=user_id).all()
@@ -748,15 +3163,15 @@ def get_thread(message_id):
     if not root_message:
         return jsonify({'success': False, 'message': 'Сообщение не найдено'}), 404
 
-    participant = RoomParticipant.query.filter_by(user_id=user_id, room_id=root_message.room_id).first()
-    if not participant:
+    if not is_room_member(user_id, root_message.room_id):
         return jsonify({'error': 'Forbidden'}), 403
 
     comments = Message.query.filter_by(room_id=root_message.room_id, thread_root_id=message_id).order_by(Message.timestamp.asc()).all()
+    serialized = serialize_messages([root_message] + comments, viewer_id=user_id)
     return jsonify({
         'success': True,
-        'thread': root_message.to_dict(),
-        'comments': [comment.to_dict() for comment in comments]
+        'thread': serialized[0],
+        'comments': serialized[1:]
     })
 # --- API Блокировок и Контактов (неизвестные/запросы) ---
 @app.route('/api/block_user', methods=['POST'])
@@ -769,6 +3184,7 @@ def block_user():
     if not BlockedUser.query.filter_by(blocker_id=user_id, blocked_id=target_id).first():
         db.session.add(BlockedUser(blocker_id=user_id, blocked_id=target_id))
         db.session.commit()
+    invalidate_block(user_id, target_id)
     return jsonify({'success': True, 'message': 'Пользователь заблокирован.'})
 
 @app.route('/api/unblock_user', methods=['POST'])
@@ -778,34 +3194,109 @@ def unblock_user():
     user_id = session['user_id']
     BlockedUser.query.filter_by(blocker_id=user_id, blocked_id=target_id).delete()
     db.session.commit()
+    invalidate_block(user_id, target_id)
     return jsonify({'success': True})
 # --- API Чата и Комнат ---
 @app.route('/api/chat_history/<int:room_id>', methods=['GET'])
 def chat_history(room_id):
     if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
     user_id = session['user_id']
-    if not RoomParticipant.query.filter_by(user_id=user_id, room_id=room_id).first():
+    if not is_room_member(user_id, room_id):
         return jsonify({'error': 'Access denied'}), 403
     # Если это dm и один из участников заблокирован — сообщения не показываем
-    room = db.session.get(Room, room_id)
-    if room and room.type == 'dm':
-        other_participant_entry = room.participants.filter(RoomParticipant.user_id != user_id).first()
-        if other_participant_entry:
-            other_id = other_participant_entry.user_id
-            if BlockedUser.query.filter_by(blocker_id=user_id, blocked_id=other_id).first():
-                return jsonify([])
-    messages = (Message.query
-                .filter(Message.room_id == room_id, Message.message_type.notin_(['poll_comment', 'comment']))
-                .order_by(Message.timestamp.asc())
-                .limit(100)
-                .all())
-    return jsonify([message.to_dict() for message in messages])
+    room_info = get_room_info(room_id)
+    if room_info and room_info['type'] == 'dm':
+        other_id = dm_peer_id(room_info, user_id)
+        if other_id and is_blocked(user_id, other_id):
+            return jsonify([])
+
+    # Курсорная пагинация по id: ?before=<id>, ?after=<id> или ?around=<id>, плюс ?limit=
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    anchors = {}
+    for key in ('before', 'after', 'around'):
+        value = request.args.get(key)
+        if value is None:
+            continue
+        try:
+            anchors[key] = int(value)
+        except (TypeError, ValueError):
+            return jsonify({'error': f'Некорректный параметр {key}'}), 400
+    if len(anchors) > 1:
+        return jsonify({'error': 'Укажите только один из параметров before, after, around'}), 400
+
+    base_query = Message.query.filter(
+        Message.room_id == room_id,
+        Message.message_type.notin_(['poll_comment', 'comment'])
+    )
+
+    def page_before(message_id, size, inclusive=False):
+        query = base_query
+        if message_id is not None:
+            query = query.filter(Message.id <= message_id if inclusive else Message.id < message_id)
+        rows = query.order_by(Message.id.desc()).limit(size + 1).all()
+        return list(reversed(rows[:size])), len(rows) > size
+
+    def page_after(message_id, size, inclusive=False):
+        query = base_query.filter(Message.id >= message_id if inclusive else Message.id > message_id)
+        rows = query.order_by(Message.id.asc()).limit(size + 1).all()
+        return rows[:size], len(rows) > size
+
+    if 'after' in anchors:
+        messages, has_more_after = page_after(anchors['after'], limit)
+        has_more_before = base_query.filter(Message.id <= anchors['after']).with_entities(Message.id).first() is not None
+    elif 'around' in anchors:
+        # Якорное сообщение попадает в страницу, остаток делится между сторонами
+        older, has_more_before = page_before(anchors['around'], limit // 2)
+        newer, has_more_after = page_after(anchors['around'], limit - len(older), inclusive=True)
+        messages = older + newer
+    else:
+        messages, has_more_before = page_before(anchors.get('before'), limit)
+        has_more_after = ('before' in anchors and
+                          base_query.filter(Message.id >= anchors['before']).with_entities(Message.id).first() is not None)
+
+    response = jsonify(serialize_messages(messages, viewer_id=user_id))
+    response.headers['X-Has-More-Before'] = '1' if has_more_before else '0'
+    response.headers['X-Has-More-After'] = '1' if has_more_after else '0'
+    return response
+
+_LINK_PATTERN = re.compile(r'https?://[^\s]+')
+
+@app.route('/api/room_stats/<int:room_id>', methods=['GET'])
+def room_stats(room_id):
+    """Счетчики окна сведений о комнате по всей истории: сообщения, медиа и ссылки"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    user_id = session['user_id']
+    if not is_room_member(user_id, room_id):
+        return jsonify({'error': 'Access denied'}), 403
+    # Те же сообщения, что отдает chat_history
+    room_info = get_room_info(room_id)
+    if room_info and room_info['type'] == 'dm':
+        other_id = dm_peer_id(room_info, user_id)
+        if other_id and is_blocked(user_id, other_id):
+            return jsonify({'success': True, 'messages': 0, 'media': 0, 'links': 0})
+
+    base_query = Message.query.filter(
+        Message.room_id == room_id,
+        Message.message_type.notin_(['poll_comment', 'comment'])
+    )
+    message_ids = base_query.with_entities(Message.id)
+    media_count = (MessageMedia.query.filter(MessageMedia.message_id.in_(message_ids)).count()
+                   + base_query.filter(Message.media_url.isnot(None)).count())
+    link_rows = base_query.filter(db.or_(Message.content.like('%http://%'), Message.content.like('%https://%')))
+    links_count = sum(len(_LINK_PATTERN.findall(content or ''))
+                      for content, in link_rows.with_entities(Message.content))
+    return jsonify({'success': True, 'messages': base_query.count(), 'media': media_count, 'links': links_count})
 
 @app.route('/api/room_members/<int:room_id>', methods=['GET'])
 def room_members(room_id):
     if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
     # Проверяем, что текущий пользователь состоит в комнате
-    if not RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first():
+    if not is_room_member(session['user_id'], room_id):
         return jsonify({'error': 'Access denied'}), 403
     participants = RoomParticipant.query.filter_by(room_id=room_id).all()
     result = []
@@ -836,7 +3327,10 @@ def create_room():
 
     db.session.commit()
     
+    invalidate_membership(new_room.id)
+    sync_member_room(user.id, new_room.id)
     for added_user in added_users:
+        sync_member_room(added_user.id, new_room.id)
         notify_user_about_new_room(added_user, new_room)
 
     return jsonify({'success': True, 'room': new_room.to_dict(user)}), 201
@@ -884,19 +3378,24 @@ def add_room_members():
     room = participant.room
     if room.type == 'dm': return jsonify({'success': False}), 400
 
+    # Новые участники не получают всю прошлую историю как непрочитанную
+    last_message_id = latest_message_id(room_id)
     added_count = 0; added_users = []
     for member_id in member_ids:
         member_user = db.session.get(User, member_id)
         if member_user and user.get_contact(member_user):
             if not RoomParticipant.query.filter_by(user_id=member_id, room_id=room_id).first():
-                db.session.add(RoomParticipant(user_id=member_id, room_id=room_id, role='member'))
+                db.session.add(RoomParticipant(user_id=member_id, room_id=room_id, role='member',
+                                               last_read_message_id=last_message_id))
                 added_count += 1
                 added_users.append(member_user)
 
     db.session.commit()
     
     if added_count > 0:
+        invalidate_membership(room_id)
         for added_user in added_users:
+             sync_member_room(added_user.id, room.id)
              notify_user_about_new_room(added_user, room)
 
     return jsonify({'success': True, 'message': f'Добавлено участников: {added_count}.'})
@@ -939,6 +3438,7 @@ def manage_room_member():
         message = 'Участник удален из комнаты.'
 
     db.session.commit()
+    invalidate_membership(room_id, target_user_id)
 
     # Оповещаем всех в комнате об изменениях
     participants = RoomParticipant.query.filter_by(room_id=room_id).all()
@@ -947,6 +3447,7 @@ def manage_room_member():
 
     # Если пользователя удалили, ему нужно отправить отдельное событие
     if action == 'remove':
+        sync_member_room(target_user_id, room_id, joined=False)
         socketio.emit('removed_from_room', {'room_id': room_id}, room=f"user_{target_user_id}")
 
     return jsonify({'success': True, 'message': message})
@@ -975,18 +3476,34 @@ def delete_room():
     socketio.emit('room_deleted', {'room_id': room_id, 'room_name': room.name}, room=str(room_id))
     
     # Удаляем все связанные сущности: сообщения, реакции, участники
-    MessageReaction.query.join(Message).filter(Message.room_id == room_id).delete(synchronize_session=False)
-    MessageMedia.query.join(Message).filter(Message.room_id == room_id).delete(synchronize_session=False)
+    room_message_ids = db.select(Message.id).where(Message.room_id == room_id)
+    MessageReaction.query.filter(MessageReaction.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    MessageReactionCount.query.filter(MessageReactionCount.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    orphaned_media = release_media_blobs(room_message_ids)
+    MessageMedia.query.filter(MessageMedia.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    PollVote.query.filter(PollVote.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    PollOption.query.filter(PollOption.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    Poll.query.filter(Poll.message_id.in_(room_message_ids)).delete(synchronize_session=False)
+    unindex_room_messages(room_id)
     Message.query.filter_by(room_id=room_id).delete()
     RoomParticipant.query.filter_by(room_id=room_id).delete()
+    DirectMessagePair.query.filter_by(room_id=room_id).delete()
+    RoomDocument.query.filter_by(room_id=room_id).delete()
+    for upload in MediaUpload.query.filter_by(room_id=room_id).all():
+        discard_media_upload(upload)
+    DOCUMENTS.drop(room_id)
+    ROOM_SESSIONS.end(_as_int(room_id))
     
     # Наконец, удаляем саму комнату
     db.session.delete(room)
     db.session.commit()
+    remove_media_blob_files(orphaned_media)
+    invalidate_membership(room_id)
     
     # Закрываем комнаты у всех пользователей
     for user_id in participant_ids:
         socketio.close_room(str(room_id))
+    socketio.close_room(members_room(room_id))
 
     return jsonify({'success': True, 'message': f'Комната "{room.name}" успешно удалена.'})
 
@@ -1000,16 +3517,40 @@ def search_user():
     if not query or len(query) < 3:
          return jsonify({'success': False, 'message': 'Запрос должен быть длиннее 2 символов.'})
 
-    results = User.query.filter(
-        User.username.ilike(f'%{query}%'),
-        User.is_verified == True,
-        User.id != session['user_id']
-    ).limit(10).all()
+    results = search_users(query, session['user_id'])
     
     if not results: return jsonify({'success': False, 'message': 'Пользователь не найден.'})
         
     return jsonify({'success': True, 'results': [user.to_dict_profile() for user in results]})
 
+@app.route('/api/search_messages', methods=['GET'])
+def search_messages_api():
+    """Поиск по тексту сообщений во всех комнатах пользователя или в одной (room_id)"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    user_id = session['user_id']
+
+    if not message_search_ready():
+        return jsonify({'success': False, 'message': 'Поиск по сообщениям недоступен.'}), 503
+
+    match_query = build_match_query(request.args.get('q', '').strip())
+    if not match_query:
+        return jsonify({'success': False, 'message': 'Пустой запрос.'}), 400
+
+    room_id = request.args.get('room_id', type=int)
+    if room_id is not None and not is_room_member(user_id, room_id):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    before_id = request.args.get('before', type=int)
+    limit = request.args.get('limit', MESSAGE_SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGE_SEARCH_MAX_PAGE_SIZE))
+
+    results, has_more = search_messages(user_id, match_query, room_id=room_id, before_id=before_id, limit=limit)
+    return jsonify({
+        'success': True,
+        'results': results,
+        'next_before': results[-1]['message_id'] if has_more else None
+    })
+
 @app.route('/api/user/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """Получить информацию о пользователе (для аватарки и т.д.)"""
@@ -1094,7 +3635,7 @@ def start_dm():
     if not contact_user: return jsonify({'success': False, 'message': 'Неверный ID.'}), 400
 
     # Нельзя начинать ЛС если вы заблокировали пользователя
-    if BlockedUser.query.filter_by(blocker_id=current_user.id, blocked_id=contact_id).first():
+    if is_blocked(current_user.id, contact_id):
         return jsonify({'success': False, 'message': 'Пользователь заблокирован.'}), 403
 
     room = find_or_create_dm_room(current_user, contact_user)
@@ -1116,11 +3657,7 @@ def update_contact():
     contact_entry.custom_name = custom_name if custom_name else None
     db.session.commit()
     
-    room = Room.query.filter_by(type='dm').filter(
-        Room.participants.any(user_id=user.id)
-    ).filter(
-        Room.participants.any(user_id=contact_id)
-    ).first()
+    room = find_dm_room(user.id, contact_entry.contact_id)
     
     if room:
         socketio.emit('room_updated', room.to_dict(user), room=f"user_{user.id}")
@@ -1140,6 +3677,7 @@ def update_profile():
         if User.query.filter(User.username == new_username).first():
             return jsonify({'success': False, 'message': 'Это имя занято.'}), 409
         user.username = new_username
+        index_username(user)
 
     user.bio = new_bio[:200]
     if new_theme in ['dark', 'light', 'ocean', 'amoled']: user.theme = new_theme
@@ -1165,25 +3703,25 @@ def upload_avatar():
 
     filename = secure_filename(file.filename)
     name_base, ext = os.path.splitext(filename)
-    unique_name = f"u{session['user_id']}_{int(time.time())}{ext.lower()}"
+    unique_name = f"u{session['user_id']}_{int(time.time())}{uuid.uuid4().hex[:8]}{ext.lower()}"
     save_path = os.path.join(UPLOAD_AVATAR_DIR, unique_name)
     try:
         file.save(save_path)
     except Exception:
         return jsonify({'success': False, 'message': 'Не удалось сохранить файл.'}), 500
+    avatar_size = read_image_size(save_path)
+    if not avatar_size:
+        os.remove(save_path)
+        return jsonify({'success': False, 'message': 'Недопустимый формат изображения.'}), 400
 
     user = db.session.get(User, session['user_id'])
     # Удаляем предыдущий файл (если загружался через наше API)
-    try:
-        if user.avatar_url and user.avatar_url.startswith('/static/uploads/avatars/'):
-            old_path = user.avatar_url.lstrip('/')
-            if os.path.exists(old_path):
-                os.remove(old_path)
-    except Exception:
-        pass
+    new_avatar_url = f"/static/uploads/avatars/{unique_name}"
+    remove_avatar_files(user.avatar_url)
 
-    user.avatar_url = f"/static/uploads/avatars/{unique_name}"
+    user.avatar_url = new_avatar_url
     db.session.commit()
+    schedule_avatar_variant('user', user.id, user.avatar_url)
 
     # Обновляем DM-комнаты для отображения нового аватара у собеседников
     participant_entries = user.rooms.options(db.joinedload(RoomParticipant.room)).all()
@@ -1191,20 +3729,14 @@ def upload_avatar():
         if entry.room.type == 'dm':
             notify_room_update(entry.room)
 
-    return jsonify({'success': True, 'avatar_url': user.avatar_url})
+    return jsonify({'success': True, 'avatar_url': user.avatar_url, 'width': avatar_size[0], 'height': avatar_size[1]})
 
 @app.route('/api/remove_avatar', methods=['POST'])
 def remove_avatar():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     user = db.session.get(User, session['user_id'])
-    try:
-        if user.avatar_url and user.avatar_url.startswith('/static/uploads/avatars/'):
-            old_path = user.avatar_url.lstrip('/')
-            if os.path.exists(old_path):
-                os.remove(old_path)
-    except Exception:
-        pass
+    remove_avatar_files(user.avatar_url)
     user.avatar_url = None
     db.session.commit()
 
@@ -1248,30 +3780,30 @@ def upload_room_avatar():
 
     filename = secure_filename(file.filename)
     name_base, ext = os.path.splitext(filename)
-    unique_name = f"room{room_id}_{int(time.time())}{ext.lower()}"
+    unique_name = f"room{room_id}_{int(time.time())}{uuid.uuid4().hex[:8]}{ext.lower()}"
     save_path = os.path.join(UPLOAD_AVATAR_DIR, unique_name)
     
     try:
         file.save(save_path)
     except Exception:
         return jsonify({'success': False, 'message': 'Не удалось сохранить файл.'}), 500
+    avatar_size = read_image_size(save_path)
+    if not avatar_size:
+        os.remove(save_path)
+        return jsonify({'success': False, 'message': 'Недопустимый формат изображения.'}), 400
 
     # Удаляем предыдущий файл аватара
-    try:
-        if room.avatar_url and room.avatar_url.startswith('/static/uploads/avatars/'):
-            old_path = room.avatar_url.lstrip('/')
-            if os.path.exists(old_path):
-                os.remove(old_path)
-    except Exception:
-        pass
+    new_avatar_url = f"/static/uploads/avatars/{unique_name}"
+    remove_avatar_files(room.avatar_url)
 
-    room.avatar_url = f"/static/uploads/avatars/{unique_name}"
+    room.avatar_url = new_avatar_url
     db.session.commit()
+    schedule_avatar_variant('room', room.id, room.avatar_url)
 
     # Уведомляем всех участников об обновлении
     notify_room_update(room)
 
-    return jsonify({'success': True, 'avatar_url': room.avatar_url})
+    return jsonify({'success': True, 'avatar_url': room.avatar_url, 'width': avatar_size[0], 'height': avatar_size[1]})
 
 @app.route('/api/remove_room_avatar', methods=['POST'])
 def remove_room_avatar():
@@ -1294,13 +3826,7 @@ def remove_room_avatar():
         return jsonify({'success': False, 'message': 'Комната не найдена или это личный чат.'}), 404
     
     # Удаляем файл аватара
-    try:
-        if room.avatar_url and room.avatar_url.startswith('/static/uploads/avatars/'):
-            old_path = room.avatar_url.lstrip('/')
-            if os.path.exists(old_path):
-                os.remove(old_path)
-    except Exception:
-        pass
+    remove_avatar_files(room.avatar_url)
     
     room.avatar_url = None
     db.session.commit()
@@ -1316,29 +3842,28 @@ def on_connect():
     if 'user_id' in session:
         user_id = session['user_id']
         join_room(f"user_{user_id}")
-        ONLINE_USERS.add(user_id)
-        SID_TO_USER[flask_request.sid] = user_id
+        PRESENCE.connect(flask_request.sid, user_id)
+        ensure_presence_flusher()
         # Принудительно переводим соединение в WebSocket для мобильных клиентов,
         # если сервер запустился в режиме с polling по умолчанию
         try:
             emit('noop')  # держим канал активным
         except Exception:
             pass
-        # Уведомляем участников его комнат о присутствии
-        entries = db.session.get(User, user_id).rooms.options(db.joinedload(RoomParticipant.room)).all()
-        for e in entries:
-            emit('presence_update', {'user_id': user_id, 'online': True}, room=str(e.room_id))
+        # Присутствие рассылает фоновая задача (_flush_presence), здесь только комнаты участников
+        for (room_id,) in db.session.query(RoomParticipant.room_id).filter(RoomParticipant.user_id == user_id):
+            join_room(members_room(room_id))
 
 @socketio.on('join')
 def on_join(data):
     if 'user_id' not in session: return
     user_id = session['user_id']; room_id = data['room_id']
-    if RoomParticipant.query.filter_by(user_id=user_id, room_id=room_id).first():
+    if is_room_member(user_id, room_id):
         join_room(str(room_id))
-        # Отправим текущее присутствие участников в комнате
-        participants = RoomParticipant.query.filter_by(room_id=room_id).all()
-        presence = {p.user_id: (p.user_id in ONLINE_USERS) for p in participants}
-        emit('room_presence_snapshot', {'room_id': room_id, 'presence': presence})
+        # Отправим текущее присутствие участников и активные доску/презентацию (из памяти)
+        presence = {member_id: PRESENCE.is_online(member_id) for member_id in get_room_member_ids(room_id)}
+        emit('room_presence_snapshot', {'room_id': room_id, 'presence': presence,
+                                        'sessions': ROOM_SESSIONS.get(_as_int(room_id))})
 
 @socketio.on('leave')
 def on_leave(data):
@@ -1350,24 +3875,26 @@ def handle_message(data):
     sender_id = session['user_id']; room_id = data['room_id']; content = data.get('content', '').strip()
     if not content: return
 
-    participant = RoomParticipant.query.filter_by(user_id=sender_id, room_id=room_id).first()
-    if not participant: return
-    room = participant.room
+    role = get_member_role(sender_id, room_id)
+    if role is None: return
+    room_id = int(room_id)
+    room_info = get_room_info(room_id)
+    if not room_info: return
 
     message_type = (data.get('message_type') or 'text').strip().lower()
 
-    if room.type == 'channel' and participant.role != 'admin':
+    if room_info['type'] == 'channel' and role != 'admin':
         if message_type not in ('comment', 'poll_comment'):
             return
 
     # Блок: запрещаем писать, если отправитель заблокировал получателя ИЛИ получатель заблокировал отправителя
-    if room.type == 'dm':
-        other_entry = room.participants.filter(RoomParticipant.user_id != sender_id).first()
-        if other_entry:
+    if room_info['type'] == 'dm':
+        other_id = dm_peer_id(room_info, sender_id)
+        if other_id:
             # Проверяем блокировку в обе стороны
-            if BlockedUser.query.filter_by(blocker_id=sender_id, blocked_id=other_entry.user_id).first():
+            if is_blocked(sender_id, other_id):
                 return  # Отправитель заблокировал получателя
-            if BlockedUser.query.filter_by(blocker_id=other_entry.user_id, blocked_id=sender_id).first():
+            if is_blocked(other_id, sender_id):
                 return  # Получатель заблокировал отправителя
 
     thread_root_id = data.get('thread_root_id')
@@ -1405,46 +3932,26 @@ def handle_message(data):
         content=content,
         message_type=message_type,
         thread_root_id=thread_root_id,
-        thread_type=thread_type
+        thread_type=thread_type,
+        timestamp=datetime.now()
     )
     db.session.add(new_message)
-    
-    # Увеличиваем счетчик непрочитанных для всех в комнате, кроме отправителя
-    other_participants = room.participants.filter(RoomParticipant.user_id != sender_id).all()
-    for p in other_participants:
-        unread_entry = UnreadMessage.query.filter_by(user_id=p.user_id, room_id=room_id).first()
-        if unread_entry:
-            unread_entry.count += 1
-        else:
-            db.session.add(UnreadMessage(user_id=p.user_id, room_id=room_id, count=1))
-
+    if root_message:
+        # Атомарно обновляем статистику треда в той же транзакции, что и вставку комментария
+        Message.query.filter_by(id=root_message.id).update({
+            Message.comment_count: Message.comment_count + 1,
+            Message.last_comment_at: new_message.timestamp
+        }, synchronize_session=False)
+    index_messages([new_message])
+    advance_sender_read_pointer(new_message)
     db.session.commit()
     message_dict = new_message.to_dict()
-    if new_message.thread_root_id:
-        try:
-            count_stmt = db.select(db.func.count()).select_from(Message).where(Message.thread_root_id == new_message.thread_root_id)
-            message_dict['thread_comment_count'] = db.session.execute(count_stmt).scalar() or 0
-        except Exception:
-            message_dict['thread_comment_count'] = 0
+    if root_message:
+        db.session.refresh(root_message)
+        message_dict['thread_comment_count'] = root_message.comment_count or 0
 
     # Отправляем сообщение и обновленный счетчик непрочитанных
-    for p in room.participants.all():
-        # Сам отправитель не получает обновление счетчика, у него всегда 0
-        if p.user_id == sender_id:
-            emit('receive_message', message_dict, room=f"user_{p.user_id}")
-            continue
-
-        unread_entry = UnreadMessage.query.filter_by(user_id=p.user_id, room_id=room_id).first()
-        unread_count = unread_entry.count if unread_entry else 0
-        
-        payload = {
-            'message': message_dict,
-            'unread_update': {
-                'room_id': room_id,
-                'count': unread_count
-            }
-        }
-        emit('receive_message_with_unread', payload, room=f"user_{p.user_id}")
+    fan_out_message(room_id, message_dict, sender_id)
 
     return message_dict
 
@@ -1461,16 +3968,17 @@ def mark_room_as_read():
     except (TypeError, ValueError):
         return jsonify({'success': False, 'message': 'Не указан ID комнаты.'}), 400
 
-    unread_entry = UnreadMessage.query.filter_by(user_id=user_id, room_id=room_id).first()
-    if unread_entry:
-        unread_entry.count = 0
-
-    # Фиксируем последний прочитанный идентификатор сообщения в комнате
-    last_message_id = db.session.execute(
-        db.select(db.func.max(Message.id)).where(Message.room_id == room_id)
-    ).scalar()
-
-    db.session.commit()
+    # Фиксируем последний прочитанный идентификатор сообщения в комнате.
+    # Указатель только растет: устаревший запрос не откатит прочтение назад.
+    last_message_id = latest_message_id(room_id)
+    if last_message_id:
+        RoomParticipant.query.filter(
+            RoomParticipant.user_id == user_id,
+            RoomParticipant.room_id == room_id,
+            db.or_(RoomParticipant.last_read_message_id.is_(None),
+                   RoomParticipant.last_read_message_id < last_message_id)
+        ).update({RoomParticipant.last_read_message_id: last_message_id}, synchronize_session=False)
+        db.session.commit()
 
     if last_message_id:
         payload = {
@@ -1482,6 +3990,22 @@ def mark_room_as_read():
 
     return jsonify({'success': True})
 
+@app.route('/api/read_receipts/<int:room_id>', methods=['GET'])
+def read_receipts(room_id):
+    """До какого сообщения прочитал комнату каждый участник"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not is_room_member(session['user_id'], room_id):
+        return jsonify({'error': 'Access denied'}), 403
+
+    rows = (db.session.query(RoomParticipant.user_id, RoomParticipant.last_read_message_id)
+            .filter(RoomParticipant.room_id == room_id, RoomParticipant.last_read_message_id.isnot(None))
+            .all())
+    receipts = [
+        {'room_id': room_id, 'reader_id': user_id, 'last_read_message_id': last_read}
+        for user_id, last_read in rows
+    ]
+    return jsonify({'success': True, 'receipts': receipts})
 
 @app.route('/api/send_voice', methods=['POST'])
 def send_voice():
@@ -1496,17 +4020,17 @@ def send_voice():
         return jsonify({'success': False, 'message': 'Не указана комната или файл'}), 400
     
     # Проверяем доступ к комнате
-    participant = RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first()
-    if not participant:
+    if not is_room_member(session['user_id'], room_id):
         return jsonify({'success': False, 'message': 'Вы не участник этой комнаты'}), 403
     
     try:
         # Сохраняем аудиофайл
-        filename = secure_filename(f"voice_{session['user_id']}_{int(time.time())}.webm")
+        filename = secure_filename(f"voice_{session['user_id']}_{int(time.time())}_{uuid.uuid4().hex[:8]}.webm")
         filepath = os.path.join(UPLOAD_MEDIA_DIR, filename)
         audio_file.save(filepath)
         
         media_url = f"/static/uploads/media/{filename}"
+        media_meta = describe_media_file(filepath, filename, audio_file.mimetype, 'audio')
         
         # Создаем сообщение
         new_message = Message(
@@ -1515,9 +4039,13 @@ def send_voice():
             content='🎤 Голосовое сообщение',
             media_url=media_url,
             media_type='audio',
-            message_type='voice'
+            message_type='voice',
+            media_original_name=media_meta['original_name'],
+            media_mime_type=media_meta['mime_type'],
+            media_file_size=media_meta['file_size']
         )
         db.session.add(new_message)
+        advance_sender_read_pointer(new_message)
         db.session.commit()
         
         # Отправляем через Socket.IO
@@ -1545,101 +4073,203 @@ def send_media():
             
         room_id = int(room_id_str)
         
-        participant = RoomParticipant.query.filter_by(user_id=sender_id, room_id=room_id).first()
-        if not participant:
-            return jsonify({'success': False, 'message': 'Нет доступа к комнате.'}), 403
-        
-        room = participant.room
-        if room.type == 'channel' and participant.role != 'admin':
-            return jsonify({'success': False, 'message': 'Нет прав для отправки в канал.'}), 403
-        
-        if room.type == 'dm':
-            other_entry = room.participants.filter(RoomParticipant.user_id != sender_id).first()
-            if other_entry and BlockedUser.query.filter_by(blocker_id=sender_id, blocked_id=other_entry.user_id).first():
-                return jsonify({'success': False, 'message': 'Пользователь заблокирован.'}), 403
+        denied = media_send_denied(sender_id, room_id)
+        if denied:
+            return jsonify({'success': False, 'message': denied}), 403
         
         # Создаем одно сообщение
         new_message = Message(room_id=room_id, sender_id=sender_id, content=caption)
         db.session.add(new_message)
         
         media_items_added = []
+        stored_urls = []
         
         for file in files:
             if not file or not file.filename:
                 continue
 
-            filename = secure_filename(file.filename)
-            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+            ext = upload_extension(file.filename)
 
-            if ext in ALLOWED_IMAGE_EXTENSIONS:
-                media_type = 'image'
-            elif ext in ALLOWED_VIDEO_EXTENSIONS:
-                media_type = 'video'
-            else:
-                media_type = 'file'
-
-            unique_name = f"m{sender_id}_{int(time.time())}_{filename}"
-            save_path = os.path.join(UPLOAD_MEDIA_DIR, unique_name)
-
-            # Ограничим размер файла вручную на случай отсутствия Content-Length
-            file.seek(0, os.SEEK_END)
-            size = file.tell()
-            file.seek(0)
-            if size > MAX_FILE_SIZE:
+            # Размер ограничивается по ходу записи (Content-Length может отсутствовать)
+            try:
+                blob, reused = store_media_upload(file.stream, ext)
+            except MediaTooLargeError:
+                db.session.rollback()
+                # Файлы, впервые сохраненные этим запросом, после отката ни на что не ссылаются
+                remove_media_blob_files(stored_urls)
                 return jsonify({'success': False, 'message': 'Файл слишком большой.'}), 413
+            if not reused:
+                stored_urls.append(blob.url)
 
-            file.save(save_path)
-            
-            media_url = f"/static/uploads/media/{unique_name}"
-            
-            media_item = MessageMedia(
-                message=new_message,
-                url=media_url,
-                type=media_type
-            )
-            media_items_added.append(media_item)
+            media_items_added.append(attach_media_item(new_message, blob, reused, file.filename, file.mimetype))
 
         if not media_items_added and not caption:
             return jsonify({'success': False, 'message': 'Нет контента для отправки'}), 400
 
-        if media_items_added:
-            db.session.add_all(media_items_added)
+        message_dict = publish_media_message(new_message, media_items_added)
+        return jsonify({'success': True, 'message': message_dict})
 
-        # Увеличиваем счетчик непрочитанных
-        other_participants = room.participants.filter(RoomParticipant.user_id != sender_id).all()
-        for p in other_participants:
-            unread_entry = UnreadMessage.query.filter_by(user_id=p.user_id, room_id=room_id).first()
-            if unread_entry:
-                unread_entry.count += 1
-            else:
-                db.session.add(UnreadMessage(user_id=p.user_id, room_id=room_id, count=1))
+    except Exception as e:
+        import traceback
+        app.logger.error(f"Error in /api/send_media: {e}\n{traceback.format_exc()}")
+        return jsonify({'success': False, 'message': 'Внутренняя ошибка сервера.'}), 500
 
-        db.session.commit()
-        
-        message_dict = new_message.to_dict()
-        
-        # Отправляем сообщение и обновленный счетчик непрочитанных (через socketio.emit из HTTP контекста)
-        for p in room.participants.all():
-            if p.user_id == sender_id:
-                socketio.emit('receive_message', message_dict, room=f"user_{p.user_id}")
-                continue
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Начало загрузки по частям: {room_id, filename, size, mime_type} -> upload_id"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    try:
+        room_id = int(data.get('room_id'))
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Неверные параметры загрузки.'}), 400
+    filename = (data.get('filename') or '').strip()[:255]
+    if not filename or size < 0:
+        return jsonify({'success': False, 'message': 'Неверные параметры загрузки.'}), 400
+    if size > MAX_FILE_SIZE:
+        return jsonify({'success': False, 'message': 'Файл слишком большой.'}), 413
+
+    denied = media_send_denied(user_id, room_id)
+    if denied:
+        return jsonify({'success': False, 'message': denied}), 403
+
+    expire_media_uploads()
+    if MediaUpload.query.filter_by(user_id=user_id).count() >= UPLOAD_SESSIONS_PER_USER:
+        return jsonify({'success': False, 'message': 'Слишком много незавершенных загрузок.'}), 429
+
+    upload = MediaUpload(id=uuid.uuid4().hex, user_id=user_id, room_id=room_id, filename=filename,
+                         mime_type=(data.get('mime_type') or None), size=size)
+    open(media_tmp_path(upload.id), 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify({'success': True, 'upload_id': upload.id, 'offset': 0, 'size': size,
+                    'chunk_size': UPLOAD_CHUNK_MAX})
+
+def get_own_upload(upload_id):
+    upload = db.session.get(MediaUpload, upload_id)
+    if upload is None or upload.user_id != session['user_id']:
+        return None
+    return upload
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Подтвержденное смещение: с него клиент продолжает после обрыва"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    upload = get_own_upload(upload_id)
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Загрузка не найдена.'}), 404
+    return jsonify({'success': True, 'upload_id': upload.id, 'offset': upload.received, 'size': upload.size})
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Часть файла в теле запроса, позиция — в Content-Range: bytes <start>-<end>/<size>"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    upload = get_own_upload(upload_id)
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Загрузка не найдена.'}), 404
+
+    content_range = parse_content_range(request.headers.get('Content-Range'))
+    if content_range is None or content_range[2] != upload.size:
+        return jsonify({'success': False, 'message': 'Неверный Content-Range.', 'offset': upload.received}), 400
+    start, end, _ = content_range
+    length = end - start + 1
+    if length > UPLOAD_CHUNK_MAX:
+        return jsonify({'success': False, 'message': 'Слишком большая часть.', 'offset': upload.received}), 413
+    if request.content_length != length:
+        return jsonify({'success': False, 'message': 'Длина тела не совпадает с Content-Range.',
+                        'offset': upload.received}), 400
+    if start != upload.received:
+        # Часть уже принята или пропущена — клиент продолжает с подтвержденного смещения
+        return jsonify({'success': False, 'message': 'Неверное смещение.', 'offset': upload.received}), 409
 
-            unread_entry = UnreadMessage.query.filter_by(user_id=p.user_id, room_id=room_id).first()
-            unread_count = unread_entry.count if unread_entry else 0
-            
-            payload = {
-                'message': message_dict,
-                'unread_update': { 'room_id': room_id, 'count': unread_count }
-            }
-            socketio.emit('receive_message_with_unread', payload, room=f"user_{p.user_id}")
-        
-        return jsonify({'success': True, 'message': message_dict})
+    try:
+        offset = append_upload_chunk(upload, start, length, request.stream)
+    except ClientDisconnected:
+        return jsonify({'success': False, 'message': 'Часть получена не полностью.', 'offset': upload.received}), 400
+
+    # Условие на received отсекает параллельную запись той же части
+    updated = db.session.execute(
+        db.update(MediaUpload)
+        .where(MediaUpload.id == upload.id, MediaUpload.received == start)
+        .values(received=offset, updated_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    if not updated:
+        db.session.refresh(upload)
+        return jsonify({'success': False, 'message': 'Неверное смещение.', 'offset': upload.received}), 409
+    return jsonify({'success': True, 'offset': offset, 'size': upload.size})
 
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    upload = get_own_upload(upload_id)
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Загрузка не найдена.'}), 404
+    discard_media_upload(upload)
+    db.session.commit()
+    return jsonify({'success': True})
+
+@app.route('/api/uploads/complete', methods=['POST'])
+def complete_uploads():
+    """Завершает загрузки и отправляет их одним сообщением: {room_id, caption, upload_ids}"""
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    sender_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    upload_ids = data.get('upload_ids') or []
+    caption = (data.get('caption') or '').strip()
+    try:
+        room_id = int(data.get('room_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'ID комнаты отсутствует.'}), 400
+    if not isinstance(upload_ids, list) or not upload_ids:
+        return jsonify({'success': False, 'message': 'Нет загрузок для отправки.'}), 400
+
+    uploads = {upload.id: upload for upload in
+               MediaUpload.query.filter(MediaUpload.id.in_([str(upload_id) for upload_id in upload_ids]),
+                                        MediaUpload.user_id == sender_id, MediaUpload.room_id == room_id)}
+    if len(uploads) != len(set(upload_ids)):
+        return jsonify({'success': False, 'message': 'Загрузка не найдена.'}), 404
+    incomplete = {upload.id: upload.received for upload in uploads.values() if upload.received != upload.size}
+    if incomplete:
+        return jsonify({'success': False, 'message': 'Загрузка не завершена.', 'offsets': incomplete}), 409
+
+    denied = media_send_denied(sender_id, room_id)
+    if denied:
+        return jsonify({'success': False, 'message': denied}), 403
+
+    new_message = Message(room_id=room_id, sender_id=sender_id, content=caption)
+    db.session.add(new_message)
+    media_items_added = []
+    stored_urls = []
+    try:
+        for upload_id in dict.fromkeys(upload_ids):
+            upload = uploads[upload_id]
+            ext = upload_extension(upload.filename)
+            # Часть остается на месте до commit: при ошибке строка загрузки откатывается вместе с ней
+            blob, reused = commit_media_blob(media_tmp_path(upload.id), upload_digest(upload), upload.size,
+                                             f".{ext}" if ext else '', keep_source=True)
+            if not reused:
+                stored_urls.append(blob.url)
+            media_items_added.append(attach_media_item(new_message, blob, reused, upload.filename, upload.mime_type))
+            db.session.delete(upload)
+        message_dict = publish_media_message(new_message, media_items_added)
     except Exception as e:
+        db.session.rollback()
+        remove_media_blob_files(stored_urls)
         import traceback
-        app.logger.error(f"Error in /api/send_media: {e}\n{traceback.format_exc()}")
+        app.logger.error(f"Error in /api/uploads/complete: {e}\n{traceback.format_exc()}")
         return jsonify({'success': False, 'message': 'Внутренняя ошибка сервера.'}), 500
 
+    # Части остались во временном каталоге: содержимое уже в хранилище или совпало с сохраненным
+    for upload in uploads.values():
+        try:
+            os.remove(media_tmp_path(upload.id))
+        except OSError:
+            pass
+    return jsonify({'success': True, 'message': message_dict})
+
 
 @socketio.on('react_to_message')
 def handle_reaction(data):
@@ -1653,26 +4283,87 @@ def handle_reaction(data):
     message = db.session.get(Message, message_id)
     if not message: return
     
-    if not RoomParticipant.query.filter_by(user_id=user_id, room_id=message.room_id).first(): return
+    if not is_room_member(user_id, message.room_id): return
 
+    changed = False
     if action == 'add':
-        try:
-            db.session.add(MessageReaction(message_id=message_id, user_id=user_id, emoji=emoji))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
+        # Вторая попытка нужна, если параллельный запрос первым создал строку счетчика
+        for _ in range(2):
+            try:
+                db.session.add(MessageReaction(message_id=message_id, user_id=user_id, emoji=emoji))
+                db.session.flush()
+                bump_reaction_count(message_id, emoji, 1)
+                db.session.commit()
+                changed = True
+                break
+            except IntegrityError:
+                db.session.rollback()
             
     elif action == 'remove':
-        MessageReaction.query.filter_by(message_id=message_id, user_id=user_id, emoji=emoji).delete()
+        deleted = MessageReaction.query.filter_by(message_id=message_id, user_id=user_id, emoji=emoji).delete()
+        if deleted:
+            bump_reaction_count(message_id, emoji, -deleted)
+            changed = True
         db.session.commit()
 
-    updated_message = db.session.get(Message, message_id)
-    
+    # Автору — сразу, с действием ("моя ли реакция" клиент вычисляет сам);
+    # комнате — только итоговые счетчики, одно событие на сообщение за окно слияния
     update_data = {
         'message_id': message_id,
-        'reactions': updated_message.get_reactions_summary()
+        'reactions': message.get_reactions_summary(),
+        'user_id': user_id,
+        'emoji': emoji,
+        'action': action if changed else None
     }
-    emit('update_reactions', update_data, room=str(message.room_id))
+    emit('update_reactions', update_data, room=f"user_{user_id}")
+    if changed:
+        COALESCER.state('update_reactions', str(message.room_id), message_id)
+
+@app.route('/api/reactions/<int:message_id>', methods=['GET'])
+def list_reactors(message_id):
+    """Постраничный список поставивших реакции: ?emoji=&after=<user_id>&limit="""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    message = db.session.get(Message, message_id)
+    if not message:
+        return jsonify({'success': False, 'message': 'Сообщение не найдено'}), 404
+    if not is_room_member(session['user_id'], message.room_id):
+        return jsonify({'error': 'Access denied'}), 403
+
+    emoji = request.args.get('emoji')
+    try:
+        after = int(request.args.get('after', 0))
+        limit = max(1, min(int(request.args.get('limit', REACTORS_PAGE_SIZE)), REACTORS_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Некорректные параметры'}), 400
+
+    base = MessageReaction.query.filter(MessageReaction.message_id == message_id, MessageReaction.user_id > after)
+    if emoji:
+        base = base.filter(MessageReaction.emoji == emoji)
+    user_ids = [row[0] for row in (base.with_entities(MessageReaction.user_id).distinct()
+                                   .order_by(MessageReaction.user_id).limit(limit + 1).all())]
+    has_more = len(user_ids) > limit
+    user_ids = user_ids[:limit]
+
+    emojis_by_user = {}
+    usernames = {}
+    if user_ids:
+        rows = (base.filter(MessageReaction.user_id.in_(user_ids))
+                .with_entities(MessageReaction.user_id, MessageReaction.emoji)
+                .order_by(MessageReaction.user_id, MessageReaction.emoji).all())
+        for reactor_id, reactor_emoji in rows:
+            emojis_by_user.setdefault(reactor_id, []).append(reactor_emoji)
+        usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)).all())
+
+    reactors = [
+        {'user_id': reactor_id, 'username': usernames.get(reactor_id), 'emojis': emojis_by_user.get(reactor_id, [])}
+        for reactor_id in user_ids
+    ]
+    return jsonify({
+        'success': True,
+        'reactors': reactors,
+        'next_after': user_ids[-1] if has_more else None
+    })
 
 @socketio.on('typing')
 def handle_typing(data):
@@ -1681,9 +4372,11 @@ def handle_typing(data):
     room_id = data.get('room_id')
     is_typing = bool(data.get('is_typing'))
     if not room_id: return
-    if not RoomParticipant.query.filter_by(user_id=user_id, room_id=room_id).first():
+    if not is_room_member(user_id, room_id):
         return
-    emit('typing', {'user_id': user_id, 'room_id': room_id, 'is_typing': is_typing}, room=str(room_id), include_self=False)
+    COALESCER.typing(str(room_id), user_id, is_typing,
+                     {'user_id': user_id, 'room_id': room_id, 'is_typing': is_typing},
+                     skip_sid=flask_request.sid)
 
 @socketio.on('edit_message')
 def handle_edit_message(data):
@@ -1695,11 +4388,12 @@ def handle_edit_message(data):
     msg = db.session.get(Message, message_id)
     if not msg: return
     # Разрешаем редактировать отправителю или админу комнаты
-    participant = RoomParticipant.query.filter_by(user_id=user_id, room_id=msg.room_id).first()
-    if not participant: return
-    if msg.sender_id != user_id and participant.role != 'admin':
+    role = get_member_role(user_id, msg.room_id)
+    if role is None: return
+    if msg.sender_id != user_id and role != 'admin':
         return
     msg.content = new_content
+    index_messages([msg])
     db.session.commit()
     payload = {'message_id': msg.id, 'content': msg.content}
     emit('message_edited', payload, room=str(msg.room_id))
@@ -1713,14 +4407,21 @@ def handle_delete_message(data):
     if not message_id: return
     msg = db.session.get(Message, message_id)
     if not msg: return
-    participant = RoomParticipant.query.filter_by(user_id=user_id, room_id=msg.room_id).first()
-    if not participant: return
-    if msg.sender_id != user_id and participant.role != 'admin':
+    role = get_member_role(user_id, msg.room_id)
+    if role is None: return
+    if msg.sender_id != user_id and role != 'admin':
         return
     room_id = msg.room_id
+    thread_root_id = msg.thread_root_id
+    orphaned_media = release_media_blobs([msg.id])
     db.session.delete(msg)
+    unindex_messages([message_id])
+    refresh_thread_stats([thread_root_id])
     db.session.commit()
+    remove_media_blob_files(orphaned_media)
     emit('message_deleted', {'message_id': message_id}, room=str(room_id))
+    for stats in thread_stats_payload([thread_root_id] if thread_root_id else []):
+        emit('thread_stats_updated', stats, room=str(room_id))
     return {'success': True}
 
 @socketio.on('delete_messages')
@@ -1732,6 +4433,7 @@ def handle_delete_messages(data):
     if not message_ids: return
 
     deleted_ids = []
+    affected_roots = set()
     room_id_to_notify = None
 
     for msg_id in message_ids:
@@ -1742,11 +4444,21 @@ def handle_delete_messages(data):
                 room_id_to_notify = msg.room_id
             
             deleted_ids.append(msg_id)
-            db.session.delete(msg)
+            if msg.thread_root_id:
+                affected_roots.add(msg.thread_root_id)
 
     if deleted_ids:
+        # Ссылки снимаются до удаления: вместе с сообщениями уходят и строки message_media
+        orphaned_media = release_media_blobs(deleted_ids)
+        for msg_id in deleted_ids:
+            db.session.delete(db.session.get(Message, msg_id))
+        unindex_messages(deleted_ids)
+        refresh_thread_stats(affected_roots)
         db.session.commit()
+        remove_media_blob_files(orphaned_media)
         emit('messages_deleted', {'message_ids': deleted_ids}, room=str(room_id_to_notify))
+        for stats in thread_stats_payload(affected_roots):
+            emit('thread_stats_updated', stats, room=str(stats['room_id']))
     
     return {'success': True, 'deleted_count': len(deleted_ids)}
 
@@ -1796,7 +4508,7 @@ def handle_room_call_action(data):
     if not room_id or not action_type: return
 
     # Проверяем, что пользователь в комнате
-    if not RoomParticipant.query.filter_by(user_id=sender_id, room_id=room_id).first():
+    if not is_room_member(sender_id, room_id):
         return
 
     sender_name = 'Unknown'
@@ -1856,7 +4568,7 @@ def handle_system_message(data):
     if not room_id or not content: return
     
     # Проверяем доступ к комнате
-    if not RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first():
+    if not is_room_member(session['user_id'], room_id):
         return
     
     # Создаем системное сообщение от текущего пользователя
@@ -1868,6 +4580,7 @@ def handle_system_message(data):
         call_duration=call_duration
     )
     db.session.add(new_message)
+    advance_sender_read_pointer(new_message)
     db.session.commit()
     
     # Отправляем всем участникам
@@ -1882,16 +4595,15 @@ def handle_whiteboard_session(data):
     if 'user_id' not in session:
         return
 
-    room_id = data.get('room_id')
+    room_id = _as_int(data.get('room_id'))
     board_url = data.get('board_url')
     if not room_id or not board_url:
         return
 
-    participant = RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first()
-    if not participant:
+    if not is_room_member(session['user_id'], room_id):
         return
 
-    user = User.query.get(session['user_id'])
+    user = db.session.get(User, session['user_id'])
     payload = {
         'room_id': room_id,
         'board_url': board_url,
@@ -1901,41 +4613,99 @@ def handle_whiteboard_session(data):
         'created_at': data.get('created_at') or int(time.time() * 1000)
     }
 
+    ROOM_SESSIONS.set(room_id, 'whiteboard', payload)
     emit('whiteboard_session', payload, room=str(room_id), include_self=False)
 
+@socketio.on('whiteboard_session_end')
+def handle_whiteboard_session_end(data):
+    """Завершение совместной доски: новые участники ее больше не получают"""
+    if 'user_id' not in session: return
+    room_id = _as_int(data.get('room_id'))
+    if not room_id or not is_room_member(session['user_id'], room_id):
+        return
+    ROOM_SESSIONS.end(room_id, 'whiteboard')
+    emit('whiteboard_session_end', {'room_id': room_id}, room=str(room_id), include_self=False)
+
+def _apply_document_op(room_id, user_id, base_version, op, op_id=None):
+    """Применяет операцию и рассылает дельту всей комнате (отправителю — как подтверждение)"""
+    def publish(version, applied):
+        socketio.emit('document_delta', {'room_id': room_id, 'version': version, 'op': applied,
+                                         'user_id': user_id, 'op_id': op_id}, room=str(room_id))
+    try:
+        version, _ = DOCUMENTS.apply(room_id, base_version, op, publish)
+    except DocumentStaleError:
+        emit('document_resync', {'room_id': room_id})
+        return {'success': False, 'resync': True}
+    except ValueError:
+        return {'success': False, 'message': 'Документ слишком большой'}
+    return {'success': True, 'version': version}
+
+@socketio.on('document_sync')
+def handle_document_sync(data):
+    """Снимок совместного документа и операции после него для нового участника"""
+    if 'user_id' not in session: return
+    room_id = _as_int((data or {}).get('room_id'))
+    if not room_id or not is_room_member(session['user_id'], room_id):
+        return {'success': False}
+    return dict(DOCUMENTS.snapshot(room_id), success=True, room_id=room_id)
+
+@socketio.on('document_op')
+def handle_document_op(data):
+    """Правка совместного документа: операция по версии version"""
+    if 'user_id' not in session: return
+    room_id = _as_int((data or {}).get('room_id'))
+    op = parse_document_op(data.get('op')) if room_id else None
+    if not op or not is_room_member(session['user_id'], room_id):
+        return {'success': False}
+    return _apply_document_op(room_id, session['user_id'], _as_int(data.get('version')), op, data.get('op_id'))
+
 @socketio.on('document_update')
 def handle_document_update(data):
-    """Синхронизация совместного документа"""
+    """Старый протокол: полный текст документа превращается в одну операцию по текущей версии"""
     if 'user_id' not in session: return
     
-    room_id = data.get('room_id')
+    room_id = _as_int(data.get('room_id'))
     content = data.get('content', '')
     
-    if not room_id: return
+    if not room_id or not isinstance(content, str): return
     
     # Проверяем доступ к комнате
-    if not RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first():
+    if not is_room_member(session['user_id'], room_id):
         return
     
-    # Отправляем всем участникам кроме отправителя
-    emit('document_update', {'content': content}, room=str(room_id), include_self=False)
+    current, version = DOCUMENTS.current(room_id)
+    op = diff_document(current, content)
+    if op:
+        return _apply_document_op(room_id, session['user_id'], version, op)
 
 @socketio.on('presentation_slide_change')
 def handle_presentation_slide_change(data):
     """Синхронизация смены слайдов презентации"""
     if 'user_id' not in session: return
     
-    room_id = data.get('room_id')
-    slide_index = data.get('slide_index', 0)
+    room_id = _as_int(data.get('room_id'))
+    slide_index = _as_int(data.get('slide_index', 0)) or 0
     
     if not room_id: return
     
     # Проверяем доступ к комнате
-    if not RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=room_id).first():
+    if not is_room_member(session['user_id'], room_id):
         return
     
-    # Отправляем всем участникам кроме отправителя
-    emit('presentation_slide_change', {'slide_index': slide_index}, room=str(room_id), include_self=False)
+    ROOM_SESSIONS.set(room_id, 'presentation', {'slide_index': slide_index, 'presenter_id': session['user_id']})
+    # Отправляем всем участникам кроме отправителя; в окне слияния побеждает последний слайд
+    COALESCER.latest('presentation_slide_change', str(room_id), 'slide',
+                     {'slide_index': slide_index}, skip_sid=flask_request.sid)
+
+@socketio.on('presentation_end')
+def handle_presentation_end(data):
+    """Ведущий закрыл презентацию"""
+    if 'user_id' not in session: return
+    room_id = _as_int(data.get('room_id'))
+    if not room_id or not is_room_member(session['user_id'], room_id):
+        return
+    ROOM_SESSIONS.end(room_id, 'presentation')
+    emit('presentation_end', {'room_id': room_id}, room=str(room_id), include_self=False)
 
 @socketio.on('update_call_card')
 def handle_update_call_card(data):
@@ -1953,7 +4723,7 @@ def handle_update_call_card(data):
     if not message or message.message_type != 'call': return
     
     # Проверяем доступ
-    if not RoomParticipant.query.filter_by(user_id=session['user_id'], room_id=message.room_id).first():
+    if not is_room_member(session['user_id'], message.room_id):
         return
     
     # Обновляем длительность
@@ -1969,17 +4739,8 @@ def handle_update_call_card(data):
 
 @socketio.on('disconnect')
 def on_disconnect():
-    sid = flask_request.sid
-    user_id = SID_TO_USER.pop(sid, None)
-    if user_id and user_id in ONLINE_USERS:
-        ONLINE_USERS.discard(user_id)
-        # Уведомляем участников его комнат
-        try:
-            entries = db.session.get(User, user_id).rooms.options(db.joinedload(RoomParticipant.room)).all()
-            for e in entries:
-                emit('presence_update', {'user_id': user_id, 'online': False}, room=str(e.room_id))
-        except Exception:
-            pass
+    # Офлайн публикуется с задержкой, если у пользователя не осталось других соединений
+    PRESENCE.disconnect(flask_request.sid)
 
 # --- Технический маршрут: подавление 404 от Chrome DevTools ---
 @app.route('/.well-known/appspecific/com.chrome.devtools.json', methods=['GET'])
@@ -1991,7 +4752,8 @@ def chrome_devtools_probe():
 def favicon():
     return ('', 204)
 
-if __name__ == '__main__':
+def migrate_database():
+    """Создает таблицы и доводит схему существующей БД до текущей версии"""
     with app.app_context():
        db.create_all()
        # Добавляем недостающие столбцы (SQLite)
@@ -2014,6 +4776,16 @@ if __name__ == '__main__':
            inspector = db.inspect(db.engine)
            if not inspector.has_table('message_media'):
                 MessageMedia.__table__.create(db.engine)
+           # Метаданные вложений; существующие строки заполняет backfill_media_metadata.py
+           media_columns = {row[1] for row in db.session.execute(text("PRAGMA table_info(message_media)")).fetchall()}
+           for column, ddl in (('original_name', 'VARCHAR(255)'), ('mime_type', 'VARCHAR(120)'),
+                               ('file_size', 'INTEGER'), ('width', 'INTEGER'), ('height', 'INTEGER'),
+                               ('thumbnail_url', 'VARCHAR(512)'), ('preview_url', 'VARCHAR(512)'),
+                               ('digest', 'VARCHAR(64) REFERENCES media_blob (digest)')):
+               if column not in media_columns:
+                   db.session.execute(text(f"ALTER TABLE message_media ADD COLUMN {column} {ddl}"))
+           db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_message_media_digest ON message_media (digest)"))
+           db.session.commit()
 
            if not has_media_url:
                db.session.execute(text("ALTER TABLE message ADD COLUMN media_url VARCHAR(512)"))
@@ -2027,6 +4799,42 @@ if __name__ == '__main__':
            if not has_thread_type:
                db.session.execute(text("ALTER TABLE message ADD COLUMN thread_type VARCHAR(20)"))
                db.session.commit()
+           # Метаданные файла media_url; раньше у голосовых их хранила лишняя строка message_media
+           if not any(row[1] == 'media_file_size' for row in msg_info):
+               db.session.execute(text("ALTER TABLE message ADD COLUMN media_original_name VARCHAR(255)"))
+               db.session.execute(text("ALTER TABLE message ADD COLUMN media_mime_type VARCHAR(120)"))
+               db.session.execute(text("ALTER TABLE message ADD COLUMN media_file_size INTEGER"))
+               voice_media = ("FROM message_media WHERE message_media.message_id = message.id "
+                              "AND message_media.url = message.media_url AND message_media.type = 'audio'")
+               db.session.execute(text(
+                   "UPDATE message SET "
+                   f"media_original_name = (SELECT original_name {voice_media}), "
+                   f"media_mime_type = (SELECT mime_type {voice_media}), "
+                   f"media_file_size = (SELECT file_size {voice_media}) "
+                   "WHERE message_type = 'voice'"
+               ))
+               db.session.execute(text(
+                   "DELETE FROM message_media WHERE type = 'audio' AND digest IS NULL AND EXISTS "
+                   "(SELECT 1 FROM message WHERE message.id = message_media.message_id "
+                   "AND message.message_type = 'voice' AND message.media_url = message_media.url)"
+               ))
+               db.session.commit()
+           # Статистика тредов на корневых сообщениях
+           if not any(row[1] == 'comment_count' for row in msg_info):
+               db.session.execute(text("ALTER TABLE message ADD COLUMN comment_count INTEGER DEFAULT 0 NOT NULL"))
+               db.session.execute(text("ALTER TABLE message ADD COLUMN last_comment_at DATETIME"))
+               db.session.execute(text(
+                   "UPDATE message SET "
+                   "comment_count = (SELECT COUNT(*) FROM message AS c WHERE c.thread_root_id = message.id), "
+                   "last_comment_at = (SELECT MAX(c.timestamp) FROM message AS c WHERE c.thread_root_id = message.id)"
+               ))
+               db.session.commit()
+           db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_message_thread_root_id ON message (thread_root_id)"))
+           db.session.commit()
+
+           # Составной индекс (room_id, id) для курсорной пагинации истории
+           db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_message_room_id_id ON message (room_id, id)"))
+           db.session.commit()
            
            # message_type для системных сообщений
            has_message_type = any(row[1] == 'message_type' for row in msg_info)
@@ -2052,9 +4860,85 @@ if __name__ == '__main__':
                    PollVote.__table__.create(db.engine)
                except OperationalError:
                    pass
+
+           # Счетчики реакций: индекс для постраничного списка и первичное заполнение
+           db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_message_reaction_msg_emoji_user ON message_reaction (message_id, emoji, user_id)"))
+           if not db.session.execute(text("SELECT 1 FROM message_reaction_count LIMIT 1")).first():
+               db.session.execute(text(
+                   "INSERT INTO message_reaction_count (message_id, emoji, count) "
+                   "SELECT message_id, emoji, COUNT(*) FROM message_reaction GROUP BY message_id, emoji"
+               ))
+           db.session.commit()
+
+           # user_search: триграммный индекс имен для /api/search_user
+           ensure_user_search_index()
+           db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_user_username_lower ON user (lower(username))"))
+           db.session.commit()
+           # message_search: новые сообщения индексируются сразу, старые — backfill_message_search.py
+           ensure_message_search_index()
+
+           # dm_pair: заполняем канонические пары для существующих личных чатов
+           # (если из-за старой гонки у пары несколько комнат, берется самая ранняя)
+           if not db.session.execute(text("SELECT 1 FROM dm_pair LIMIT 1")).first():
+               db.session.execute(text(
+                   "INSERT OR IGNORE INTO dm_pair (min_user_id, max_user_id, room_id) "
+                   "SELECT MIN(rp.user_id), MAX(rp.user_id), rp.room_id FROM room_participant rp "
+                   "JOIN room r ON r.id = rp.room_id WHERE r.type = 'dm' "
+                   "GROUP BY rp.room_id HAVING COUNT(*) = 2 ORDER BY rp.room_id"
+               ))
+               db.session.commit()
+
+           # Переносим опросы из JSON в content в таблицы poll/poll_option со счетчиками голосов
+           legacy_polls = (Message.query.outerjoin(Poll, Poll.message_id == Message.id)
+                           .filter(Message.message_type == 'poll', Poll.message_id.is_(None)).all())
+           for legacy in legacy_polls:
+               try:
+                   payload = json.loads(legacy.content or '{}')
+               except ValueError:
+                   payload = {}
+               votes = dict(db.session.query(PollVote.option_index, db.func.count())
+                            .filter(PollVote.message_id == legacy.id)
+                            .group_by(PollVote.option_index).all())
+               db.session.add(Poll(
+                   message_id=legacy.id,
+                   question=payload.get('question', ''),
+                   multiple_choice=bool(payload.get('multiple_choice')),
+                   anonymous=bool(payload.get('anonymous')),
+                   options=[PollOption(position=idx, text=str(text)[:100], vote_count=votes.get(idx, 0))
+                            for idx, text in enumerate(payload.get('options', []))]
+               ))
+           if legacy_polls:
+               db.session.commit()
+
+           # last_read_message_id: переносим старые счетчики unread_message в указатели прочтения
+           rp_info = db.session.execute(text("PRAGMA table_info(room_participant)")).fetchall()
+           if not any(row[1] == 'last_read_message_id' for row in rp_info):
+               db.session.execute(text("ALTER TABLE room_participant ADD COLUMN last_read_message_id INTEGER"))
+               db.session.commit()
+               legacy_counts = {}
+               if inspector.has_table('unread_message'):
+                   for row in db.session.execute(text("SELECT user_id, room_id, count FROM unread_message")).fetchall():
+                       legacy_counts[(row[0], row[1])] = row[2]
+               for participant in RoomParticipant.query.all():
+                   unread = legacy_counts.get((participant.user_id, participant.room_id), 0)
+                   # Указатель ставим на сообщение, после которого остается ровно unread чужих
+                   pointer = db.session.execute(
+                       db.select(Message.id)
+                       .where(Message.room_id == participant.room_id,
+                              db.or_(Message.sender_id.is_(None), Message.sender_id != participant.user_id))
+                       .order_by(Message.id.desc())
+                       .offset(unread)
+                       .limit(1)
+                   ).scalar()
+                   participant.last_read_message_id = pointer or 0
+               db.session.commit()
        except Exception as e:
            print(f"Migration error: {e}")
            pass
+
+if __name__ == '__main__':
+    # Сервер разработки (Werkzeug, перезагрузчик). Для продакшена: python serve.py
+    migrate_database()
     print("Сервер запущен на http://127.0.0.1:5000")
     try:
         print(f"Используемая БД: {app.config.get('SQLALCHEMY_DATABASE_URI')}")
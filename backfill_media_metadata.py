@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Заполняет метаданные вложений (размер, исходное имя, MIME, размеры картинки)
+для строк message_media, загруженных до появления этих столбцов, а затем
+размер, имя и MIME файлов media_url у сообщений (голосовые).
+
+Каждый файл читается один раз здесь, после чего история сериализуется
+без обращений к диску. Работает порциями по id, прерванный запуск
+продолжается с id, выведенного последним:
+
+    python backfill_media_metadata.py [start_id] [chunk_size]
+"""
+
+import sys
+
+from app import (app, backfill_media_metadata, backfill_message_file_metadata, migrate_database,
+                 MEDIA_METADATA_BACKFILL_CHUNK)
+
+start_id = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else MEDIA_METADATA_BACKFILL_CHUNK
+
+print("=" * 60)
+print("Заполнение метаданных вложений")
+print("=" * 60)
+
+# Добавляет недостающие столбцы, если сервер после обновления еще не запускался
+migrate_database()
+
+with app.app_context():
+    last_id = backfill_media_metadata(
+        chunk_size=chunk_size,
+        start_id=start_id,
+        progress=lambda media_id: print(f"Обработано до id={media_id}")
+    )
+    # Заполненные сообщения отбираются фильтром, поэтому этот этап всегда идет с начала
+    backfill_message_file_metadata(
+        chunk_size=chunk_size,
+        progress=lambda message_id: print(f"Голосовые: обработано до id сообщения={message_id}")
+    )
+
+print("=" * 60)
+print(f"Готово. Последний id: {last_id}")
+print("=" * 60)
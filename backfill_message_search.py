@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Заполняет полнотекстовый индекс message_search существующими сообщениями.
+
+Работает порциями по id, каждая порция — короткая транзакция, поэтому скрипт
+можно запускать на работающем сервере. Прерванный запуск продолжается с id,
+выведенного последним:
+
+    python backfill_message_search.py [start_id] [chunk_size]
+"""
+
+import sys
+
+from app import app, backfill_message_search, MESSAGE_SEARCH_BACKFILL_CHUNK
+
+start_id = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else MESSAGE_SEARCH_BACKFILL_CHUNK
+
+print("=" * 60)
+print("Индексация сообщений для поиска")
+print("=" * 60)
+
+with app.app_context():
+    last_id = backfill_message_search(
+        chunk_size=chunk_size,
+        start_id=start_id,
+        progress=lambda message_id: print(f"Обработано до id={message_id}")
+    )
+
+print("=" * 60)
+print(f"Готово. Последний id: {last_id}")
+print("=" * 60)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Нагрузочное сравнение режимов сервера (threading / gevent / eventlet).
+
+Для каждого режима поднимает serve.py на временной БД, подключает N клиентов
+Socket.IO (long-polling, как браузер), все заходят в одну группу, один клиент
+отправляет сообщения. Измеряются время подключения, задержка доставки,
+доля доставленных сообщений, RSS и число потоков сервера.
+
+    pip install "python-socketio[client]" gevent eventlet
+    python bench_concurrency.py --clients 200 --messages 20
+    python bench_concurrency.py --modes threading,gevent --clients 500
+
+Результаты и методика: PRODUCTION.md.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def prepare_database(db_path, clients):
+    """Пользователи и одна группа со всеми участниками; возвращает (room_id, cookies)"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+    os.environ['ASYNC_MODE'] = 'threading'
+    sys.path.insert(0, BASE_DIR)
+    from app import app, db, migrate_database, User, Room, RoomParticipant
+    migrate_database()
+    with app.app_context():
+        room = Room(name='bench', type='group')
+        db.session.add(room)
+        db.session.flush()
+        user_ids = []
+        for index in range(clients):
+            user = User(username=f'bench{index}', email=f'bench{index}@example.com',
+                        password_hash='-', is_verified=True)
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(RoomParticipant(user_id=user.id, room_id=room.id, role='admin' if index == 0 else 'member'))
+            user_ids.append(user.id)
+        db.session.commit()
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+        cookies = [f"{cookie_name}={serializer.dumps({'user_id': user_id})}" for user_id in user_ids]
+        return room.id, cookies
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/favicon.ico', timeout=1)
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def process_stats(pid):
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    stats['rss_mb'] = int(line.split()[1]) / 1024
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def run_mode(mode, port, db_path, room_id, cookies, messages, interval):
+    import socketio
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + db_path)
+    server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'serve.py'), '--mode', mode,
+                               '--host', '127.0.0.1', '--port', str(port), '--no-migrate'],
+                              env=env, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    result = {'mode': mode}
+    clients = []
+    try:
+        if not wait_for_server(url):
+            result['error'] = 'server did not start'
+            return result
+
+        latencies = []
+        lock = threading.Lock()
+
+        def on_message(data):
+            payload = data.get('message', data) if isinstance(data, dict) else {}
+            try:
+                sent_at = float(payload.get('content', ''))
+            except (TypeError, ValueError):
+                return
+            with lock:
+                latencies.append(time.time() - sent_at)
+
+        def connect(cookie):
+            client = socketio.Client(reconnection=False)
+            client.on('receive_message', on_message)
+            client.on('receive_message_with_unread', on_message)
+            started = time.time()
+            client.connect(url, headers={'Cookie': cookie}, transports=['polling'], wait_timeout=30)
+            client.emit('join', {'room_id': room_id})
+            return client, time.time() - started
+
+        connect_times = []
+        failures = 0
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            for future in [pool.submit(connect, cookie) for cookie in cookies]:
+                try:
+                    client, elapsed = future.result()
+                    clients.append(client)
+                    connect_times.append(elapsed)
+                except Exception:
+                    failures += 1
+        time.sleep(1)
+
+        sender = clients[0]
+        started = time.time()
+        for _ in range(messages):
+            sender.emit('send_message', {'room_id': room_id, 'content': repr(time.time())})
+            time.sleep(interval)
+        expected = messages * len(clients)
+        deadline = time.time() + 30
+        while time.time() < deadline and len(latencies) < expected:
+            time.sleep(0.2)
+        elapsed = time.time() - started
+
+        result.update(process_stats(server.pid))
+        result.update({
+            'connected': len(clients),
+            'connect_failures': failures,
+            'connect_p50': percentile(connect_times, 50),
+            'connect_p95': percentile(connect_times, 95),
+            'delivered': f"{len(latencies)}/{expected}",
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'latency_mean': statistics.mean(latencies) if latencies else float('nan'),
+            'deliveries_per_sec': len(latencies) / elapsed if elapsed else 0,
+        })
+        return result
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GlassChat concurrency benchmark')
+    parser.add_argument('--modes', default='threading,gevent,eventlet')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.05, help='пауза между сообщениями, с')
+    parser.add_argument('--port', type=int, default=5600)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='glasschat-bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    room_id, cookies = prepare_database(db_path, args.clients)
+
+    results = []
+    for offset, mode in enumerate(args.modes.split(',')):
+        print(f"== {mode}: {args.clients} клиентов, {args.messages} сообщений", flush=True)
+        result = run_mode(mode.strip(), args.port + offset, db_path, room_id, cookies, args.messages, args.interval)
+        results.append(result)
+        for key, value in result.items():
+            print(f"  {key}: {value:.3f}" if isinstance(value, float) else f"  {key}: {value}", flush=True)
+
+    print("\n| mode | connected | connect p95, s | latency p50, ms | latency p99, ms | delivered | RSS, MB | threads |")
+    print("|---|---|---|---|---|---|---|---|")
+    for r in results:
+        if 'error' in r:
+            print(f"| {r['mode']} | {r['error']} | | | | | | |")
+            continue
+        print(f"| {r['mode']} | {r['connected']} | {r['connect_p95']:.2f} | {r['latency_p50'] * 1000:.0f} | "
+              f"{r['latency_p99'] * 1000:.0f} | {r['delivered']} | {r.get('rss_mb', 0):.0f} | {r.get('threads', '?')} |")
+
+
+if __name__ == '__main__':
+    main()
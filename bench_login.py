@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Пропускная способность входа и задержка чата во время "шторма" логинов.
+
+Для каждого режима сервера и значения PASSWORD_HASH_WORKERS (0 — хэш считается
+в обработчике) поднимает serve.py на временной БД. Подключает клиентов чата, один
+из них шлет сообщения каждые 50 мс. Сначала задержка доставки меряется без
+нагрузки, затем параллельно с потоками, которые непрерывно вызывают /api/login.
+
+    pip install "python-socketio[client]" gevent
+    python bench_login.py --modes threading,gevent --workers 0,2 --logins 50 --duration 10
+
+Методика и результаты: PRODUCTION.md.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bench_concurrency import BASE_DIR, percentile, prepare_database, wait_for_server
+
+PASSWORD = 'bench-password'
+
+
+def login_once(url, identifier):
+    request = urllib.request.Request(url + '/api/login', data=json.dumps({'identifier': identifier, 'password': PASSWORD}).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+
+def run_config(mode, workers, port, db_path, room_id, cookies, args):
+    import socketio
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + db_path, PASSWORD_HASH_WORKERS=str(workers))
+    server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'serve.py'), '--mode', mode,
+                               '--host', '127.0.0.1', '--port', str(port), '--no-migrate'],
+                              env=env, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    result = {'mode': mode, 'workers': workers}
+    clients = []
+    try:
+        if not wait_for_server(url):
+            result['error'] = 'server did not start'
+            return result
+        # Первый вход запускает пул процессов — в измерения он не попадает
+        login_once(url, 'bench0')
+
+        samples = []  # (время отправки, задержка)
+        lock = threading.Lock()
+
+        def on_message(data):
+            payload = data.get('message', data) if isinstance(data, dict) else {}
+            try:
+                sent_at = float(payload.get('content', ''))
+            except (TypeError, ValueError):
+                return
+            with lock:
+                samples.append((sent_at, time.time() - sent_at))
+
+        for cookie in cookies[:args.chat_clients]:
+            client = socketio.Client(reconnection=False)
+            client.on('receive_message', on_message)
+            client.on('receive_message_with_unread', on_message)
+            client.connect(url, headers={'Cookie': cookie}, transports=['polling'], wait_timeout=30)
+            client.emit('join', {'room_id': room_id})
+            clients.append(client)
+        time.sleep(1)
+
+        stop = threading.Event()
+
+        def chat_sender():
+            while not stop.is_set():
+                clients[0].emit('send_message', {'room_id': room_id, 'content': repr(time.time())})
+                time.sleep(0.05)
+
+        login_results = []  # (статус, длительность)
+
+        def login_worker(index):
+            while not stop.is_set():
+                started = time.time()
+                status = login_once(url, f'bench{index % len(cookies)}')
+                with lock:
+                    login_results.append((status, time.time() - started))
+
+        sender = threading.Thread(target=chat_sender, daemon=True)
+        sender.start()
+        time.sleep(args.baseline)
+        storm_started = time.time()
+        workers_threads = [threading.Thread(target=login_worker, args=(index,), daemon=True)
+                           for index in range(args.logins)]
+        for thread in workers_threads:
+            thread.start()
+        time.sleep(args.duration)
+        storm_finished = time.time()
+        stop.set()
+        for thread in workers_threads:
+            thread.join(timeout=35)
+        time.sleep(1)
+
+        with lock:
+            baseline = [latency for sent_at, latency in samples if sent_at < storm_started]
+            storm = [latency for sent_at, latency in samples if storm_started <= sent_at < storm_finished]
+            logins = list(login_results)
+        ok = [elapsed for status, elapsed in logins if status == 200]
+        result.update({
+            'chat_idle_p50': percentile(baseline, 50),
+            'chat_idle_p99': percentile(baseline, 99),
+            'chat_storm_p50': percentile(storm, 50),
+            'chat_storm_p99': percentile(storm, 99),
+            'logins_ok': len(ok),
+            'logins_per_sec': len(ok) / (storm_finished - storm_started),
+            'logins_503': sum(1 for status, _ in logins if status == 503),
+            'logins_failed': sum(1 for status, _ in logins if status not in (200, 503)),
+            'login_p50': percentile(ok, 50),
+            'login_p95': percentile(ok, 95),
+        })
+        return result
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GlassChat login storm benchmark')
+    parser.add_argument('--modes', default='threading,gevent')
+    parser.add_argument('--workers', default='0,2', help='значения PASSWORD_HASH_WORKERS через запятую')
+    parser.add_argument('--chat-clients', type=int, default=20)
+    parser.add_argument('--logins', type=int, default=50, help='параллельных потоков входа')
+    parser.add_argument('--baseline', type=float, default=3, help='секунд чата без нагрузки')
+    parser.add_argument('--duration', type=float, default=10, help='секунд шторма логинов')
+    parser.add_argument('--port', type=int, default=5700)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='glasschat-login-')
+    db_path = os.path.join(workdir, 'bench.db')
+    room_id, cookies = prepare_database(db_path, max(args.chat_clients, args.logins))
+    from werkzeug.security import generate_password_hash
+    with sqlite3.connect(db_path) as connection:
+        connection.execute('UPDATE user SET password_hash = ?', (generate_password_hash(PASSWORD),))
+
+    results = []
+    port = args.port
+    for mode in args.modes.split(','):
+        for workers in args.workers.split(','):
+            print(f"== {mode}, PASSWORD_HASH_WORKERS={workers}", flush=True)
+            result = run_config(mode.strip(), int(workers), port, db_path, room_id, cookies, args)
+            port += 1
+            results.append(result)
+            for key, value in result.items():
+                print(f"  {key}: {value:.3f}" if isinstance(value, float) else f"  {key}: {value}", flush=True)
+
+    print("\n| mode | workers | logins/s | 503 | login p95, ms | chat p50 idle / storm, ms | chat p99 idle / storm, ms |")
+    print("|---|---|---|---|---|---|---|")
+    for r in results:
+        if 'error' in r:
+            print(f"| {r['mode']} | {r['workers']} | {r['error']} | | | | |")
+            continue
+        print(f"| {r['mode']} | {r['workers']} | {r['logins_per_sec']:.1f} | {r['logins_503']} | {r['login_p95'] * 1000:.0f} | "
+              f"{r['chat_idle_p50'] * 1000:.0f} / {r['chat_storm_p50'] * 1000:.0f} | "
+              f"{r['chat_idle_p99'] * 1000:.0f} / {r['chat_storm_p99'] * 1000:.0f} |")
+
+
+if __name__ == '__main__':
+    main()
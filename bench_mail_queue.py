@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Проверка очереди писем (MailQueue) на локальном SMTP-заменителе.
+
+Поднимает в процессе простой SMTP-сервер с задержкой приветствия (как у
+удаленного Mail.ru/Яндекса) и, по желанию, временными отказами 451. Сначала
+отправляет письма по-старому, через mail.send (новое соединение на письмо),
+затем через MAIL_QUEUE. Печатает время, на которое блокируется обработчик
+запроса, время доставки всех писем, число SMTP-соединений и MAIL_QUEUE.stats().
+
+    python bench_mail_queue.py --messages 200 --handshake 0.3
+    python bench_mail_queue.py --messages 50 --fail-every 7 --retry-base 0.2
+
+Настоящая почта не отправляется: MAIL_SERVER указывает на заменитель.
+"""
+
+import argparse
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Минимальный SMTP-сервер: принимает письма и считает соединения"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, handshake_delay, fail_every):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.handshake_delay = handshake_delay
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.recipients = 0
+        self.messages = 0
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.handshake_delay)
+        self.reply('220 standin ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 standin')
+            elif command.startswith('MAIL FROM'):
+                self.reply('250 OK')
+            elif command.startswith('RCPT TO'):
+                with server.lock:
+                    server.recipients += 1
+                    refuse = server.fail_every and server.recipients % server.fail_every == 0
+                self.reply('451 try again later' if refuse else '250 OK')
+            elif command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b'.\r\n', b'.\n'):
+                        break
+                with server.lock:
+                    server.messages += 1
+                self.reply('250 queued')
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GlassChat mail queue benchmark')
+    parser.add_argument('--messages', type=int, default=100, help='писем через очередь')
+    parser.add_argument('--inline-messages', type=int, default=10, help='писем через mail.send для сравнения')
+    parser.add_argument('--handshake', type=float, default=0.3, help='задержка приветствия сервера, с')
+    parser.add_argument('--fail-every', type=int, default=0, help='каждому N-му получателю ответить 451')
+    parser.add_argument('--retry-base', type=float, default=None, help='первая пауза перед повтором, с')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    standin = SMTPStandIn(args.handshake, args.fail_every)
+    threading.Thread(target=standin.serve_forever, daemon=True).start()
+
+    os.environ.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='glasschat-mail-'), 'bench.db'),
+        'ASYNC_MODE': 'threading',
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(standin.server_address[1]),
+        'MAIL_USE_TLS': 'False',
+        'MAIL_USERNAME': 'bench@localhost',
+    })
+    os.environ.pop('MAIL_PASSWORD', None)
+    sys.path.insert(0, BASE_DIR)
+    from app import app, mail, MailMessage, MAIL_QUEUE
+
+    if args.retry_base is not None:
+        MAIL_QUEUE.retry_base = args.retry_base
+
+    def make_message(index):
+        return MailMessage(subject=f'bench {index}', recipients=[f'user{index}@example.com'],
+                           body='GlassChat mail queue benchmark', charset='utf-8')
+
+    with app.app_context():
+        if args.inline_messages:
+            print(f"== mail.send: {args.inline_messages} писем, приветствие {args.handshake} с", flush=True)
+            blocked = []
+            for index in range(args.inline_messages):
+                started = time.monotonic()
+                try:
+                    mail.send(make_message(index))
+                except Exception as e:
+                    print(f"  ошибка: {e}")
+                blocked.append(time.monotonic() - started)
+            print(f"  блокировка обработчика: в среднем {sum(blocked) / len(blocked) * 1000:.0f} мс, "
+                  f"всего {sum(blocked):.2f} с, соединений {standin.connections}", flush=True)
+
+        connections_before, delivered_before = standin.connections, standin.messages
+        print(f"== MAIL_QUEUE: {args.messages} писем", flush=True)
+        started = time.monotonic()
+        blocked = []
+        for index in range(args.messages):
+            enqueued = time.monotonic()
+            MAIL_QUEUE.enqueue(make_message(index))
+            blocked.append(time.monotonic() - enqueued)
+        deadline = started + args.timeout
+        while MAIL_QUEUE.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+
+    print(f"  блокировка обработчика: в среднем {sum(blocked) / len(blocked) * 1000:.3f} мс")
+    print(f"  все письма обработаны за {elapsed:.2f} с, доставлено {standin.messages - delivered_before}, "
+          f"соединений {standin.connections - connections_before}")
+    for key, value in MAIL_QUEUE.stats().items():
+        print(f"  {key}: {value}")
+    standin.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Проверка сходимости преобразования операций совместных документов.
+
+Сервер применяет a, затем b, преобразованную transform_document_op(b, a);
+клиент, автор b, получает a поверх своей b через transformRemoteDocumentOp(a, b)
+из chat.js. Оба текста обязаны совпасть, иначе клиент разойдется с сервером
+и перезапишет правки остальных. Скрипт перебирает случайные пары операций
+(включая одинаковые позиции и вложенные удаления) и сравнивает результаты.
+
+    python check_document_ops.py --cases 200000
+    python check_document_ops.py --cases 5000 --seed 7 --max-length 4
+
+Функции берутся прямо из app.py и static/js/chat.js, приложение не запускается;
+для клиентской стороны нужен node.
+"""
+
+import argparse
+import ast
+import json
+import os
+import random
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PY_FUNCTIONS = ('apply_document_op', 'transform_document_op')
+JS_FUNCTIONS = ('applyDocumentOp', 'transformRemoteDocumentOp')
+
+
+def load_server_functions():
+    with open(os.path.join(BASE_DIR, 'app.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    nodes = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in PY_FUNCTIONS]
+    namespace = {}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), 'app.py', 'exec'), namespace)
+    return namespace['apply_document_op'], namespace['transform_document_op']
+
+
+def extract_js_function(source, name):
+    start = source.index('function %s(' % name)
+    depth = 0
+    for index in range(source.index('{', start), len(source)):
+        if source[index] == '{':
+            depth += 1
+        elif source[index] == '}':
+            depth -= 1
+            if depth == 0:
+                return source[start:index + 1]
+    raise ValueError('незакрытая функция %s' % name)
+
+
+def run_client(cases):
+    with open(os.path.join(BASE_DIR, 'static', 'js', 'chat.js'), encoding='utf-8') as f:
+        source = f.read()
+    script = '\n'.join(extract_js_function(source, name) for name in JS_FUNCTIONS) + '''
+let input = '';
+process.stdin.on('data', chunk => { input += chunk; });
+process.stdin.on('end', () => {
+    const results = JSON.parse(input).map(([text, a, b]) =>
+        applyDocumentOp(applyDocumentOp(text, b), transformRemoteDocumentOp(a, b)));
+    process.stdout.write(JSON.stringify(results));
+});
+'''
+    completed = subprocess.run(['node', '-e', script], input=json.dumps(cases),
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+
+def random_op(rng, text, alphabet):
+    pos = rng.randint(0, len(text))
+    delete = rng.randint(0, len(text) - pos)
+    insert = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 2)))
+    return {'pos': pos, 'delete': delete, 'insert': insert}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-length', type=int, default=6, help='длина исходного текста')
+    args = parser.parse_args()
+
+    apply_op, transform_op = load_server_functions()
+    rng = random.Random(args.seed)
+    cases = []
+    for _ in range(args.cases):
+        text = ''.join(rng.choice('ab') for _ in range(rng.randint(0, args.max_length)))
+        a = random_op(rng, text, 'XZ')
+        b = random_op(rng, text, 'YW')
+        cases.append((text, a, b))
+
+    client = run_client(cases)
+    failures = 0
+    for (text, a, b), client_text in zip(cases, client):
+        server_text = apply_op(apply_op(text, a), transform_op(b, a))
+        if server_text != client_text:
+            failures += 1
+            if failures <= 5:
+                print('расхождение: %r a=%s b=%s сервер=%r клиент=%r' % (text, a, b, server_text, client_text))
+    print('случаев: %d, расхождений: %d' % (len(cases), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
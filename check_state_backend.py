@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Проверка общего состояния процессов (RedisStateBackend и PresenceRegistry) без Redis.
+
+Два RedisStateBackend над одним state_testing.LocalBroker играют роль двух
+процессов. Скрипт проверяет, что соединения пользователя видны из обоих
+процессов, опубликованный онлайн меняется ровно одним переходом, broadcast()
+доходит до другого процесса и не возвращается отправителю, а пользователи
+упавшего процесса (его ключ host:<id> истек) уходят в офлайн через sweep()
+уцелевшего.
+
+    python check_state_backend.py
+
+Классы берутся прямо из app.py, приложение не запускается.
+"""
+
+import ast
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from state_testing import LocalBroker
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CLASSES = ('RedisStateBackend', 'PresenceRegistry')
+
+
+def load_classes():
+    with open(os.path.join(BASE_DIR, 'app.py'), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    nodes = [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name in CLASSES]
+    namespace = {'json': json, 'threading': threading, 'time': time, 'uuid': uuid}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), 'app.py', 'exec'), namespace)
+    return namespace['RedisStateBackend'], namespace['PresenceRegistry']
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def main():
+    RedisStateBackend, PresenceRegistry = load_classes()
+    broker = LocalBroker()
+    first, second = RedisStateBackend(broker), RedisStateBackend(broker)
+    # Без задержек: переходы созревают к следующему collect_transitions()
+    first_presence = PresenceRegistry(first, 0, 0)
+    second_presence = PresenceRegistry(second, 0, 0)
+    failures = []
+
+    def check(name, ok):
+        print(('ok    ' if ok else 'FAIL  ') + name)
+        if not ok:
+            failures.append(name)
+
+    first_presence.connect('sid-a', 1)
+    check('соединение первого процесса видно второму', second.user_sids(1) == ['sid-a'])
+    check('вход публикует онлайн', first_presence.collect_transitions() == {1: True})
+    check('второй процесс видит пользователя онлайн', second_presence.is_online(1))
+
+    second_presence.connect('sid-b', 1)
+    check('второе соединение не публикует повторно', second_presence.collect_transitions() == {})
+    second_presence.disconnect('sid-b')
+    check('отключение при живом соединении не публикует офлайн', second_presence.collect_transitions() == {})
+
+    received_first, received_second = [], []
+    first.subscribe('events', received_first.append)
+    second.subscribe('events', received_second.append)
+    wait_for(lambda: broker.subscribed(first._key('channel', 'events')) == 2)
+    first.broadcast('events', {'n': 1})
+    check('broadcast доходит до другого процесса', wait_for(lambda: received_second == [{'n': 1}]))
+    check('broadcast не возвращается отправителю', received_first == [])
+
+    second_presence.connect('sid-c', 2)
+    second_presence.collect_transitions()
+    # Первый процесс "падает": перестает продлевать host:<id>, его отложенные переходы теряются
+    broker.advance(RedisStateBackend.HOST_TTL + 1)
+    check('соединения упавшего процесса не учитываются', second.user_sids(1) == [])
+    second_presence.sweep()
+    check('sweep уводит в офлайн пользователя упавшего процесса',
+          second_presence.collect_transitions() == {1: False})
+    check('пользователь упавшего процесса больше не онлайн', not second_presence.is_online(1))
+    check('пользователь живого процесса остается онлайн', second_presence.is_online(2))
+    check('офлайн публикуется один раз', first_presence.collect_transitions() == {} and
+          second_presence.collect_transitions() == {})
+
+    print('проверок не прошло: %d' % len(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Уменьшенные копии загруженных изображений (миниатюра, превью, аватар).
+
+Функции выполняются в отдельных процессах (ProcessPoolExecutor в app.py).
+Модуль импортирует только Pillow: дочерние процессы запускаются через spawn
+и импортируют модуль функции заново, поэтому он не должен тянуть за собой
+приложение.
+"""
+
+import os
+
+from PIL import Image, ImageOps
+
+# Защита от "бомб" с огромным разрешением при маленьком размере файла
+Image.MAX_IMAGE_PIXELS = 100_000_000
+
+WEBP_QUALITY = 80
+
+
+def _open(source_path):
+    image = Image.open(source_path)
+    if getattr(image, 'is_animated', False):
+        # Анимацию не режем: клиент продолжит показывать оригинал
+        return None
+    return image
+
+
+def _save_webp(image, target_path):
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    tmp_path = target_path + '.tmp'
+    image.save(tmp_path, 'WEBP', quality=WEBP_QUALITY, method=4)
+    os.replace(tmp_path, target_path)
+    return image.size
+
+
+def render_variants(source_path, target_base, sizes):
+    """Вписанные в max_side копии: {name: (path, width, height)}.
+
+    sizes — {name: max_side}. Копия не создается, если оригинал и так не больше
+    max_side: для нее клиент использует оригинал.
+    """
+    image = _open(source_path)
+    if image is None:
+        return {}
+    with image:
+        largest = max(sizes.values())
+        # JPEG декодируется сразу в уменьшенном масштабе, не разворачиваясь в память целиком
+        if image.format == 'JPEG':
+            image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image.load()
+        results = {}
+        for name, max_side in sorted(sizes.items(), key=lambda item: -item[1]):
+            if max(image.size) <= max_side:
+                continue
+            variant = image.copy()
+            variant.thumbnail((max_side, max_side), Image.LANCZOS)
+            target_path = f"{target_base}_{name}.webp"
+            width, height = _save_webp(variant, target_path)
+            results[name] = (target_path, width, height)
+        return results
+
+
+def render_avatar(source_path, target_base, side):
+    """Квадратный аватар side×side (обрезка по центру): (path, side, side) или None"""
+    image = _open(source_path)
+    if image is None:
+        return None
+    with image:
+        if image.format == 'JPEG':
+            image.draft('RGB', (side * 2, side * 2))
+        image = ImageOps.exif_transpose(image)
+        side = min(side, *image.size)
+        variant = ImageOps.fit(image, (side, side), Image.LANCZOS)
+        target_path = f"{target_base}_{side}.webp"
+        _save_webp(variant, target_path)
+        return target_path, side, side
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Продакшен-запуск GlassChat на кооперативном сервере (gevent или eventlet).
+
+    python serve.py                         # gevent, один процесс, 0.0.0.0:5000
+    python serve.py --mode eventlet
+    python serve.py --workers 4 --port 5000 # процессы на портах 5000..5003
+
+Отличия от `python app.py`: нет Werkzeug и перезагрузчика, monkey-patching
+выполняется до импорта приложения, пул соединений с БД подбирается под режим
+(DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT переопределяют значения по умолчанию).
+
+Несколько процессов (--workers > 1) требуют общего состояния (STATE_BACKEND_URL,
+например redis://localhost:6379/0) и балансировщика с липкими сессиями: клиент
+работает через long-polling, и все запросы одной сессии должны попадать в один
+процесс. Пример для nginx:
+
+    upstream glasschat {
+        ip_hash;
+        server 127.0.0.1:5000;
+        server 127.0.0.1:5001;
+    }
+
+Сравнение с режимом threading: bench_concurrency.py и PRODUCTION.md.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GlassChat production server')
+    parser.add_argument('--mode', choices=['gevent', 'eventlet', 'threading'],
+                        default=os.environ.get('ASYNC_MODE', 'gevent'))
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                        help='число процессов; процесс i слушает порт port+i')
+    parser.add_argument('--no-migrate', action='store_true', help='не выполнять миграцию БД перед стартом')
+    # Служебные флаги супервизора
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--migrate-only', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def patch_for(mode):
+    """monkey-patching стандартной библиотеки; должен идти до импорта app"""
+    if mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    elif mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+
+
+def run_worker(args):
+    patch_for(args.mode)
+    os.environ['ASYNC_MODE'] = args.mode
+    from app import app, socketio, migrate_database, DB_POOL_SIZE
+
+    if not args.worker and not args.no_migrate:
+        migrate_database()
+    print(f"GlassChat [{args.mode}] pid={os.getpid()} http://{args.host}:{args.port} (DB pool {DB_POOL_SIZE})")
+    options = {'allow_unsafe_werkzeug': True} if args.mode == 'threading' else {}
+    socketio.run(app, host=args.host, port=args.port, debug=False, use_reloader=False, log_output=False, **options)
+
+
+def run_supervisor(args):
+    """Запускает фиксированное число процессов и перезапускает упавшие"""
+    if not os.environ.get('STATE_BACKEND_URL'):
+        sys.exit("Для --workers > 1 задайте STATE_BACKEND_URL (например redis://localhost:6379/0)")
+
+    script = os.path.abspath(__file__)
+    if not args.no_migrate:
+        subprocess.run([sys.executable, script, '--mode', 'threading', '--migrate-only'], check=True)
+
+    def spawn(index):
+        return subprocess.Popen([sys.executable, script, '--worker', '--mode', args.mode,
+                                 '--host', args.host, '--port', str(args.port + index)])
+
+    workers = {index: spawn(index) for index in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(workers.items()):
+            if process.poll() is not None and not stopping:
+                print(f"Процесс на порту {args.port + index} завершился ({process.returncode}), перезапуск")
+                workers[index] = spawn(index)
+
+    for process in workers.values():
+        process.wait()
+
+
+def main():
+    args = parse_args()
+    if args.migrate_only:
+        from app import migrate_database
+        migrate_database()
+    elif args.workers > 1 and not args.worker:
+        run_supervisor(args)
+    else:
+        run_worker(args)
+
+
+if __name__ == '__main__':
+    main()
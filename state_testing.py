@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Внутрипроцессная замена Redis для проверки RedisStateBackend (app.py).
+
+LocalBroker поддерживает ровно те команды redis.Redis(decode_responses=True),
+которыми пользуется бэкенд: множества, ключи со сроком жизни, pipeline и
+pub/sub. Несколько RedisStateBackend над одним LocalBroker ведут себя как
+отдельные процессы над одним Redis:
+
+    broker = LocalBroker()
+    first, second = RedisStateBackend(broker), RedisStateBackend(broker)
+
+advance() сдвигает часы брокера, чтобы истекли ключи host:<id> процесса,
+который перестал продлевать их ("упал").
+"""
+
+import queue
+import threading
+import time
+
+
+class LocalBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sets = {}
+        self._values = {}  # key -> (value, expires_at)
+        self._subscribers = []
+        self._offset = 0.0
+
+    def _now(self):
+        return time.monotonic() + self._offset
+
+    def advance(self, seconds):
+        with self._lock:
+            self._offset += seconds
+
+    def sadd(self, key, *members):
+        with self._lock:
+            target = self._sets.setdefault(key, set())
+            added = [str(member) for member in members if str(member) not in target]
+            target.update(added)
+            return len(added)
+
+    def srem(self, key, *members):
+        with self._lock:
+            target = self._sets.get(key, set())
+            removed = [str(member) for member in members if str(member) in target]
+            target.difference_update(removed)
+            return len(removed)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._sets.get(key, ()))
+
+    def sismember(self, key, member):
+        with self._lock:
+            return str(member) in self._sets.get(key, ())
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, self._now() + ex if ex else None)
+
+    def exists(self, *keys):
+        with self._lock:
+            now = self._now()
+            return sum(1 for key in keys
+                       if key in self._values and (self._values[key][1] is None or self._values[key][1] > now))
+
+    def pipeline(self):
+        return _LocalPipeline(self)
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = [pubsub for pubsub in self._subscribers if channel in pubsub.channels]
+        for pubsub in subscribers:
+            pubsub.queue.put({'type': 'message', 'channel': channel, 'data': message})
+        return len(subscribers)
+
+    def pubsub(self):
+        pubsub = _LocalPubSub()
+        with self._lock:
+            self._subscribers.append(pubsub)
+        return pubsub
+
+    def subscribed(self, channel):
+        """Сколько подписчиков слушают канал (подписка в бэкенде идет в фоновом потоке)"""
+        with self._lock:
+            return sum(1 for pubsub in self._subscribers if channel in pubsub.channels)
+
+
+class _LocalPipeline:
+    def __init__(self, broker):
+        self._broker = broker
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._broker, name)
+
+        def queue_call(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class _LocalPubSub:
+    def __init__(self):
+        self.channels = set()
+        self.queue = queue.Queue()
+
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
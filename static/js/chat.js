@@ -1165,12 +1165,21 @@ document.addEventListener('DOMContentLoaded', (event) => {
     initializeReactionPicker();
     initializeWhiteboardUI();
 
-    socket.on('connect', () => console.log('WebSocket подключен!'));
+    let hasConnectedOnce = false;
+    socket.on('connect', () => {
+        console.log('WebSocket подключен!');
+        // После переподключения сверяем список комнат (дешево, если ничего не изменилось: 304)
+        if (hasConnectedOnce) {
+            syncRoomList();
+            if (documentState.roomId) syncDocument(documentState.roomId);
+        }
+        hasConnectedOnce = true;
+    });
 
     socket.on('receive_message', (data) => {
         console.log('Получено сообщение:', data);
         if (data.room_id == currentRoomId) {
-            displayMessage(data);
+            if (shouldDisplayLiveMessage(data)) displayMessage(data);
             // Воспроизводим звук только если сообщение не от нас
             if (data.sender_id !== CURRENT_USER_ID && data.message_type !== 'system') {
                 playMessageSound();
@@ -1189,7 +1198,7 @@ document.addEventListener('DOMContentLoaded', (event) => {
 
         if (message.room_id == currentRoomId) {
             // Если мы в этой комнате, просто отображаем сообщение
-            displayMessage(message);
+            if (shouldDisplayLiveMessage(message)) displayMessage(message);
             // И сразу же помечаем как прочитанное
             markRoomAsRead(message.room_id); 
             // Воспроизводим звук только если сообщение не от нас
@@ -1210,6 +1219,20 @@ document.addEventListener('DOMContentLoaded', (event) => {
         }
     });
 
+    // Большие группы и каналы: сообщение приходит общим receive_message,
+    // а счетчик непрочитанных — пачкой приращений раз в полсекунды
+    socket.on('unread_delta', (data) => {
+        if (!data || typeof data.room_id === 'undefined') return;
+        if (data.room_id == currentRoomId) {
+            scheduleMarkRoomAsRead(data.room_id);
+            return;
+        }
+        const own = (data.by_sender && data.by_sender[String(CURRENT_USER_ID)]) || 0;
+        const delta = (data.delta || 0) - own;
+        if (delta <= 0) return;
+        updateUnreadBadge(data.room_id, getUnreadBadgeCount(data.room_id) + delta);
+    });
+
     socket.on('room_read_receipt', (data) => {
         applyReadReceipt(data);
     });
@@ -1247,10 +1270,16 @@ document.addEventListener('DOMContentLoaded', (event) => {
         // data.presence: { userId: true/false }
         // Можно отрисовать индикаторы в UI (упростим: шапка показывает онлайн-счётчик)
         updatePresenceHeader(data.presence);
+        // data.sessions: активные доска и презентация комнаты на момент входа
+        applyRoomSessions(data.room_id, data.sessions || {});
     });
     socket.on('presence_update', (data) => {
         applyPresenceUpdate(data.user_id, data.online);
     });
+    socket.on('presence_batch', (data) => {
+        // data.updates: { userId: true/false } — накопленные за интервал изменения
+        Object.entries(data.updates || {}).forEach(([userId, online]) => applyPresenceUpdate(userId, online));
+    });
     socket.on('typing', (data) => {
         showTypingIndicator(data.user_id, !!data.is_typing);
     });
@@ -1271,6 +1300,12 @@ document.addEventListener('DOMContentLoaded', (event) => {
 
     // НОВОЕ: Обработчик обновления реакций (Получаем полное состояние)
     socket.on('update_reactions', (data) => {
+        // Сервер присылает только счетчики; свои реакции отслеживаем по автору изменения
+        if (data.user_id === CURRENT_USER_ID && data.action) {
+            const mine = getMyReactions(data.message_id);
+            if (data.action === 'add') mine.add(data.emoji);
+            else if (data.action === 'remove') mine.delete(data.emoji);
+        }
         updateMessageReactionsUI(data.message_id, data.reactions);
     });
 
@@ -1519,6 +1554,12 @@ document.addEventListener('DOMContentLoaded', (event) => {
         }
     });
 
+    // Счетчик комментариев ветки после удаления сообщений
+    socket.on('thread_stats_updated', (data) => {
+        if (!data || typeof data.root_id === 'undefined') return;
+        updateThreadButtonCount(data.root_id, data.thread_comment_count);
+    });
+
     // Перенесено внутрь инициализации: подписка на массовое удаление сообщений
     socket.on('messages_deleted', (data) => {
         if (data && data.message_ids) {
@@ -1544,19 +1585,15 @@ document.addEventListener('DOMContentLoaded', (event) => {
         }
     });
     
+    socket.on('whiteboard_session_end', (data = {}) => {
+        clearWhiteboardSession(data.room_id);
+    });
+    
     // Совместные документы
-    socket.on('document_update', (data) => {
-        if (!data.content) return;
-        
-        documentContent = data.content;
-        const editor = document.getElementById('documentEditor');
-        
-        // Обновляем только если документ открыт и пользователь не редактирует
-        if (editor && document.activeElement !== editor) {
-            const scrollPos = editor.scrollTop;
-            editor.innerHTML = data.content;
-            editor.scrollTop = scrollPos;
-        }
+    socket.on('document_delta', (data) => applyDocumentDelta(data));
+
+    socket.on('document_resync', (data) => {
+        if (String(data.room_id) === String(documentState.roomId)) syncDocument(documentState.roomId);
     });
     
     // Презентации
@@ -1564,6 +1601,32 @@ document.addEventListener('DOMContentLoaded', (event) => {
         currentSlideIndex = data.slide_index;
         renderSlides();
     });
+
+    socket.on('presentation_end', () => {
+        presentationBroadcasting = false;
+    });
+
+    // Готовы уменьшенные копии картинок сообщения
+    socket.on('media_variants_ready', (data = {}) => {
+        const container = document.querySelector(`.message-container[data-message-id="${data.message_id}"]`);
+        if (!container) return;
+        (data.media_items || []).forEach(item => {
+            container.querySelectorAll('.message-media-gallery img').forEach(img => {
+                if (img.dataset.mediaUrl !== item.url) return;
+                if (item.thumbnail_url) img.src = item.thumbnail_url;
+                if (item.preview_url) img.dataset.previewUrl = item.preview_url;
+            });
+        });
+    });
+
+    // Собственный аватар заменен уменьшенной копией
+    socket.on('avatar_updated', (data = {}) => {
+        if (!data.avatar_url) return;
+        ['inline-settings-avatar-img', 'settings-avatar-img', 'my-avatar-img'].forEach(id => {
+            const img = document.getElementById(id);
+            if (img) img.src = data.avatar_url;
+        });
+    });
     
     // Инициализация счетчиков чатов
     updateChatCounts();
@@ -2753,6 +2816,7 @@ function updateUnreadBadge(roomId, count) {
             roomElement.appendChild(badge);
         }
         badge.textContent = count > 99 ? '99+' : count;
+        badge.dataset.count = String(count);
         badge.style.display = 'block';
     } else {
         if (badge) {
@@ -2761,6 +2825,23 @@ function updateUnreadBadge(roomId, count) {
     }
 }
 
+function getUnreadBadgeCount(roomId) {
+    const badge = document.querySelector(`.room-item[data-room-id="${roomId}"] .unread-badge`);
+    if (!badge) return 0;
+    const count = parseInt(badge.dataset.count || badge.textContent, 10);
+    return Number.isNaN(count) ? 0 : count;
+}
+
+const markRoomAsReadTimers = new Map();
+function scheduleMarkRoomAsRead(roomId) {
+    // Склеиваем частые отметки о прочтении в активном большом канале в один запрос
+    if (markRoomAsReadTimers.has(roomId)) return;
+    markRoomAsReadTimers.set(roomId, setTimeout(() => {
+        markRoomAsReadTimers.delete(roomId);
+        markRoomAsRead(roomId);
+    }, 1000));
+}
+
 async function markRoomAsRead(roomId) {
     // Сначала обновляем UI немедленно
     updateUnreadBadge(roomId, 0);
@@ -2777,19 +2858,164 @@ async function markRoomAsRead(roomId) {
     }
 }
 
-async function loadChatHistory(roomId) {
+// История грузится страницами по курсору: в окне всегда непрерывный диапазон сообщений
+// от oldestId до newestId. Прокрутка вверх догружает before=<oldestId>, вниз (после
+// перехода к старому сообщению) — after=<newestId>; новые сообщения по сокету
+// добавляются, только когда диапазон доходит до конца истории.
+let historyState = { roomId: null, oldestId: null, newestId: null, hasMoreBefore: false, hasMoreAfter: false, loading: false };
+// Пока страница вставляется не в конец, displayMessage ставит сообщения перед historyPlacement.before
+let historyPlacement = null;
+const HISTORY_SCROLL_THRESHOLD = 200; // px до края окна, после которых грузится следующая страница
+
+function placeMessageElement(element) {
+    if (historyPlacement) {
+        chatWindow.insertBefore(element, historyPlacement.before);
+        return;
+    }
+    chatWindow.appendChild(element);
+    chatWindow.scrollTop = chatWindow.scrollHeight;
+}
+
+function historyMessageElements() {
+    return chatWindow.querySelectorAll(':scope > [data-message-id]');
+}
+
+async function fetchHistoryPage(roomId, params = {}) {
+    const query = new URLSearchParams(params).toString();
+    const response = await fetch(`/api/chat_history/${roomId}${query ? `?${query}` : ''}`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return {
+        messages: await response.json(),
+        hasMoreBefore: response.headers.get('X-Has-More-Before') === '1',
+        hasMoreAfter: response.headers.get('X-Has-More-After') === '1'
+    };
+}
+
+function renderHistoryPage(messages, before) {
+    historyPlacement = { before };
+    try {
+        messages.forEach(message => displayMessage(message));
+    } finally {
+        historyPlacement = null;
+    }
+}
+
+// Первая страница комнаты (последние сообщения) или страница вокруг aroundId
+async function loadChatHistory(roomId, aroundId = null) {
+    historyState = { roomId: String(roomId), oldestId: null, newestId: null, hasMoreBefore: false, hasMoreAfter: false, loading: true };
     try {
-        const response = await fetch(`/api/chat_history/${roomId}`);
-        if (response.ok) {
-            const messages = await response.json();
-            messages.forEach(message => displayMessage(message));
+        const page = await fetchHistoryPage(roomId, aroundId ? { around: aroundId } : {});
+        if (String(roomId) !== String(currentRoomId) || historyState.roomId !== String(roomId)) return;
+        historyMessageElements().forEach(element => element.remove());
+        if (aroundId) {
+            renderHistoryPage(page.messages, null);
         } else {
-            console.error('Не удалось загрузить историю чата:', response.status);
-            placeholderText.textContent = "Ошибка загрузки истории.";
-            placeholderText.style.display = 'block';
+            page.messages.forEach(message => displayMessage(message));
         }
+        historyState.hasMoreBefore = page.hasMoreBefore;
+        historyState.hasMoreAfter = page.hasMoreAfter;
+        if (page.messages.length) {
+            historyState.oldestId = page.messages[0].id;
+            historyState.newestId = page.messages[page.messages.length - 1].id;
+        }
+        loadReadReceipts(roomId);
+        if (aroundId) highlightMessage(aroundId);
     } catch (error) {
-        console.error('Ошибка при загрузке истории:', error);
+        console.error('Не удалось загрузить историю чата:', error);
+        placeholderText.textContent = "Ошибка загрузки истории.";
+        placeholderText.style.display = 'block';
+    } finally {
+        if (historyState.roomId === String(roomId)) historyState.loading = false;
+    }
+}
+
+async function loadOlderMessages() {
+    const state = historyState;
+    if (state.loading || !state.hasMoreBefore || state.oldestId === null || state.roomId !== String(currentRoomId)) return;
+    state.loading = true;
+    try {
+        const page = await fetchHistoryPage(state.roomId, { before: state.oldestId });
+        if (historyState !== state) return;
+        // Позиция прокрутки сохраняется относительно уже показанных сообщений
+        const previousHeight = chatWindow.scrollHeight;
+        const previousTop = chatWindow.scrollTop;
+        renderHistoryPage(page.messages, historyMessageElements()[0] || null);
+        chatWindow.scrollTop = previousTop + (chatWindow.scrollHeight - previousHeight);
+        state.hasMoreBefore = page.hasMoreBefore;
+        if (page.messages.length) state.oldestId = page.messages[0].id;
+        loadReadReceipts(state.roomId);
+    } catch (error) {
+        console.error('Не удалось загрузить более ранние сообщения:', error);
+    } finally {
+        state.loading = false;
+    }
+}
+
+async function loadNewerMessages() {
+    const state = historyState;
+    if (state.loading || !state.hasMoreAfter || state.newestId === null || state.roomId !== String(currentRoomId)) return;
+    state.loading = true;
+    try {
+        const page = await fetchHistoryPage(state.roomId, { after: state.newestId });
+        if (historyState !== state) return;
+        renderHistoryPage(page.messages, null);
+        state.hasMoreAfter = page.hasMoreAfter;
+        if (page.messages.length) state.newestId = page.messages[page.messages.length - 1].id;
+        loadReadReceipts(state.roomId);
+    } catch (error) {
+        console.error('Не удалось загрузить более новые сообщения:', error);
+    } finally {
+        state.loading = false;
+    }
+}
+
+chatWindow.addEventListener('scroll', () => {
+    if (chatWindow.scrollTop < HISTORY_SCROLL_THRESHOLD) {
+        loadOlderMessages();
+    } else if (chatWindow.scrollHeight - chatWindow.scrollTop - chatWindow.clientHeight < HISTORY_SCROLL_THRESHOLD) {
+        loadNewerMessages();
+    }
+});
+
+// Новое сообщение по сокету: показывается, только если в окне конец истории.
+// Иначе оно придет при прокрутке вниз; свое сообщение возвращает к последней странице.
+function shouldDisplayLiveMessage(message) {
+    // Комментарии тредов идут в панель треда, а не в окно истории
+    if (typeof message.thread_root_id !== 'undefined') return true;
+    if (historyState.roomId !== String(message.room_id) || !historyState.hasMoreAfter) return true;
+    if (message.sender_id == CURRENT_USER_ID) loadChatHistory(message.room_id);
+    return false;
+}
+
+function highlightMessage(messageId) {
+    const element = chatWindow.querySelector(`:scope > [data-message-id="${messageId}"]`);
+    if (!element) return false;
+    element.scrollIntoView({ block: 'center' });
+    element.classList.add('jump-target');
+    setTimeout(() => element.classList.remove('jump-target'), 2000);
+    return true;
+}
+
+// Переход к сообщению (например, из результатов поиска): если его нет в окне,
+// загружается страница вокруг него
+function jumpToMessage(roomId, messageId) {
+    if (String(roomId) !== String(currentRoomId)) {
+        const roomElement = document.querySelector(`.room-item[data-room-id="${roomId}"]`);
+        if (roomElement) selectRoom(roomElement, messageId);
+        return;
+    }
+    if (!highlightMessage(messageId)) loadChatHistory(roomId, messageId);
+}
+
+async function loadReadReceipts(roomId) {
+    // Текущие указатели прочтения участников, чтобы сразу отрисовать статусы "прочитано"
+    try {
+        const response = await fetch(`/api/read_receipts/${roomId}`);
+        if (!response.ok) return;
+        const data = await response.json();
+        (data.receipts || []).forEach(receipt => applyReadReceipt(receipt));
+    } catch (error) {
+        console.error('Не удалось загрузить статусы прочтения:', error);
     }
 }
 
@@ -3131,7 +3357,106 @@ async function sendMessage() {
     messageInput.focus();
 }
 
+// Файлы крупнее порога отправляются по частям через /api/uploads: при обрыве
+// загрузка продолжается с подтвержденного сервером смещения
+const CHUNKED_UPLOAD_THRESHOLD = 5 * 1024 * 1024;
+const CHUNKED_UPLOAD_CHUNK = 2 * 1024 * 1024;
+const CHUNKED_UPLOAD_RETRIES = 8;
+
+async function fetchUploadOffset(uploadId) {
+    try {
+        const response = await fetch(`/api/uploads/${uploadId}`);
+        const data = await response.json();
+        return data.success ? data.offset : null;
+    } catch (error) {
+        return null;
+    }
+}
+
+async function uploadFileInChunks(file) {
+    const initResponse = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            room_id: parseInt(currentRoomId),
+            filename: file.name,
+            size: file.size,
+            mime_type: file.type || null
+        })
+    });
+    const upload = await initResponse.json();
+    if (!upload.success) {
+        throw new Error(upload.message || 'не удалось начать загрузку');
+    }
+
+    const chunkSize = Math.min(upload.chunk_size, CHUNKED_UPLOAD_CHUNK);
+    let offset = upload.offset;
+    let failures = 0;
+    while (offset < file.size) {
+        const end = Math.min(offset + chunkSize, file.size);
+        try {
+            const response = await fetch(`/api/uploads/${upload.upload_id}`, {
+                method: 'PUT',
+                headers: { 'Content-Range': `bytes ${offset}-${end - 1}/${file.size}` },
+                body: file.slice(offset, end)
+            });
+            const data = await response.json();
+            if (typeof data.offset === 'number' && (response.ok || response.status === 409)) {
+                offset = data.offset;
+                failures = 0;
+                continue;
+            }
+            if (response.status === 403 || response.status === 404 || response.status === 413) {
+                throw Object.assign(new Error(data.message || 'загрузка отклонена'), { fatal: true });
+            }
+        } catch (error) {
+            if (error.fatal) throw error;
+        }
+
+        failures += 1;
+        if (failures > CHUNKED_UPLOAD_RETRIES) {
+            throw new Error('соединение потеряно');
+        }
+        await new Promise(resolve => setTimeout(resolve, Math.min(1000 * 2 ** failures, 30000)));
+        const confirmed = await fetchUploadOffset(upload.upload_id);
+        if (confirmed !== null) {
+            offset = confirmed;
+        }
+    }
+    return upload.upload_id;
+}
+
+async function sendChunkedFilesMessage(caption) {
+    const uploadIds = [];
+    for (const file of selectedFiles) {
+        uploadIds.push(await uploadFileInChunks(file));
+    }
+    const response = await fetch('/api/uploads/complete', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            room_id: parseInt(currentRoomId),
+            caption: caption || '',
+            upload_ids: uploadIds
+        })
+    });
+    return response.json();
+}
+
 async function sendFilesMessage(caption) {
+    if (selectedFiles.some(file => file.size > CHUNKED_UPLOAD_THRESHOLD)) {
+        try {
+            const data = await sendChunkedFilesMessage(caption);
+            if (!data.success) {
+                alert('Ошибка отправки файлов: ' + (data.message || 'неизвестная ошибка'));
+            }
+        } catch (error) {
+            console.error('Ошибка отправки файлов:', error);
+            alert('Не удалось отправить файлы: ' + error.message);
+        }
+        return;
+    }
+
     const formData = new FormData();
     formData.append('room_id', currentRoomId);
     formData.append('caption', caption || '');
@@ -3168,8 +3493,7 @@ function displayMessage(data) {
         systemMsg.className = 'system-message';
         systemMsg.textContent = data.content;
         systemMsg.setAttribute('data-message-id', data.id);
-        chatWindow.appendChild(systemMsg);
-        chatWindow.scrollTop = chatWindow.scrollHeight;
+        placeMessageElement(systemMsg);
         return;
     }
     
@@ -3202,8 +3526,7 @@ function displayMessage(data) {
             ${data.call_duration ? `<div class="call-card-duration">Длительность: ${data.call_duration}</div>` : ''}
         `;
         
-        chatWindow.appendChild(card);
-        chatWindow.scrollTop = chatWindow.scrollHeight;
+        placeMessageElement(card);
         return;
     }
     
@@ -3257,8 +3580,7 @@ function displayMessage(data) {
             }
         };
 
-        chatWindow.appendChild(voiceContainer);
-        chatWindow.scrollTop = chatWindow.scrollHeight;
+        placeMessageElement(voiceContainer);
 
         if (isSentVoice) {
             const statusEl = voiceContainer.querySelector('.message-status');
@@ -3408,13 +3730,16 @@ function displayMessage(data) {
             visualItems.forEach(item => {
                 if (item.type === 'image') {
                     const img = document.createElement('img');
-                    img.src = item.url;
+                    // Миниатюра, пока ее нет — оригинал (media_variants_ready подменит src)
+                    img.src = item.thumbnail_url || item.url;
+                    img.dataset.mediaUrl = item.url;
+                    if (item.preview_url) img.dataset.previewUrl = item.preview_url;
                     img.alt = 'Изображение';
                     img.loading = 'lazy';
                     img.addEventListener('click', (event) => {
                         event.preventDefault();
                         openMediaPreview({
-                            url: item.url,
+                            url: img.dataset.previewUrl || item.url,
                             name: item.name || item.url.split('/').pop(),
                             size: item.size,
                             type: item.mime_type || 'image',
@@ -3570,14 +3895,17 @@ function displayMessage(data) {
     innerContainer.appendChild(reactionsContainer);
     
     messageContainer.appendChild(innerContainer);
-    chatWindow.appendChild(messageContainer);
+    placeMessageElement(messageContainer);
 
     // НОВОЕ: Отображаем существующие реакции
+    if (Array.isArray(data.my_reactions)) {
+        myReactionsByMessage.set(String(data.id), new Set(data.my_reactions));
+    }
     if (data.reactions && Object.keys(data.reactions).length > 0) {
         updateMessageReactionsUI(data.id, data.reactions);
     }
 
-    chatWindow.scrollTop = chatWindow.scrollHeight;
+    if (!historyPlacement) chatWindow.scrollTop = chatWindow.scrollHeight;
 }
 
 // --- НОВОЕ: Функции Реакций и редактирования ---
@@ -3779,6 +4107,14 @@ function toggleReaction(messageId, emoji, isReactedByMe) {
     });
 }
 
+// Эмодзи, которые поставил текущий пользователь: { messageId: Set(emoji) }
+const myReactionsByMessage = new Map();
+function getMyReactions(messageId) {
+    const key = String(messageId);
+    if (!myReactionsByMessage.has(key)) myReactionsByMessage.set(key, new Set());
+    return myReactionsByMessage.get(key);
+}
+
 function updateMessageReactionsUI(messageId, reactions) {
     // Обновляем UI на основе полного состояния реакций, полученного от сервера
     const messageContainer = document.querySelector(`.message-container[data-message-id="${messageId}"]`);
@@ -3788,10 +4124,13 @@ function updateMessageReactionsUI(messageId, reactions) {
     reactionsContainer.innerHTML = ''; // Очищаем текущие реакции
 
     // Рендерим обновленный список
+    const mine = getMyReactions(messageId);
     for (const emoji in reactions) {
-        const userIds = reactions[emoji];
-        const count = userIds.length;
-        const isReactedByMe = userIds.includes(CURRENT_USER_ID);
+        // Компактный формат {emoji: count}; старый {emoji: [userIds]} тоже поддерживается
+        const value = reactions[emoji];
+        const count = Array.isArray(value) ? value.length : Number(value) || 0;
+        if (count <= 0) continue;
+        const isReactedByMe = Array.isArray(value) ? value.includes(CURRENT_USER_ID) : mine.has(emoji);
 
         const reactionElement = document.createElement('span');
         reactionElement.classList.add('reaction');
@@ -3831,6 +4170,50 @@ function updateMessageReactionsUI(messageId, reactions) {
 
 // --- Управление Сайдбаром (Обновлено для Аватаров) ---
 
+let roomListETag = null;
+
+async function syncRoomList() {
+    try {
+        const headers = {};
+        if (roomListETag) headers['If-None-Match'] = roomListETag;
+        const response = await fetch('/api/rooms', { headers, cache: 'no-store' });
+        if (response.status === 304 || !response.ok) return;
+        roomListETag = response.headers.get('ETag');
+        const data = await response.json();
+        const applyRoom = (room, isArchived) => {
+            const element = document.querySelector(`.room-item[data-room-id="${room.id}"]`);
+            if (element) {
+                updateRoomInSidebar(room);
+            } else if (!isArchived) {
+                addNewRoomToSidebar(room);
+            }
+            updateUnreadBadge(room.id, room.id == currentRoomId ? 0 : room.unread_count);
+        };
+        (data.rooms || []).forEach(room => applyRoom(room, false));
+        (data.archived_rooms || []).forEach(room => applyRoom(room, true));
+
+        // Комнаты, удаленные или покинутые, пока сокет был отключен
+        const knownIds = new Set([...(data.rooms || []), ...(data.archived_rooms || [])].map(room => String(room.id)));
+        document.querySelectorAll('#room-list .room-item, #archive-list .room-item').forEach(element => {
+            const roomId = element.getAttribute('data-room-id');
+            if (knownIds.has(roomId)) return;
+            element.remove();
+            if (roomId == currentRoomId) {
+                chatHeader.style.display = 'none';
+                chatInputArea.style.display = 'none';
+                placeholderText.textContent = 'Выберите чат для общения.';
+                placeholderText.style.display = 'block';
+                currentRoomId = null;
+                currentRoomType = null;
+                currentUserRole = null;
+            }
+        });
+        updateChatCounts();
+    } catch (error) {
+        console.error('Ошибка синхронизации списка комнат:', error);
+    }
+}
+
 function addNewRoomToSidebar(room) {
     let existingElement = document.querySelector(`.room-item[data-room-id="${room.id}"]`);
     if (existingElement) {
@@ -3887,6 +4270,7 @@ function addNewRoomToSidebar(room) {
         const badge = document.createElement('span');
         badge.className = 'unread-badge';
         badge.textContent = room.unread_count > 99 ? '99+' : room.unread_count;
+        badge.dataset.count = String(room.unread_count);
         li.appendChild(badge);
     }
 
@@ -4029,11 +4413,12 @@ async function openContactSettings() {
     // Получаем статистику сообщений для текущей комнаты
     if (currentRoomId) {
         try {
-            const response = await fetch(`/api/chat_history/${currentRoomId}`);
-            const messages = await response.json();
+            // История отдается страницами, поэтому счетчик считает сервер
+            const response = await fetch(`/api/room_stats/${currentRoomId}`);
+            const stats = await response.json();
             
             const messagesCountEl = document.getElementById('contactMessagesCount');
-            if (messagesCountEl) messagesCountEl.textContent = messages.length || '0';
+            if (messagesCountEl && stats.success) messagesCountEl.textContent = stats.messages;
         } catch (e) {
             console.log('Не удалось загрузить статистику сообщений:', e);
         }
@@ -4148,39 +4533,18 @@ async function openRoomSettings() {
         console.log('Не удалось загрузить количество участников:', e);
     }
     
-    // Получаем статистику комнаты
+    // Получаем статистику комнаты (по всей истории, а не по загруженной странице)
     try {
-        const response = await fetch(`/api/chat_history/${currentRoomId}`);
-        const messages = await response.json();
-        
-        // Подсчитываем сообщения
-        const messagesCountEl = document.getElementById('roomMessagesCount');
-        if (messagesCountEl) messagesCountEl.textContent = messages.length || '0';
-        
-        // Подсчитываем медиа (фото и видео)
-        let mediaCount = 0;
-        messages.forEach(msg => {
-            if (msg.media_items && msg.media_items.length > 0) {
-                mediaCount += msg.media_items.length;
-            }
-            if (msg.media_url) {
-                mediaCount++;
-            }
-        });
-        const mediaCountEl = document.getElementById('roomMediaCount');
-        if (mediaCountEl) mediaCountEl.textContent = mediaCount;
-        
-        // Подсчитываем ссылки (простой подсчет http/https в тексте)
-        let linksCount = 0;
-        messages.forEach(msg => {
-            if (msg.content) {
-                const urlRegex = /https?:\/\/[^\s]+/g;
-                const matches = msg.content.match(urlRegex);
-                if (matches) linksCount += matches.length;
-            }
-        });
-        const linksCountEl = document.getElementById('roomLinksCount');
-        if (linksCountEl) linksCountEl.textContent = linksCount;
+        const response = await fetch(`/api/room_stats/${currentRoomId}`);
+        const stats = await response.json();
+        if (stats.success) {
+            const messagesCountEl = document.getElementById('roomMessagesCount');
+            if (messagesCountEl) messagesCountEl.textContent = stats.messages;
+            const mediaCountEl = document.getElementById('roomMediaCount');
+            if (mediaCountEl) mediaCountEl.textContent = stats.media;
+            const linksCountEl = document.getElementById('roomLinksCount');
+            if (linksCountEl) linksCountEl.textContent = stats.links;
+        }
     } catch (e) {
         console.log('Не удалось загрузить статистику комнаты:', e);
     }
@@ -6292,18 +6656,25 @@ function searchUsers() {
     messageBox.style.display = 'none';
     resultsBox.innerHTML = '';
 
-    fetch(`/api/search_user?q=${encodeURIComponent(q)}`)
-        .then(r => r.json())
-        .then(data => {
-            if (!data.success) {
-                showMessage(messageBox, data.message || 'Не найдено.', 'error');
-                return;
-            }
-            if (!data.results || data.results.length === 0) {
-                resultsBox.innerHTML = '<p class="empty-state small">Никого не найдено.</p>';
+    // "@имя" ищет только людей, остальные запросы еще и по тексту сообщений
+    const usersRequest = fetch(`/api/search_user?q=${encodeURIComponent(q)}`).then(r => r.json());
+    const messagesRequest = q.startsWith('@')
+        ? Promise.resolve(null)
+        : fetch(`/api/search_messages?q=${encodeURIComponent(q)}`).then(r => r.json()).catch(() => null);
+
+    Promise.all([usersRequest, messagesRequest])
+        .then(([data, messageData]) => {
+            const users = data.success ? (data.results || []) : [];
+            const messages = messageData && messageData.success ? (messageData.results || []) : [];
+            if (users.length === 0 && messages.length === 0) {
+                if (!data.success) {
+                    showMessage(messageBox, data.message || 'Не найдено.', 'error');
+                } else {
+                    resultsBox.innerHTML = '<p class="empty-state small">Ничего не найдено.</p>';
+                }
                 return;
             }
-            data.results.forEach(user => {
+            users.forEach(user => {
                 const div = document.createElement('div');
                 div.className = 'search-result';
                 div.innerHTML = `<div><span class="result-username">@${user.username}</span></div>`;
@@ -6313,6 +6684,21 @@ function searchUsers() {
                 div.appendChild(btn);
                 resultsBox.appendChild(div);
             });
+            messages.forEach(result => {
+                // snippet уже экранирован сервером, <mark> выделяет совпадение
+                const div = document.createElement('div');
+                div.className = 'search-result message-search-result';
+                div.innerHTML = `<div><span class="result-username">@${result.sender_username}</span><span class="result-snippet">${result.snippet}</span></div>`;
+                const btn = document.createElement('button');
+                btn.textContent = 'Перейти';
+                btn.onclick = () => {
+                    closeModal({ target: document.getElementById('searchModal'), forceClose: true });
+                    // Комментарии треда показываются в его корневом сообщении
+                    jumpToMessage(result.room_id, result.thread_root_id || result.message_id);
+                };
+                div.appendChild(btn);
+                resultsBox.appendChild(div);
+            });
         })
         .catch(() => showMessage(messageBox, 'Ошибка сети.', 'error'));
 }
@@ -7020,7 +7406,7 @@ function closeMobileChat() {
 }
 
 // Закрываем список чатов при выборе комнаты на мобильных
-function selectRoom(element) {
+function selectRoom(element, aroundMessageId = null) {
     const roomId = element.getAttribute('data-room-id');
     const roomName = element.getAttribute('data-room-name');
     const roomType = element.getAttribute('data-room-type');
@@ -7059,7 +7445,7 @@ function selectRoom(element) {
     setupRoomUI();
 
     // D. Загружаем историю
-    loadChatHistory(roomId);
+    loadChatHistory(roomId, aroundMessageId);
 
     // E. Вступаем в новую комнату SocketIO
     socket.emit('join', { room_id: parseInt(currentRoomId) });
@@ -7426,6 +7812,41 @@ function setWhiteboardSessionUI(session) {
     }
 }
 
+function applyRoomSessions(roomId, sessions) {
+    const roomKey = String(roomId);
+    if (sessions.whiteboard && sessions.whiteboard.board_url) {
+        whiteboardSessions.set(roomKey, normalizeWhiteboardSession(sessions.whiteboard));
+    } else {
+        whiteboardSessions.delete(roomKey);
+    }
+    const presentation = sessions.presentation;
+    if (presentation && String(currentRoomId) === roomKey && presentation.slide_index < slides.length) {
+        currentSlideIndex = presentation.slide_index;
+        renderSlides();
+    }
+}
+
+function clearWhiteboardSession(roomId) {
+    const roomKey = String(roomId);
+    whiteboardSessions.delete(roomKey);
+    if (pendingWhiteboardInvite && pendingWhiteboardInvite.roomId === roomKey) {
+        dismissWhiteboardInvite();
+    }
+    if (activeWhiteboardSession && activeWhiteboardSession.roomId === roomKey) {
+        setWhiteboardSessionUI(null);
+    }
+}
+
+function endWhiteboardSession() {
+    if (!currentRoomId) return;
+    if (!confirm('Завершить доску для всех участников?')) return;
+    if (socket) {
+        socket.emit('whiteboard_session_end', { room_id: parseInt(currentRoomId, 10) });
+    }
+    clearWhiteboardSession(currentRoomId);
+    closeWhiteboardModal();
+}
+
 function announceWhiteboardSession(session) {
     if (!socket || !currentRoomId || !session) return;
     socket.emit('system_message', {
@@ -7575,11 +7996,142 @@ let documentContent = '';
 
 let documentSyncTimeout = null;
 
+// Состояние сервера: shadow — текст версии version, inflight — отправленная и еще
+// не подтвержденная операция. Локальные правки — разница между shadow и documentContent.
+let documentState = { roomId: null, version: 0, shadow: '', inflight: null, synced: false };
+
+// Операции {pos, delete, insert} считаются в символах Unicode, как на сервере
+function applyDocumentOp(text, op) {
+    const chars = Array.from(text);
+    return chars.slice(0, op.pos).join('') + op.insert + chars.slice(op.pos + op.delete).join('');
+}
+
+function diffDocument(oldText, newText) {
+    if (oldText === newText) return null;
+    const a = Array.from(oldText);
+    const b = Array.from(newText);
+    const limit = Math.min(a.length, b.length);
+    let prefix = 0;
+    while (prefix < limit && a[prefix] === b[prefix]) prefix++;
+    let suffix = 0;
+    while (suffix < limit - prefix && a[a.length - 1 - suffix] === b[b.length - 1 - suffix]) suffix++;
+    return { pos: prefix, delete: a.length - prefix - suffix, insert: b.slice(prefix, b.length - suffix).join('') };
+}
+
+// Удаленная операция поверх локальных правок — зеркало transform_document_op на сервере:
+// при пересечении диапазонов обе вставки сохраняются, первой идет левая, а при равных
+// позициях — удаленная (на сервере она применена раньше локальной)
+function transformRemoteDocumentOp(op, local) {
+    const end = op.pos + op.delete;
+    const localEnd = local.pos + local.delete;
+    const localLength = Array.from(local.insert).length;
+    if (end < local.pos) return op;
+    if (op.pos > localEnd) return { pos: op.pos + localLength - local.delete, delete: op.delete, insert: op.insert };
+    if (op.pos <= local.pos) {
+        if (end > localEnd) return { pos: op.pos, delete: op.delete - local.delete + localLength, insert: op.insert + local.insert };
+        return { pos: op.pos, delete: local.pos - op.pos, insert: op.insert };
+    }
+    return { pos: local.pos + localLength, delete: Math.max(0, end - localEnd), insert: op.insert };
+}
+
+function renderDocument(content) {
+    documentContent = content;
+    const editor = document.getElementById('documentEditor');
+    if (!editor || editor.innerHTML === content) return;
+    const scrollPos = editor.scrollTop;
+    const caret = document.activeElement === editor ? getCaretOffset(editor) : null;
+    editor.innerHTML = content;
+    editor.scrollTop = scrollPos;
+    if (caret !== null) setCaretOffset(editor, caret);
+}
+
+function getCaretOffset(element) {
+    const selection = window.getSelection();
+    if (!selection.rangeCount) return null;
+    const range = selection.getRangeAt(0).cloneRange();
+    range.selectNodeContents(element);
+    range.setEnd(selection.getRangeAt(0).endContainer, selection.getRangeAt(0).endOffset);
+    return range.toString().length;
+}
+
+function setCaretOffset(element, offset) {
+    const walker = document.createTreeWalker(element, NodeFilter.SHOW_TEXT);
+    let node;
+    while ((node = walker.nextNode())) {
+        if (offset <= node.length) {
+            const range = document.createRange();
+            range.setStart(node, offset);
+            range.collapse(true);
+            const selection = window.getSelection();
+            selection.removeAllRanges();
+            selection.addRange(range);
+            return;
+        }
+        offset -= node.length;
+    }
+}
+
+function syncDocument(roomId) {
+    if (!socket || !roomId) return;
+    documentState = { roomId, version: 0, shadow: '', inflight: null, synced: false };
+    socket.emit('document_sync', { room_id: roomId }, (data) => {
+        if (!data || !data.success || String(documentState.roomId) !== String(roomId)) return;
+        let content = data.snapshot || '';
+        (data.ops || []).forEach(entry => { content = applyDocumentOp(content, entry.op); });
+        documentState = { roomId, version: data.version, shadow: content, inflight: null, synced: true };
+        renderDocument(content);
+    });
+}
+
+function sendDocumentOp() {
+    if (!socket || !documentState.synced || documentState.inflight) return;
+    const op = diffDocument(documentState.shadow, documentContent);
+    if (!op) return;
+    const opId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    documentState.inflight = opId;
+    socket.emit('document_op', {
+        room_id: documentState.roomId,
+        version: documentState.version,
+        op,
+        op_id: opId
+    }, (result) => {
+        if (result && !result.success && !result.resync && documentState.inflight === opId) {
+            documentState.inflight = null;
+            if (result.message) alert(result.message);
+        }
+    });
+}
+
+function applyDocumentDelta(data) {
+    if (!documentState.synced || String(data.room_id) !== String(documentState.roomId)) return;
+    if (data.version <= documentState.version) return;
+    if (data.version !== documentState.version + 1) {
+        syncDocument(documentState.roomId);
+        return;
+    }
+    const previousShadow = documentState.shadow;
+    documentState.shadow = applyDocumentOp(previousShadow, data.op);
+    documentState.version = data.version;
+
+    if (data.op_id && data.op_id === documentState.inflight) {
+        // Подтверждение своей операции: отправляем накопившиеся за это время правки
+        documentState.inflight = null;
+        if (documentContent !== documentState.shadow) sendDocumentOp();
+        return;
+    }
+    const local = diffDocument(previousShadow, documentContent);
+    renderDocument(local ? applyDocumentOp(documentContent, transformRemoteDocumentOp(data.op, local)) : documentState.shadow);
+}
+
 function openDocuments() {
     openModal('documentsModal');
     const editor = document.getElementById('documentEditor');
 
-    if (documentContent) {
+    if (String(documentState.roomId) !== String(currentRoomId)) {
+        documentContent = '';
+        editor.innerHTML = '';
+        syncDocument(currentRoomId);
+    } else if (documentContent) {
         editor.innerHTML = documentContent;
     }
 
@@ -7589,14 +8141,8 @@ function openDocuments() {
 
             if (documentSyncTimeout) clearTimeout(documentSyncTimeout);
 
-            documentSyncTimeout = setTimeout(() => {
-                if (currentRoomId && socket) {
-                    socket.emit('document_update', {
-                        room_id: currentRoomId,
-                        content: documentContent
-                    });
-                }
-            }, 500);
+            // Отправляется только разница с последней версией сервера
+            documentSyncTimeout = setTimeout(sendDocumentOp, 300);
         });
         editor.dataset.bound = 'true';
     }
@@ -7680,6 +8226,7 @@ function sendDocumentToChat() {
 
 let slides = [];
 let currentSlideIndex = 0;
+let presentationBroadcasting = false;
 let presentationSelectedElementId = null;
 let presentationColor = '#007aff';
 let presentationFontSize = 32;
@@ -8378,6 +8925,7 @@ function deleteSlide() {
 
 function syncSlideChange() {
     if (currentRoomId && socket) {
+        presentationBroadcasting = true;
         socket.emit('presentation_slide_change', {
             room_id: currentRoomId,
             slide_index: currentSlideIndex
@@ -8402,6 +8950,11 @@ document.addEventListener('click', function detachPresentationKeys(e) {
     const overlay = e && e.target && e.target.closest && e.target.closest('#presentationModal');
     if (overlay && (e.target.classList.contains('close-btn') || e.target.id === 'presentationModal')) {
         document.removeEventListener('keydown', handlePresentationKeys);
+        // Ведущий закрыл презентацию — новые участники больше не получают текущий слайд
+        if (presentationBroadcasting && currentRoomId && socket) {
+            socket.emit('presentation_end', { room_id: parseInt(currentRoomId, 10) });
+            presentationBroadcasting = false;
+        }
     }
 });
 